@@ -26,6 +26,7 @@ from flask_github import GitHub
 from flask_login import logout_user, current_user, LoginManager
 from flask_mail import Mail
 from flask_wtf.csrf import CSRFProtect
+from werkzeug.middleware.proxy_fix import ProxyFix
 
 from app.markdown import init_markdown, MARKDOWN_EXTENSIONS, MARKDOWN_EXTENSION_CONFIG
 
@@ -101,6 +102,12 @@ app.config.from_pyfile(os.environ["FLASK_CONFIG"])
 if not app.config["ADMIN_CONTACT_URL"]:
 	raise Exception("Missing config property: ADMIN_CONTACT_URL")
 
+# request.remote_addr is the client address given by the reverse proxies, the rest of
+# X-Forwarded-For is set by the client and can't be trusted
+proxy_count = app.config.get("REVERSE_PROXY_COUNT", 1)
+if proxy_count > 0:
+	app.wsgi_app = ProxyFix(app.wsgi_app, x_for=proxy_count)
+
 redis_client = redis.Redis.from_url(app.config["REDIS_URL"])
 
 github = GitHub(app)
@@ -122,6 +129,10 @@ sass(app)
 from . import models, template_filters
 
 
+from .instrumentation import init_app as instrumentation
+instrumentation(app)
+
+
 @login_manager.user_loader
 def load_user(user_id):
 	return models.User.query.filter_by(username=user_id).first()
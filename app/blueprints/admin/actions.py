@@ -101,9 +101,7 @@ def del_mod_names():
 
 @action("Recalc package scores")
 def recalc_scores():
-	for package in Package.query.all():
-		package.recalculate_score()
-
+	Package.recalculate_review_aggregates()
 	db.session.commit()
 
 	flash("Recalculated package scores", "success")
@@ -23,7 +23,8 @@ from app.utils import rank_required, add_audit_log, add_notification, get_system
 	get_int_or_abort
 from . import bp
 from .actions import actions
-from app.models import UserRank, Package, db, PackageState, User, AuditSeverity, NotificationType, PackageAlias
+from app.models import UserRank, Package, db, PackageState, User, AuditSeverity, NotificationType, PackageAlias, \
+	PackageDailyStats
 from ...querybuilder import QueryBuilder
 
 
@@ -154,6 +155,7 @@ def perform_transfer(form: TransferPackageForm):
 	for package in packages:
 		if form.remove_maintainer.data:
 			package.maintainers.remove(package.author)
+		PackageDailyStats.move_author_rollups(db.session, package.id, package.author_id, new_user.id)
 		package.author = new_user
 		package.maintainers.append(new_user)
 		package.aliases.append(PackageAlias(form.old_username.data, package.name))
@@ -19,21 +19,29 @@ import os
 from typing import List
 
 import flask_sqlalchemy
-from flask import request, jsonify, current_app
+from flask import request, jsonify, current_app, send_file
 from flask_babel import gettext
 from sqlalchemy import and_, or_
 from sqlalchemy.orm import joinedload
 from sqlalchemy.sql.expression import func
 
 from app import csrf
+from app.logic.catalogue import get_catalogue
+from app.logic.dependencies import get_dependency_graph, get_dependency_export
+from app.logic.downloads import iter_live_downloads, open_live_stream
+from app.logic.LogicError import LogicError
 from app.logic.graphs import get_package_stats, get_package_stats_for_user, get_all_package_stats
+from app.logic.serializers import PackageSerializer
 from app.markdown import render_markdown
 from app.models import Tag, PackageState, PackageType, Package, db, PackageRelease, Permission, \
 	MinetestRelease, APIToken, PackageScreenshot, License, ContentWarning, User, PackageReview, Thread, Collection, \
-	PackageAlias, Language
+	PackageAlias, Language, PackageLatestRelease, get_language_ids, STATS_GRANULARITIES
 from app.querybuilder import QueryBuilder
+from app.tasks.importtasks import export_dependencies
+from app.rediscache import get_downloads_channel
 from app.utils import is_package_page, get_int_or_abort, url_set_query, abs_url, is_yes, get_request_date, cached, \
-	cors_allowed
+	cached_with_etag, cors_allowed, response_cached, stream_json_list, stream_json_object, stream_server_sent_events
+from app.utils.pagination import keyset_paginate, KeysetPagination
 from app.utils.minetest_hypertext import html_to_minetest, package_info_as_hypertext, package_reviews_as_hypertext
 from . import bp
 from .auth import is_api_authd
@@ -41,52 +49,76 @@ from .support import error, api_create_vcs_release, api_create_zip_release, api_
 	api_order_screenshots, api_edit_package, api_set_cover_image
 
 
+def jsonify_keyset_page(pagination: KeysetPagination, to_dict):
+	return jsonify({
+		"per_page": pagination.per_page,
+		"urls": {
+			"first": abs_url(url_set_query(cursor="")),
+			"next": abs_url(url_set_query(cursor=pagination.next_cursor)) if pagination.has_next else None,
+		},
+		"items": [to_dict(item) for item in pagination.items],
+	})
+
+
 @bp.route("/api/packages/")
 @cors_allowed
-@cached(300)
+@cached_with_etag(300)
+@response_cached(300, ["*"])
 def packages():
-	allowed_languages = set([x[0] for x in db.session.query(Language.id).all()])
+	allowed_languages = get_language_ids()
 	lang = request.accept_languages.best_match(allowed_languages)
 
 	qb = QueryBuilder(request.args, lang=lang)
-	query = qb.build_package_query()
-
 	fmt = request.args.get("fmt")
-	if fmt == "keys":
-		return jsonify([pkg.as_key_dict() for pkg in query.all()])
-
 	include_vcs = fmt == "vcs"
-	pkgs = qb.convert_to_dictionary(query.all(), include_vcs)
-	if "engine_version" in request.args or "protocol_version" in request.args:
-		pkgs = [pkg for pkg in pkgs if pkg.get("release")]
+
+	# Answer from the in-memory snapshot, including search
+	entries = get_catalogue().query(qb)
+	if fmt == "keys":
+		return stream_json_list(entry.as_key_dict() for entry in entries)
 
 	# Promote featured packages
-	if "sort" not in request.args and \
+	promote_featured = "sort" not in request.args and \
 			"order" not in request.args and \
 			"q" not in request.args and \
-			"limit" not in request.args:
-		featured_lut = set()
-		featured = qb.convert_to_dictionary(query.filter(
-			Package.collections.any(and_(Collection.name == "featured", Collection.author.has(username="ContentDB")))).all(),
-			include_vcs)
-		for pkg in featured:
-			featured_lut.add(f"{pkg['author']}/{pkg['name']}")
+			"limit" not in request.args
+	if promote_featured:
+		entries = [entry for entry in entries if entry.featured] + [entry for entry in entries if not entry.featured]
+
+	base_url = current_app.config["BASE_URL"]
+
+	def to_dict(entry):
+		pkg = entry.as_short_dict(base_url, qb.version, qb.lang, include_vcs)
+		if promote_featured and entry.featured:
 			pkg["short_description"] = gettext("Featured") + ". " + pkg["short_description"]
 			pkg["featured"] = True
+		return pkg
 
-		not_featured = [pkg for pkg in pkgs if f"{pkg['author']}/{pkg['name']}" not in featured_lut]
-		pkgs = featured + not_featured
+	pkgs = (to_dict(entry) for entry in entries)
 
-	resp = jsonify(pkgs)
+	if "engine_version" in request.args or "protocol_version" in request.args:
+		pkgs = (pkg for pkg in pkgs if pkg.get("release"))
+
+	resp = stream_json_list(pkgs)
 	resp.vary = "Accept-Language"
 	return resp
 
 
+@bp.route("/api/packages/facets/")
+@cors_allowed
+@cached_with_etag(300)
+@response_cached(300, ["*"])
+def package_facets():
+	qb = QueryBuilder(request.args, lang="en")
+	return jsonify(get_catalogue().get_facets(qb))
+
+
 @bp.route("/api/packages/<author>/<name>/")
 @is_package_page
 @cors_allowed
+@response_cached(300, ["*"])
 def package_view(package):
-	allowed_languages = set([x[0] for x in db.session.query(Language.id).all()])
+	allowed_languages = get_language_ids()
 	lang = request.accept_languages.best_match(allowed_languages)
 
 	data = package.as_dict(current_app.config["BASE_URL"], lang=lang)
@@ -106,7 +138,7 @@ def package_view_client(package: Package):
 	else:
 		version = None
 
-	allowed_languages = set([x[0] for x in db.session.query(Language.id).all()])
+	allowed_languages = get_language_ids()
 	lang = request.accept_languages.best_match(allowed_languages)
 
 	data = package.as_dict(current_app.config["BASE_URL"], version, lang=lang, screenshots_dict=True)
@@ -121,10 +153,11 @@ def package_view_client(package: Package):
 
 	data["download_size"] = package.get_download_release(version).file_size
 
+	reviews = package.get_review_summary()
 	data["reviews"] = {
-		"positive": package.reviews.filter(PackageReview.rating > 3).count(),
-		"neutral": package.reviews.filter(PackageReview.rating == 3).count(),
-		"negative": package.reviews.filter(PackageReview.rating < 3).count(),
+		"positive": reviews[0],
+		"neutral": reviews[1],
+		"negative": reviews[2],
 	}
 
 	resp = jsonify(data)
@@ -167,57 +200,23 @@ def edit_package(token, package):
 	return api_edit_package(token, package, request.json)
 
 
-def resolve_package_deps(out, package, only_hard, depth=1):
-	id_ = package.get_id()
-	if id_ in out:
-		return
-
-	ret = []
-	out[id_] = ret
-
-	if package.type != PackageType.MOD:
-		return
-
-	for dep in package.dependencies:
-		if only_hard and dep.optional:
-			continue
-
-		if dep.package:
-			name = dep.package.name
-			fulfilled_by = [ dep.package.get_id() ]
-			resolve_package_deps(out, dep.package, only_hard, depth)
-
-		elif dep.meta_package:
-			name = dep.meta_package.name
-			fulfilled_by = [ pkg.get_id() for pkg in dep.meta_package.packages if pkg.state == PackageState.APPROVED]
-
-			if depth == 1 and not dep.optional:
-				most_likely = next((pkg for pkg in dep.meta_package.packages \
-						if pkg.type == PackageType.MOD and pkg.state == PackageState.APPROVED), None)
-				if most_likely:
-					resolve_package_deps(out, most_likely, only_hard, depth + 1)
-
-		else:
-			raise Exception("Malformed dependency")
-
-		ret.append({
-			"name": name,
-			"is_optional": dep.optional,
-			"packages": fulfilled_by
-		})
-
-
 @bp.route("/api/packages/<author>/<name>/dependencies/")
 @is_package_page
 @cors_allowed
 @cached(300)
+@response_cached(300, ["*"])
 def package_dependencies(package):
-	only_hard = request.args.get("only_hard")
+	only_hard = bool(request.args.get("only_hard"))
 
-	out = {}
-	resolve_package_deps(out, package, only_hard)
+	depth = request.args.get("depth")
+	if depth == "all":
+		max_depth = None
+	else:
+		max_depth = get_int_or_abort(depth, 1)
+		if max_depth < 0:
+			error(400, "depth must be a positive number or all")
 
-	return jsonify(out)
+	return jsonify(get_dependency_graph().resolve(package.id, only_hard, max_depth))
 
 
 @bp.route("/api/topics/")
@@ -225,7 +224,7 @@ def package_dependencies(package):
 def topics():
 	qb = QueryBuilder(request.args)
 	query = qb.build_topic_query(show_added=True)
-	return jsonify([t.as_dict() for t in query.all()])
+	return stream_json_list(t.as_dict() for t in query.yield_per(500))
 
 
 @bp.route("/api/whoami/")
@@ -278,7 +277,14 @@ def list_all_releases():
 		query = query.join(Package)
 		query = query.filter(Package.maintainers.contains(maintainer))
 
-	return jsonify([ rel.as_long_dict() for rel in query.limit(30).all() ])
+	num = min(get_int_or_abort(request.args.get("n"), 30), 100)
+	pagination = keyset_paginate(query, [(PackageRelease.created_at, True), (PackageRelease.id, True)],
+			request.args.get("cursor"), num)
+
+	resp = jsonify([ rel.as_long_dict() for rel in pagination.items ])
+	if pagination.has_next:
+		resp.headers["Link"] = f"<{abs_url(url_set_query(cursor=pagination.next_cursor))}>; rel=\"next\""
+	return resp
 
 
 @bp.route("/api/packages/<author>/<name>/releases/")
@@ -523,6 +529,11 @@ def list_all_reviews():
 
 	query = query.order_by(db.desc(PackageReview.created_at))
 
+	if "cursor" in request.args:
+		keys = [(PackageReview.created_at, True), (PackageReview.id, True)]
+		return jsonify_keyset_page(keyset_paginate(query, keys, request.args["cursor"], num),
+				lambda review: review.as_dict(True))
+
 	pagination: flask_sqlalchemy.Pagination = query.paginate(page=page, per_page=num)
 	return jsonify({
 		"page": pagination.page,
@@ -537,6 +548,13 @@ def list_all_reviews():
 	})
 
 
+def get_stats_granularity() -> str:
+	granularity = request.args.get("granularity", "day")
+	if granularity not in STATS_GRANULARITIES:
+		error(400, "Unknown granularity, expected one of: " + ", ".join(STATS_GRANULARITIES))
+	return granularity
+
+
 @bp.route("/api/packages/<author>/<name>/stats/")
 @is_package_page
 @cors_allowed
@@ -544,30 +562,49 @@ def list_all_reviews():
 def package_stats(package: Package):
 	start = get_request_date("start")
 	end = get_request_date("end")
-	return jsonify(get_package_stats(package, start, end))
+	return jsonify(get_package_stats(package, start, end, get_stats_granularity()))
+
+
+def stream_live_downloads(channel: str):
+	try:
+		close = open_live_stream(request.remote_addr)
+	except LogicError as e:
+		error(e.code, e.message)
+
+	res = stream_server_sent_events(iter_live_downloads(channel))
+	res.call_on_close(close)
+	return res
+
+
+@bp.route("/api/packages/<author>/<name>/stats/live/")
+@is_package_page
+@cors_allowed
+def package_stats_live(package: Package):
+	return stream_live_downloads(get_downloads_channel("package", package.id))
 
 
 @bp.route("/api/package_stats/")
 @cors_allowed
 @cached(900)
 def all_package_stats():
-	return jsonify(get_all_package_stats())
+	return stream_json_object(get_all_package_stats())
 
 
 @bp.route("/api/scores/")
 @cors_allowed
-@cached(900)
+@cached_with_etag(900, period=900)
+@response_cached(900, ["*"])
 def package_scores():
 	qb = QueryBuilder(request.args)
 	query = qb.build_package_query()
 
-	pkgs = [package.as_score_dict() for package in query.all()]
-	return jsonify(pkgs)
+	query = query.options(joinedload(Package.author))
+	return stream_json_list(package.as_score_dict() for package in query.yield_per(500))
 
 
 @bp.route("/api/tags/")
 @cors_allowed
-@cached(60*60)
+@cached_with_etag(60*60, period=60*60)
 def tags():
 	return jsonify([tag.as_dict() for tag in Tag.query.order_by(db.asc(Tag.name)).all()])
 
@@ -590,6 +627,7 @@ def licenses():
 @bp.route("/api/homepage/")
 @cors_allowed
 @cached(300)
+@response_cached(300, ["*"])
 def homepage():
 	query = Package.query.filter_by(state=PackageState.APPROVED)
 	count = query.count()
@@ -613,8 +651,13 @@ def homepage():
 	downloads_result = db.session.query(func.sum(Package.downloads)).one_or_none()
 	downloads = 0 if not downloads_result or not downloads_result[0] else downloads_result[0]
 
+	lists = [spotlight, new, updated, pop_mod, pop_txp, pop_gam, high_reviewed]
+	package_ids = list({pkg.id for packages in lists for pkg in packages})
+	serializer = PackageSerializer(current_app.config["BASE_URL"])
+	package_dicts = dict(zip(package_ids, serializer.as_short_dicts(package_ids)))
+
 	def map_packages(packages: List[Package]):
-		return [pkg.as_short_dict(current_app.config["BASE_URL"]) for pkg in packages]
+		return [package_dicts[pkg.id] for pkg in packages]
 
 	return jsonify({
 		"count": count,
@@ -631,6 +674,7 @@ def homepage():
 
 @bp.route("/api/minetest_versions/")
 @cors_allowed
+@response_cached(60*60, ["minetest_release"])
 def versions():
 	protocol_version = request.args.get("protocol_version")
 	engine_version = request.args.get("engine_version")
@@ -647,28 +691,39 @@ def versions():
 
 @bp.route("/api/languages/")
 @cors_allowed
+@response_cached(60*60, ["language"])
 def languages():
 	return jsonify([x.as_dict() for x in Language.query.all()])
 
 
 @bp.route("/api/dependencies/")
 @cors_allowed
+@response_cached(300, ["*"])
 def all_deps():
 	qb = QueryBuilder(request.args)
 	query = qb.build_package_query()
 
+	graph = get_dependency_graph()
+
 	def format_pkg(pkg: Package):
+		node = graph.nodes[pkg.id]
+		depends, optional_depends = graph.get_raw_dependencies(node)
 		return {
-			"type": pkg.type.to_name(),
-			"author": pkg.author.username,
-			"name": pkg.name,
-			"provides": [x.name for x in pkg.provides],
-			"depends": [str(x) for x in pkg.dependencies if not x.optional],
-			"optional_depends": [str(x) for x in pkg.dependencies if x.optional],
+			"type": node.type.to_name(),
+			"author": node.author,
+			"name": node.name,
+			"provides": sorted(graph.meta_names[meta_id] for meta_id in node.provides),
+			"depends": depends,
+			"optional_depends": optional_depends,
 		}
 
 	page = get_int_or_abort(request.args.get("page"), 1)
 	num = min(get_int_or_abort(request.args.get("n"), 100), 300)
+
+	keys = qb.get_keyset_keys()
+	if "cursor" in request.args and keys:
+		return jsonify_keyset_page(keyset_paginate(query, keys, request.args["cursor"], num), format_pkg)
+
 	pagination: flask_sqlalchemy.Pagination = query.paginate(page=page, per_page=num)
 	return jsonify({
 		"page": pagination.page,
@@ -683,6 +738,18 @@ def all_deps():
 	})
 
 
+@bp.route("/api/dependencies/export/")
+@cors_allowed
+def all_deps_export():
+	export = get_dependency_export()
+	if export is None or not os.path.isfile(export[0]):
+		export_dependencies.delay()
+		error(503, "The export is being generated, try again later")
+
+	path, content_hash = export
+	return send_file(path, mimetype="application/json", etag=content_hash, conditional=True, max_age=300)
+
+
 @bp.route("/api/users/<username>/")
 @cors_allowed
 def user_view(username: str):
@@ -703,12 +770,23 @@ def user_stats(username: str):
 
 	start = get_request_date("start")
 	end = get_request_date("end")
-	return jsonify(get_package_stats_for_user(user, start, end))
+	return jsonify(get_package_stats_for_user(user, start, end, get_stats_granularity()))
+
+
+@bp.route("/api/users/<username>/stats/live/")
+@cors_allowed
+def user_stats_live(username: str):
+	user = User.query.filter_by(username=username).first()
+	if user is None:
+		error(404, "User not found")
+
+	return stream_live_downloads(get_downloads_channel("author", user.id))
 
 
 @bp.route("/api/cdb_schema/")
 @cors_allowed
 @cached(60*60)
+@response_cached(60*60, ["tag", "content_warning", "license"])
 def json_schema():
 	tags = Tag.query.all()
 	warnings = ContentWarning.query.all()
@@ -861,6 +939,7 @@ def collection_list():
 @bp.route("/api/collections/<author>/<name>/")
 @is_api_authd
 @cors_allowed
+@response_cached(300, ["*"])
 def collection_view(token, author, name):
 	user = token.owner if token else None
 
@@ -875,14 +954,17 @@ def collection_view(token, author, name):
 	if not collection.check_perm(user, Permission.EDIT_COLLECTION):
 		items = [x for x in items if x.package.check_perm(user, Permission.VIEW_PACKAGE)]
 
+	serializer = PackageSerializer(current_app.config["BASE_URL"])
+	package_dicts = serializer.as_short_dicts([x.package_id for x in items])
+
 	ret = collection.as_dict()
-	ret["items"] = [x.as_dict() for x in items]
+	ret["items"] = [x.as_dict(package_dict) for x, package_dict in zip(items, package_dicts)]
 	return jsonify(ret)
 
 
 @bp.route("/api/updates/")
 @cors_allowed
-@cached(300)
+@cached_with_etag(300)
 def updates():
 	protocol_version = get_int_or_abort(request.args.get("protocol_version"))
 	minetest_version = request.args.get("engine_version")
@@ -891,31 +973,12 @@ def updates():
 	else:
 		version = None
 
-	# Subquery to get the latest release for each package
-	latest_release_query = (db.session.query(
-		PackageRelease.package_id,
-		func.max(PackageRelease.id).label('max_release_id'))
-			.select_from(PackageRelease)
-			.filter(PackageRelease.approved == True))
-
-	if version:
-		latest_release_query = (latest_release_query
-			.filter(or_(PackageRelease.min_rel_id == None,
-				PackageRelease.min_rel_id <= version.id))
-			.filter(or_(PackageRelease.max_rel_id == None,
-				PackageRelease.max_rel_id >= version.id)))
-
-	latest_release_subquery = (
-		latest_release_query
-		.group_by(PackageRelease.package_id)
-		.subquery()
-	)
-
 	# Get package id and latest release
-	query = (db.session.query(User.username, Package.name, latest_release_subquery.c.max_release_id)
-		.select_from(Package)
+	query = (db.session.query(User.username, Package.name, PackageLatestRelease.release_id)
+		.select_from(PackageLatestRelease)
+		.join(Package, PackageLatestRelease.package_id == Package.id)
 		.join(User, Package.author)
-		.join(latest_release_subquery, Package.id == latest_release_subquery.c.package_id)
+		.filter(PackageLatestRelease.minetest_release_id == (version.id if version else None))
 		.filter(Package.state == PackageState.APPROVED)
 		.all())
 
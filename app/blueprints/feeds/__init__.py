@@ -17,10 +17,11 @@
 
 from flask import Blueprint, jsonify, render_template, make_response
 from flask_babel import gettext
+from sqlalchemy.orm import joinedload
 
 from app.markdown import render_markdown
 from app.models import Package, PackageState, db, PackageRelease
-from app.utils import is_package_page, abs_url_for, cached, cors_allowed
+from app.utils import is_package_page, abs_url_for, cached_with_etag, cors_allowed
 
 bp = Blueprint("feeds", __name__)
 
@@ -46,6 +47,7 @@ def _get_new_packages_feed(feed_url: str) -> dict:
 	packages = (Package.query
 		.filter(Package.state == PackageState.APPROVED)
 		.order_by(db.desc(Package.approved_at))
+		.options(joinedload(Package.author))
 		.limit(100)
 		.all())
 
@@ -74,6 +76,7 @@ def _get_releases_feed(query, feed_url: str):
 	releases = (query
 		.filter(PackageRelease.package.has(state=PackageState.APPROVED), PackageRelease.approved==True)
 		.order_by(db.desc(PackageRelease.created_at))
+		.options(joinedload(PackageRelease.package).joinedload(Package.author))
 		.limit(250)
 		.all())
 
@@ -115,7 +118,7 @@ def _atomify(feed):
 
 @bp.route("/feeds/all.json")
 @cors_allowed
-@cached(1800)
+@cached_with_etag(1800)
 def all_json():
 	feed = _get_all_feed(abs_url_for("feeds.all_json"))
 	return jsonify(feed)
@@ -123,7 +126,7 @@ def all_json():
 
 @bp.route("/feeds/all.atom")
 @cors_allowed
-@cached(1800)
+@cached_with_etag(1800)
 def all_atom():
 	feed = _get_all_feed(abs_url_for("feeds.all_atom"))
 	return _atomify(feed)
@@ -131,7 +134,7 @@ def all_atom():
 
 @bp.route("/feeds/packages.json")
 @cors_allowed
-@cached(1800)
+@cached_with_etag(1800)
 def packages_all_json():
 	feed = _get_new_packages_feed(abs_url_for("feeds.packages_all_json"))
 	return jsonify(feed)
@@ -139,7 +142,7 @@ def packages_all_json():
 
 @bp.route("/feeds/packages.atom")
 @cors_allowed
-@cached(1800)
+@cached_with_etag(1800)
 def packages_all_atom():
 	feed = _get_new_packages_feed(abs_url_for("feeds.packages_all_atom"))
 	return _atomify(feed)
@@ -147,7 +150,7 @@ def packages_all_atom():
 
 @bp.route("/feeds/releases.json")
 @cors_allowed
-@cached(1800)
+@cached_with_etag(1800)
 def releases_all_json():
 	feed = _get_releases_feed(PackageRelease.query, abs_url_for("feeds.releases_all_json"))
 	return jsonify(feed)
@@ -155,7 +158,7 @@ def releases_all_json():
 
 @bp.route("/feeds/releases.atom")
 @cors_allowed
-@cached(1800)
+@cached_with_etag(1800)
 def releases_all_atom():
 	feed = _get_releases_feed(PackageRelease.query, abs_url_for("feeds.releases_all_atom"))
 	return _atomify(feed)
@@ -164,7 +167,7 @@ def releases_all_atom():
 @bp.route("/packages/<author>/<name>/releases_feed.json")
 @cors_allowed
 @is_package_page
-@cached(1800)
+@cached_with_etag(1800)
 def releases_package_json(package: Package):
 	feed = _get_releases_feed(package.releases, package.get_url("feeds.releases_package_json", absolute=True))
 	return jsonify(feed)
@@ -173,7 +176,7 @@ def releases_package_json(package: Package):
 @bp.route("/packages/<author>/<name>/releases_feed.atom")
 @cors_allowed
 @is_package_page
-@cached(1800)
+@cached_with_etag(1800)
 def releases_package_atom(package: Package):
 	feed = _get_releases_feed(package.releases, package.get_url("feeds.releases_package_atom", absolute=True))
 	return _atomify(feed)
@@ -66,7 +66,8 @@ def home():
 
 	def package_spotlight_load(query):
 		return query.options(
-				load_only(Package.name, Package.title, Package.type, Package.short_desc, Package.state, Package.cover_image_id, raiseload=True),
+				load_only(Package.name, Package.title, Package.type, Package.short_desc, Package.state, Package.cover_image_id,
+						Package.reviews_positive, Package.reviews_neutral, Package.reviews_negative, raiseload=True),
 				subqueryload(Package.main_screenshot),
 				joinedload(Package.tags),
 				joinedload(Package.content_warnings),
@@ -31,22 +31,24 @@ from wtforms.validators import InputRequired, Length, Regexp, DataRequired, Opti
 from wtforms_sqlalchemy.fields import QuerySelectField, QuerySelectMultipleField
 
 from app.logic.LogicError import LogicError
+from app.logic.catalogue import get_catalogue
 from app.logic.packages import do_edit_package
 from app.querybuilder import QueryBuilder
-from app.rediscache import has_key, set_temp_key
+from app.rediscache import add_tag_view
 from app.tasks.importtasks import import_repo_screenshot, check_zip_release, remove_package_game_support, \
 	update_package_game_support
 from app.tasks.pkgtasks import check_package_on_submit
 from app.tasks.webhooktasks import post_discord_webhook
 
 from . import bp, get_package_tabs
-from app.models import Package, Tag, db, User, Tags, PackageState, Permission, PackageType, MetaPackage, ForumTopic, \
+from app.models import Package, Tag, db, User, PackageState, Permission, PackageType, MetaPackage, ForumTopic, \
 	Dependency, Thread, UserRank, PackageReview, PackageDevState, ContentWarning, License, AuditSeverity, \
 	PackageScreenshot, NotificationType, AuditLogEntry, PackageAlias, PackageProvides, PackageGameSupport, \
-	PackageDailyStats, Collection
+	PackageDailyStats, Collection, get_tag
 from app.utils import is_user_bot, get_int_or_abort, is_package_page, abs_url_for, add_audit_log, get_package_by_info, \
 	add_notification, get_system_user, rank_required, get_games_from_csv, get_daterange_options, \
 	post_to_approval_thread, normalize_line_endings
+from app.utils.pagination import keyset_paginate
 from app.logic.package_approval import validate_package_for_approval, can_move_to_state
 from app.logic.game_support import game_support_set
 
@@ -67,9 +69,7 @@ def list_all():
 		edited = False
 		for tag in qb.tags:
 			edited = True
-			key = "tag/{}/{}".format(ip, tag.name)
-			if not has_key(key):
-				set_temp_key(key, "true")
+			if add_tag_view(ip, tag.name):
 				Tag.query.filter_by(id=tag.id).update({
 						"views": Tag.views + 1
 					})
@@ -88,7 +88,11 @@ def list_all():
 
 	page  = get_int_or_abort(request.args.get("page"), 1)
 	num   = min(40, get_int_or_abort(request.args.get("n"), 100))
-	query = query.paginate(page=page, per_page=num)
+	keys  = qb.get_keyset_keys()
+	if keys and page == 1:
+		query = keyset_paginate(query, keys, request.args.get("cursor"), num)
+	else:
+		query = query.paginate(page=page, per_page=num)
 
 	search = request.args.get("q")
 	type_name = request.args.get("type")
@@ -105,17 +109,17 @@ def list_all():
 	if qb.search and not query.has_next:
 		topics = qb.build_topic_query().all()
 
-	tags_query = db.session.query(func.count(Tags.c.tag_id), Tag) \
-		.select_from(Tag).join(Tags).join(Package).filter(Package.state==PackageState.APPROVED) \
-		.group_by(Tag.id).order_by(db.asc(Tag.title))
-	tags = qb.filter_package_query(tags_query).all()
+	facets = get_catalogue().get_facets(qb)
+	tags = [(count, get_tag(name)) for name, count in facets["tags"].items()]
+	tags = [x for x in tags if x[1] is not None]
+	tags.sort(key=lambda x: x[1].title)
 
 	selected_tags = set(qb.tags)
 
 	return render_template("packages/list.html",
 			query_hint=qb.query_hint, packages=query.items, pagination=query,
 			query=search, tags=tags, selected_tags=selected_tags, type=type_name,
-			authors=authors, packages_count=query.total, topics=topics, noindex=qb.noindex)
+			authors=authors, topics=topics, noindex=qb.noindex or "cursor" in request.args)
 
 
 def get_releases(package):
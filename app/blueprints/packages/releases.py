@@ -25,9 +25,10 @@ from wtforms.validators import InputRequired, Length, Optional
 from wtforms_sqlalchemy.fields import QuerySelectField
 
 from app.logic.releases import do_create_vcs_release, LogicError, do_create_zip_release
-from app.models import Package, db, User, PackageState, Permission, UserRank, PackageDailyStats, MinetestRelease, \
+from app.logic.downloads import record_download
+from app.models import Package, db, User, PackageState, Permission, UserRank, MinetestRelease, \
 	PackageRelease, PackageUpdateTrigger, PackageUpdateConfig
-from app.rediscache import has_key, set_temp_key, make_download_key
+from app.rediscache import make_download_key
 from app.tasks.importtasks import check_update_config
 from app.utils import is_user_bot, is_package_page, nonempty_or_none, normalize_line_endings
 from . import bp, get_package_tabs
@@ -130,29 +131,7 @@ def download_release(package, id):
 		user_agent = request.headers.get("User-Agent") or ""
 		is_minetest = user_agent.startswith("Luanti") or user_agent.startswith("Minetest")
 		reason = request.args.get("reason")
-		PackageDailyStats.update(package, is_minetest, reason)
-
-		key = make_download_key(ip, release.package)
-		if not has_key(key):
-			set_temp_key(key, "true")
-
-			bonus = 0
-			if reason == "new":
-				bonus = 1
-			elif reason == "dependency" or reason == "update":
-				bonus = 0.5
-
-			PackageRelease.query.filter_by(id=release.id).update({
-					"downloads": PackageRelease.downloads + 1
-				})
-
-			Package.query.filter_by(id=package.id).update({
-					"downloads": Package.downloads + 1,
-					"score_downloads": Package.score_downloads + bonus,
-					"score": Package.score + bonus
-				})
-
-		db.session.commit()
+		record_download(make_download_key(ip, release.package), package.id, release.id, is_minetest, reason)
 
 	return redirect(release.url)
 
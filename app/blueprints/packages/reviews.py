@@ -30,6 +30,7 @@ from app.models import db, PackageReview, Thread, ThreadReply, NotificationType,
 from app.tasks.webhooktasks import post_discord_webhook
 from app.utils import is_package_page, add_notification, get_int_or_abort, is_yes, is_safe_url, rank_required, \
 	add_audit_log, has_blocked_domains, should_return_json, normalize_line_endings
+from app.utils.pagination import keyset_paginate
 from . import bp
 
 
@@ -38,7 +39,12 @@ def list_reviews():
 	page = get_int_or_abort(request.args.get("page"), 1)
 	num = min(40, get_int_or_abort(request.args.get("n"), 100))
 
-	pagination = PackageReview.query.order_by(db.desc(PackageReview.created_at)).paginate(page=page, per_page=num)
+	query = PackageReview.query.order_by(db.desc(PackageReview.created_at))
+	if page == 1:
+		pagination = keyset_paginate(query, [(PackageReview.created_at, True), (PackageReview.id, True)],
+				request.args.get("cursor"), num)
+	else:
+		pagination = query.paginate(page=page, per_page=num)
 	return render_template("packages/reviews_list.html", pagination=pagination, reviews=pagination.items)
 
 
@@ -94,6 +100,7 @@ def review(package):
 			flash(gettext("Linking to blocked sites is not allowed"), "danger")
 		else:
 			was_new = False
+			old_rating = review.rating if review else None
 			if not review:
 				was_new = True
 				review = PackageReview()
@@ -103,6 +110,7 @@ def review(package):
 
 			review.rating = int(form.rating.data)
 			review.language = form.language.data
+			package.update_review_aggregates(old_rating, review.rating)
 
 			thread = review.thread
 			if not thread:
@@ -130,8 +138,6 @@ def review(package):
 
 			db.session.commit()
 
-			package.recalculate_score()
-
 			if was_new:
 				notif_msg = "New review '{}'".format(form.title.data)
 				type = NotificationType.NEW_REVIEW
@@ -187,7 +193,7 @@ def delete_review(package, reviewer):
 
 	db.session.delete(review)
 
-	package.recalculate_score()
+	package.update_review_aggregates(review.rating, None)
 
 	db.session.commit()
 
@@ -32,6 +32,7 @@ from flask_wtf import FlaskForm
 from wtforms import StringField, TextAreaField, SubmitField, BooleanField
 from wtforms.validators import InputRequired, Length
 from app.utils import get_int_or_abort
+from app.utils.pagination import keyset_paginate
 
 
 @bp.route("/threads/")
@@ -54,7 +55,10 @@ def list_all():
 	page = get_int_or_abort(request.args.get("page"), 1)
 	num = min(40, get_int_or_abort(request.args.get("n"), 100))
 
-	pagination = query.paginate(page=page, per_page=num)
+	if page == 1:
+		pagination = keyset_paginate(query, [(Thread.created_at, True), (Thread.id, True)], request.args.get("cursor"), num)
+	else:
+		pagination = query.paginate(page=page, per_page=num)
 
 	return render_template("threads/list.html", pagination=pagination, threads=pagination.items,
 			package=package, noindex=pid)
@@ -134,6 +138,10 @@ def delete_thread(id):
 
 	msg = "Deleted thread {} by {}".format(thread.title, thread.author.display_name)
 
+	# Deleting the thread also deletes its review
+	if thread.review:
+		thread.review.package.update_review_aggregates(thread.review.rating, None)
+
 	db.session.delete(thread)
 
 	add_audit_log(AuditSeverity.MODERATION, current_user, msg, None, thread.package, summary)
@@ -292,6 +292,9 @@ def delete(username):
 				pkg.review_thread = None
 				db.session.delete(pkg)
 
+		for review in user.reviews:
+			review.package.update_review_aggregates(review.rating, None)
+
 		db.session.delete(user)
 	elif "deactivate" in request.form:
 		for reply in user.replies.all():
@@ -0,0 +1,119 @@
+# ContentDB
+# Copyright (C) rubenwardy
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import time
+from typing import List, Tuple
+
+import redis
+from flask import Flask, g, request, has_request_context
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+from app.logic.metrics import observe_many, request_duration, request_sql_statements, request_sql_duration, \
+	request_response_bytes
+
+
+# Records the time taken, SQL statements executed, and response size of each request, per
+# endpoint. Requests slower than SLOW_REQUEST_LOG_MS are logged with the statements they ran.
+
+# Maximum number of statements to keep for the slow request log
+MAX_LOGGED_STATEMENTS = 100
+
+
+class RequestStats:
+	start: float
+	statements: int
+	sql_time: float
+	statement_start: float
+	logged_statements: List[Tuple[float, str]]
+
+	def __init__(self, log_statements: bool):
+		self.start = time.perf_counter()
+		self.statements = 0
+		self.sql_time = 0
+		self.statement_start = 0
+		self.log_statements = log_statements
+		self.logged_statements = []
+
+
+def _get_stats():
+	if has_request_context():
+		return g.get("request_stats")
+	return None
+
+
+@event.listens_for(Engine, "before_cursor_execute")
+def _before_cursor_execute(_conn, _cursor, _statement, _parameters, _context, _executemany):
+	stats = _get_stats()
+	if stats:
+		stats.statement_start = time.perf_counter()
+
+
+@event.listens_for(Engine, "after_cursor_execute")
+def _after_cursor_execute(_conn, _cursor, statement, _parameters, _context, _executemany):
+	stats = _get_stats()
+	if stats:
+		duration = time.perf_counter() - stats.statement_start
+		stats.statements += 1
+		stats.sql_time += duration
+		if stats.log_statements and len(stats.logged_statements) < MAX_LOGGED_STATEMENTS:
+			stats.logged_statements.append((duration, statement))
+
+
+def _log_slow_request(app: Flask, stats: RequestStats, endpoint: str, duration: float):
+	lines = [f"Slow request: {request.method} {request.full_path} ({endpoint}) took {duration * 1000:.0f}ms, "
+			f"{stats.statements} SQL statements took {stats.sql_time * 1000:.0f}ms"]
+	for statement_duration, statement in stats.logged_statements:
+		lines.append(f"  [{statement_duration * 1000:.1f}ms] {' '.join(statement.split())}")
+	if stats.statements > len(stats.logged_statements):
+		lines.append(f"  ...and {stats.statements - len(stats.logged_statements)} more")
+
+	app.logger.warning("\n".join(lines))
+
+
+def init_app(app: Flask):
+	slow_request_ms = app.config.get("SLOW_REQUEST_LOG_MS")
+
+	@app.before_request
+	def start_request_stats():
+		g.request_stats = RequestStats(slow_request_ms is not None)
+
+	@app.after_request
+	def record_request_stats(response):
+		stats = g.pop("request_stats", None)
+		if stats is None:
+			return response
+
+		# Streamed bodies are sent after this, so aren't included
+		duration = time.perf_counter() - stats.start
+		labels = {"endpoint": request.endpoint or "none"}
+		observations = [
+			(request_duration, duration, labels),
+			(request_sql_statements, stats.statements, labels),
+			(request_sql_duration, stats.sql_time, labels),
+		]
+		if not response.is_streamed and response.content_length is not None:
+			observations.append((request_response_bytes, response.content_length, labels))
+
+		try:
+			observe_many(observations)
+		except redis.exceptions.RedisError:
+			app.logger.exception("Unable to record request metrics")
+
+		if slow_request_ms is not None and duration * 1000 >= slow_request_ms:
+			_log_slow_request(app, stats, labels["endpoint"], duration)
+
+		return response
@@ -0,0 +1,116 @@
+# ContentDB
+# Copyright (C) rubenwardy
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+from typing import Dict, Hashable, Iterable, List, Optional, Set
+
+
+# A bitmap index maps attribute keys, such as ("tag", 12), to the set of items that have that
+# attribute. Each item is given an ordinal, and sets are stored as Python ints with bit n set
+# when the item with ordinal n is in the set. This means that filters are just bitwise
+# operations, which are fast even when there are thousands of items.
+#
+# Ordinals of removed items are reused, so the bitmaps don't grow forever.
+
+
+class BitmapIndex:
+	items: List[Optional[object]]
+	ordinals: Dict[int, int]
+	bitmaps: Dict[Hashable, int]
+
+	# Item id to the keys it was added with, used to remove it
+	keys: Dict[int, Set[Hashable]]
+
+	free: List[int]
+	all: int
+
+	def __init__(self):
+		self.items = []
+		self.ordinals = {}
+		self.bitmaps = {}
+		self.keys = {}
+		self.free = []
+		self.all = 0
+
+	def copy(self) -> "BitmapIndex":
+		"""
+		Returns a copy that can be modified without affecting this index. Bitmaps are immutable
+		ints, so this is cheap.
+		"""
+		ret = BitmapIndex()
+		ret.items = list(self.items)
+		ret.ordinals = dict(self.ordinals)
+		ret.bitmaps = dict(self.bitmaps)
+		ret.keys = dict(self.keys)
+		ret.free = list(self.free)
+		ret.all = self.all
+		return ret
+
+	def add(self, id_: int, item, keys: Iterable[Hashable]):
+		self.remove(id_)
+
+		ordinal = self.free.pop() if len(self.free) > 0 else len(self.items)
+		if ordinal == len(self.items):
+			self.items.append(item)
+		else:
+			self.items[ordinal] = item
+
+		bit = 1 << ordinal
+		keys = set(keys)
+		for key in keys:
+			self.bitmaps[key] = self.bitmaps.get(key, 0) | bit
+
+		self.ordinals[id_] = ordinal
+		self.keys[id_] = keys
+		self.all |= bit
+
+	def remove(self, id_: int):
+		ordinal = self.ordinals.pop(id_, None)
+		if ordinal is None:
+			return
+
+		mask = ~(1 << ordinal)
+		for key in self.keys.pop(id_):
+			bitmap = self.bitmaps[key] & mask
+			if bitmap == 0:
+				del self.bitmaps[key]
+			else:
+				self.bitmaps[key] = bitmap
+
+		self.items[ordinal] = None
+		self.free.append(ordinal)
+		self.all &= mask
+
+	def get(self, key: Hashable) -> int:
+		return self.bitmaps.get(key, 0)
+
+	def get_any(self, keys: Iterable[Hashable]) -> int:
+		ret = 0
+		for key in keys:
+			ret |= self.bitmaps.get(key, 0)
+		return ret
+
+	def from_ids(self, ids: Iterable[int]) -> int:
+		ret = 0
+		for id_ in ids:
+			ordinal = self.ordinals.get(id_)
+			if ordinal is not None:
+				ret |= 1 << ordinal
+		return ret
+
+	def get_items(self, bitmap: int) -> list:
+		# Scanning the binary string is much faster than testing each bit
+		items = self.items
+		return [items[i] for i, c in enumerate(reversed(bin(bitmap)[2:])) if c == "1"]
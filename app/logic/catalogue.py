@@ -0,0 +1,519 @@
+# ContentDB
+# Copyright (C) rubenwardy
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import datetime
+import random
+import threading
+from collections import Counter
+from typing import Optional, Dict, List, Set, Tuple, Iterable, Hashable
+
+from flask import abort, make_response
+from flask_babel import gettext
+from sqlalchemy import and_, func
+
+from app.models import db, Package, PackageState, PackageType, PackageDevState, User, PackageRelease, \
+	PackageScreenshot, PackageAlias, Tags, ContentWarnings, ContentWarning, License, PackageGameSupport, \
+	PackageTranslation, PackageReview, Collection, CollectionPackage, MinetestRelease, PackageLatestRelease, \
+	PackageProvides, MetaPackage, Tag
+from app.rediscache import get_catalogue_changes
+from .bitmaps import BitmapIndex
+from .search import SearchIndex
+
+
+# The catalogue is an in-memory snapshot of all approved packages, used to answer package
+# list queries without touching the database. Each process keeps its own copy, and brings it
+# up-to-date using the catalogue change log at the start of each query.
+
+# Changes to these don't require a reload
+IGNORED_ENTITIES = {"language"}
+
+
+class CatalogueEntry:
+	__slots__ = ("id", "author", "name", "title", "short_desc", "type", "dev_state", "repo",
+			"score", "score_downloads", "downloads", "created_at", "approved_at", "license_id",
+			"media_license_id", "is_foss", "thumbnail", "aliases", "provides", "tags", "content_warnings", "games",
+			"translations", "releases", "last_release_at", "has_reviews", "featured")
+
+	id: int
+	author: str
+	name: str
+	title: str
+	short_desc: str
+	type: PackageType
+	dev_state: Optional[PackageDevState]
+	repo: Optional[str]
+	score: float
+	score_downloads: float
+	downloads: int
+	created_at: datetime.datetime
+	approved_at: Optional[datetime.datetime]
+	license_id: int
+	media_license_id: int
+	is_foss: bool
+	thumbnail: Optional[str]
+	aliases: List[str]
+	provides: List[str]
+	tags: Set[int]
+	content_warnings: Set[int]
+	games: Set[int]
+
+	# Language to (title, short_desc)
+	translations: Dict[str, Tuple[Optional[str], Optional[str]]]
+
+	# MinetestRelease id to latest release id, None is used for the latest release for any version
+	releases: Dict[Optional[int], int]
+
+	last_release_at: Optional[datetime.datetime]
+	has_reviews: bool
+	featured: bool
+
+	def __init__(self, row):
+		for key in ["id", "author", "name", "title", "short_desc", "type", "dev_state", "repo", "score",
+				"score_downloads", "downloads", "created_at", "approved_at", "license_id", "media_license_id"]:
+			setattr(self, key, getattr(row, key))
+
+		self.is_foss = True
+		self.thumbnail = None
+		self.aliases = []
+		self.provides = []
+		self.tags = set()
+		self.content_warnings = set()
+		self.games = set()
+		self.translations = {}
+		self.releases = {}
+		self.last_release_at = None
+		self.has_reviews = False
+		self.featured = False
+
+	@property
+	def key(self) -> str:
+		return f"{self.author}/{self.name}"
+
+	def get_release(self, version: Optional[MinetestRelease]) -> Optional[int]:
+		return self.releases.get(version.id if version else None)
+
+	def as_key_dict(self):
+		return {
+			"name": self.name,
+			"author": self.author,
+			"type": self.type.to_name(),
+		}
+
+	def as_short_dict(self, base_url: str, version: Optional[MinetestRelease], lang: str = "en", include_vcs: bool = False):
+		title, short_desc = self.translations.get(lang, (None, None))
+		if self.dev_state == PackageDevState.WIP:
+			short_desc = gettext("Work in Progress") + ". " + self.short_desc
+
+		ret = {
+			"name": self.name,
+			"title": title or self.title,
+			"author": self.author,
+			"short_description": short_desc or self.short_desc,
+			"type": self.type.to_name(),
+			"release": self.get_release(version),
+			"thumbnail": (base_url + self.thumbnail) if self.thumbnail is not None else None,
+		}
+
+		if self.aliases:
+			ret["aliases"] = list(self.aliases)
+
+		if include_vcs:
+			ret["repo"] = self.repo
+
+		return ret
+
+
+def _load_entries(package_ids: Optional[Set[int]]) -> Dict[int, CatalogueEntry]:
+	def filter_ids(query, column):
+		if package_ids is None:
+			return query
+		return query.filter(column.in_(package_ids))
+
+	rows = filter_ids(db.session.query(Package.id, User.username.label("author"), Package.name, Package.title,
+				Package.short_desc, Package.type, Package.dev_state, Package.repo, Package.score,
+				Package.score_downloads, Package.downloads, Package.created_at, Package.approved_at,
+				Package.license_id, Package.media_license_id)
+			.select_from(Package).join(User, Package.author)
+			.filter(Package.state == PackageState.APPROVED), Package.id).all()
+
+	entries = {row.id: CatalogueEntry(row) for row in rows}
+	if len(entries) == 0:
+		return entries
+
+	foss_licenses = set([x[0] for x in db.session.query(License.id).filter(License.is_foss == True).all()])
+	for entry in entries.values():
+		entry.is_foss = entry.license_id in foss_licenses and entry.media_license_id in foss_licenses
+
+	screenshots = filter_ids(db.session.query(PackageScreenshot.package_id, PackageScreenshot.url)
+			.filter(PackageScreenshot.approved == True)
+			.order_by(db.desc(PackageScreenshot.order), db.desc(PackageScreenshot.id)), PackageScreenshot.package_id).all()
+	for package_id, url in screenshots:
+		entry = entries.get(package_id)
+		if entry:
+			# Iterating in reverse order means the first screenshot is the one that's left
+			entry.thumbnail = PackageScreenshot.make_thumb_url(url, 1, "png")
+
+	aliases = filter_ids(db.session.query(PackageAlias.package_id, PackageAlias.author, PackageAlias.name)
+			.order_by(db.asc(PackageAlias.id)), PackageAlias.package_id).all()
+	for package_id, author, name in aliases:
+		entry = entries.get(package_id)
+		if entry:
+			entry.aliases.append(f"{author}/{name}")
+
+	provides = filter_ids(db.session.query(PackageProvides.c.package_id, MetaPackage.name)
+			.select_from(PackageProvides).join(MetaPackage), PackageProvides.c.package_id).all()
+	for package_id, name in provides:
+		entry = entries.get(package_id)
+		if entry:
+			entry.provides.append(name)
+
+	for package_id, tag_id in filter_ids(db.session.query(Tags.c.package_id, Tags.c.tag_id), Tags.c.package_id).all():
+		entry = entries.get(package_id)
+		if entry:
+			entry.tags.add(tag_id)
+
+	for package_id, warning_id in filter_ids(db.session.query(ContentWarnings.c.package_id,
+			ContentWarnings.c.content_warning_id), ContentWarnings.c.package_id).all():
+		entry = entries.get(package_id)
+		if entry:
+			entry.content_warnings.add(warning_id)
+
+	games = filter_ids(db.session.query(PackageGameSupport.package_id, PackageGameSupport.game_id)
+			.filter(PackageGameSupport.supports == True), PackageGameSupport.package_id).all()
+	for package_id, game_id in games:
+		entry = entries.get(package_id)
+		if entry:
+			entry.games.add(game_id)
+
+	translations = filter_ids(db.session.query(PackageTranslation.package_id, PackageTranslation.language_id,
+			PackageTranslation.title, PackageTranslation.short_desc), PackageTranslation.package_id).all()
+	for package_id, language_id, title, short_desc in translations:
+		entry = entries.get(package_id)
+		if entry:
+			entry.translations[language_id] = (title, short_desc)
+
+	with_reviews = filter_ids(db.session.query(PackageReview.package_id).distinct(), PackageReview.package_id).all()
+	for package_id, in with_reviews:
+		entry = entries.get(package_id)
+		if entry:
+			entry.has_reviews = True
+
+	releases = filter_ids(db.session.query(PackageLatestRelease.package_id, PackageLatestRelease.minetest_release_id,
+			PackageLatestRelease.release_id), PackageLatestRelease.package_id).all()
+	for package_id, version_id, release_id in releases:
+		entry = entries.get(package_id)
+		if entry:
+			entry.releases[version_id] = release_id
+
+	last_releases = filter_ids(db.session.query(PackageRelease.package_id, func.max(PackageRelease.created_at))
+			.group_by(PackageRelease.package_id), PackageRelease.package_id).all()
+	for package_id, created_at in last_releases:
+		entry = entries.get(package_id)
+		if entry:
+			entry.last_release_at = created_at
+
+	return entries
+
+
+def _load_featured() -> Set[int]:
+	return set([x[0] for x in db.session.query(CollectionPackage.package_id)
+			.filter(CollectionPackage.collection.has(
+				and_(Collection.name == "featured", Collection.author.has(username="ContentDB"))))
+			.all()])
+
+
+def _get_search_fields(entry: CatalogueEntry, tag_names: Dict[int, Tuple[str, str]]) -> Dict[str, Iterable[str]]:
+	tags = []
+	for tag_id in entry.tags:
+		tags.extend(tag_names.get(tag_id, ()))
+
+	return {
+		"name": [entry.name],
+		"title": [entry.title],
+		"short_desc": [entry.short_desc],
+		"provides": entry.provides,
+		"tags": tags,
+		"translated_title": [title for title, _ in entry.translations.values()],
+	}
+
+
+def _get_bitmap_keys(entry: CatalogueEntry) -> Iterable[Hashable]:
+	keys = [("type", entry.type), ("author", entry.author), ("dev_state", entry.dev_state),
+			("license", entry.license_id), ("license", entry.media_license_id)]
+	if entry.is_foss:
+		keys.append(("foss",))
+	if len(entry.content_warnings) > 0:
+		keys.append(("any_content_warning",))
+
+	keys.extend(("tag", x) for x in entry.tags)
+	keys.extend(("content_warning", x) for x in entry.content_warnings)
+	keys.extend(("game", x) for x in entry.games)
+	keys.extend(("lang", x) for x in entry.translations.keys())
+	keys.extend(("release", x) for x in entry.releases.keys())
+	return keys
+
+
+class Catalogue:
+	revision: int
+	entries: Dict[int, CatalogueEntry]
+	content_warnings: Dict[str, int]
+
+	# Tag id to (name, title)
+	tag_names: Dict[int, Tuple[str, str]]
+
+	license_names: Dict[int, str]
+
+	bitmaps: BitmapIndex
+	search_index: SearchIndex
+	lock: threading.Lock
+
+	def __init__(self):
+		self.revision = -1
+		self.entries = {}
+		self.content_warnings = {}
+		self.tag_names = {}
+		self.license_names = {}
+		self.bitmaps = BitmapIndex()
+		self.search_index = SearchIndex()
+		self.lock = threading.Lock()
+
+	def sync(self):
+		with self.lock:
+			revision, changes = get_catalogue_changes(self.revision)
+			if changes is not None and len(changes) == 0:
+				return
+
+			content_warnings = self.content_warnings
+			tag_names = self.tag_names
+			license_names = self.license_names
+
+			entities = set([x for x in changes if not x.startswith("package/")]) if changes is not None else None
+			if entities is None or len(entities.difference(IGNORED_ENTITIES, {"collection"})) > 0:
+				content_warnings = {name: id_ for id_, name in db.session.query(ContentWarning.id, ContentWarning.name).all()}
+				tag_names = {id_: (name, title) for id_, name, title in db.session.query(Tag.id, Tag.name, Tag.title).all()}
+				license_names = {id_: name for id_, name in db.session.query(License.id, License.name).all()}
+				entries = _load_entries(None)
+				featured = _load_featured()
+
+				search_index = SearchIndex()
+				bitmaps = BitmapIndex()
+				changed = entries.values()
+			else:
+				package_ids = set([int(x[8:]) for x in changes if x.startswith("package/")])
+				entries = dict(self.entries)
+				bitmaps = self.bitmaps.copy()
+				search_index = self.search_index.copy()
+				for package_id in package_ids:
+					entries.pop(package_id, None)
+					bitmaps.remove(package_id)
+					search_index.remove(package_id)
+
+				changed = []
+				if len(package_ids) > 0:
+					changed = _load_entries(package_ids).values()
+					entries.update({entry.id: entry for entry in changed})
+
+				featured = _load_featured() if "collection" in entities or len(package_ids) > 0 else None
+
+			if featured is not None:
+				for entry in entries.values():
+					entry.featured = entry.id in featured
+
+			for entry in changed:
+				bitmaps.add(entry.id, entry, _get_bitmap_keys(entry))
+				search_index.add(entry.id, entry.score, _get_search_fields(entry, tag_names))
+
+			# Requests use the old entries and indexes until they are all replaced
+			self.content_warnings = content_warnings
+			self.tag_names = tag_names
+			self.license_names = license_names
+			self.entries = entries
+			self.bitmaps = bitmaps
+			self.search_index = search_index
+			self.revision = revision
+
+	def search(self, query: str) -> Dict[int, float]:
+		"""
+		Returns the approved packages that match `query`, and their rank. Higher is better.
+		"""
+		return self.search_index.search(query)
+
+	def _filter(self, qb) -> Tuple[List[CatalogueEntry], Optional[Dict[int, float]]]:
+		"""
+		Evaluates the query's filters as bitwise operations on the bitmap index
+		"""
+		assert qb.only_approved
+
+		index = self.bitmaps
+		bits = index.all
+
+		ranks = None
+		if qb.search:
+			ranks = self.search(qb.search)
+			bits &= index.from_ids(ranks.keys())
+
+		if len(qb.types) > 0:
+			bits &= index.get_any(("type", x) for x in qb.types)
+
+		if qb.author:
+			bits &= index.get(("author", qb.author))
+
+		if qb.game:
+			bits &= index.get(("game", qb.game.id))
+
+		if qb.has_lang and qb.has_lang != "en":
+			bits &= index.get(("lang", qb.has_lang))
+
+		for tag in qb.tags:
+			bits &= index.get(("tag", tag.id))
+
+		for tag in qb.hide_tags:
+			bits &= ~index.get(("tag", tag.id))
+
+		if "*" in qb.hide_flags:
+			bits &= ~index.get(("any_content_warning",))
+		else:
+			for flag in qb.hide_flags:
+				warning_id = self.content_warnings.get(flag)
+				if warning_id is None:
+					if qb.emit_http_errors:
+						abort(make_response("Unknown tag or content warning " + flag), 400)
+				else:
+					bits &= ~index.get(("content_warning", warning_id))
+
+		flags = set(qb.flags)
+		if "nonfree" in flags:
+			bits &= ~index.get(("foss",))
+		if "wip" in flags:
+			bits &= index.get(("dev_state", PackageDevState.WIP))
+		if "deprecated" in flags:
+			bits &= index.get(("dev_state", PackageDevState.DEPRECATED))
+		flags.difference_update(["nonfree", "wip", "deprecated"])
+
+		if "*" in flags:
+			bits &= index.get(("any_content_warning",))
+		else:
+			for flag in flags:
+				warning_id = self.content_warnings.get(flag)
+				if warning_id is not None:
+					bits &= index.get(("content_warning", warning_id))
+
+		licenses = [license.id for license in qb.licenses if license is not None]
+		if len(licenses) > 0:
+			bits &= index.get_any(("license", x) for x in licenses)
+
+		if qb.hide_nonfree:
+			bits &= index.get(("foss",))
+		if qb.hide_wip:
+			bits &= ~index.get(("dev_state", PackageDevState.WIP))
+		if qb.hide_deprecated:
+			bits &= ~index.get(("dev_state", PackageDevState.DEPRECATED))
+
+		if qb.version:
+			bits &= index.get(("release", qb.version.id))
+
+		return index.get_items(bits), ranks
+
+	def query(self, qb) -> List[CatalogueEntry]:
+		"""
+		Equivalent to `QueryBuilder.build_package_query()`
+		"""
+		entries, ranks = self._filter(qb)
+		if qb.author and len(entries) == 0 and User.query.filter_by(username=qb.author).count() == 0:
+			abort(404)
+
+		if ranks is not None and qb.order_by is None and not qb.random:
+			entries.sort(key=lambda x: ranks[x.id], reverse=True)
+		else:
+			entries = self._order(qb, entries)
+
+		if qb.limit:
+			entries = entries[:qb.limit]
+
+		return entries
+
+	def get_facets(self, qb) -> dict:
+		"""
+		Counts the packages matching `qb` by type, tag, content warning, license, and supported
+		game, in a single pass over the matching packages. `limit` and the order are ignored.
+		"""
+		entries, _ = self._filter(qb)
+
+		types = Counter()
+		tags = Counter()
+		content_warnings = Counter()
+		licenses = Counter()
+		games = Counter()
+		for entry in entries:
+			types[entry.type] += 1
+			tags.update(entry.tags)
+			content_warnings.update(entry.content_warnings)
+			licenses.update({entry.license_id, entry.media_license_id})
+			games.update(entry.games)
+
+		warning_names = {id_: name for name, id_ in self.content_warnings.items()}
+		all_entries = self.entries
+
+		return {
+			"total": len(entries),
+			"types": {package_type.to_name(): count for package_type, count in types.items()},
+			"tags": {self.tag_names[id_][0]: count for id_, count in tags.items() if id_ in self.tag_names},
+			"content_warnings": {warning_names[id_]: count for id_, count in content_warnings.items() if id_ in warning_names},
+			"licenses": {self.license_names[id_]: count for id_, count in licenses.items() if id_ in self.license_names},
+			"games": {all_entries[id_].key: count for id_, count in games.items() if id_ in all_entries},
+		}
+
+	@staticmethod
+	def _order(qb, entries: List[CatalogueEntry]) -> List[CatalogueEntry]:
+		if qb.random:
+			random.shuffle(entries)
+			return entries
+
+		if qb.order_by is None or qb.order_by == "score":
+			key = lambda x: x.score
+		elif qb.order_by == "reviews":
+			entries = [x for x in entries if x.has_reviews]
+			key = lambda x: x.score - x.score_downloads
+		elif qb.order_by == "name":
+			key = lambda x: x.name
+		elif qb.order_by == "title":
+			key = lambda x: x.title.lower()
+		elif qb.order_by == "downloads":
+			key = lambda x: x.downloads
+		elif qb.order_by == "created_at" or qb.order_by == "date":
+			key = lambda x: x.created_at
+		elif qb.order_by == "approved_at":
+			# Nulls are last when ascending and first when descending, like in Postgres
+			key = lambda x: (x.approved_at is None, x.approved_at or datetime.datetime.min)
+		elif qb.order_by == "last_release":
+			entries = [x for x in entries if x.last_release_at is not None]
+			key = lambda x: x.last_release_at
+		else:
+			abort(400)
+
+		if qb.order_dir != "asc" and qb.order_dir != "desc":
+			abort(400)
+
+		entries.sort(key=key, reverse=qb.order_dir == "desc")
+		return entries
+
+
+_catalogue = Catalogue()
+
+
+def get_catalogue() -> Catalogue:
+	_catalogue.sync()
+	return _catalogue
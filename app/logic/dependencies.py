@@ -0,0 +1,341 @@
+# ContentDB
+# Copyright (C) rubenwardy
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import bisect
+import hashlib
+import json
+import os
+import tempfile
+import threading
+from collections import deque
+from typing import Optional, Dict, List, Set, Tuple
+
+from app import app
+from app.models import db, Package, PackageState, PackageType, User, Dependency, MetaPackage, PackageProvides
+from app.rediscache import get_catalogue_changes, get_lock
+
+
+# The dependency graph is an in-memory copy of the dependencies and provided modnames of all
+# packages, used to resolve dependencies without querying each package. Like the catalogue,
+# each process keeps its own copy and brings it up-to-date using the catalogue change log.
+# Release checks change dependencies and provides, so are picked up by the next sync.
+
+# Changes to these need a full reload, as they change package keys
+RELOAD_ENTITIES = {"user"}
+
+
+class DependencyNode:
+	__slots__ = ("id", "author", "name", "type", "approved", "dependencies", "provides")
+
+	id: int
+	author: str
+	name: str
+	type: PackageType
+	approved: bool
+
+	# (is_optional, package id, meta package id), only one of the ids is set
+	dependencies: List[Tuple[bool, Optional[int], Optional[int]]]
+
+	# Meta package ids
+	provides: List[int]
+
+	def __init__(self, row):
+		self.id = row.id
+		self.author = row.author
+		self.name = row.name
+		self.type = row.type
+		self.approved = row.state == PackageState.APPROVED
+		self.dependencies = []
+		self.provides = []
+
+	@property
+	def key(self) -> str:
+		return f"{self.author}/{self.name}"
+
+
+def _load_nodes(package_ids: Optional[Set[int]]) -> Tuple[Dict[int, DependencyNode], Set[int]]:
+	"""
+	Returns the nodes of the given packages, or all packages if package_ids is None, and the
+	ids of the meta packages they use
+	"""
+	def filter_ids(query, column):
+		if package_ids is None:
+			return query
+		return query.filter(column.in_(package_ids))
+
+	rows = filter_ids(db.session.query(Package.id, User.username.label("author"), Package.name, Package.type,
+				Package.state)
+			.select_from(Package).join(User, Package.author), Package.id).all()
+	nodes = {row.id: DependencyNode(row) for row in rows}
+	meta_ids = set()
+
+	dependencies = filter_ids(db.session.query(Dependency.depender_id, Dependency.optional, Dependency.package_id,
+				Dependency.meta_package_id)
+			.order_by(db.asc(Dependency.id)), Dependency.depender_id).all()
+	for depender_id, optional, package_id, meta_id in dependencies:
+		node = nodes.get(depender_id)
+		if node and (package_id is None) != (meta_id is None):
+			node.dependencies.append((optional, package_id, meta_id))
+			if meta_id is not None:
+				meta_ids.add(meta_id)
+
+	provides = filter_ids(db.session.query(PackageProvides.c.package_id, PackageProvides.c.metapackage_id),
+			PackageProvides.c.package_id).all()
+	for package_id, meta_id in provides:
+		node = nodes.get(package_id)
+		if node:
+			node.provides.append(meta_id)
+			meta_ids.add(meta_id)
+
+	return nodes, meta_ids
+
+
+class DependencyGraph:
+	revision: int
+	nodes: Dict[int, DependencyNode]
+
+	# Meta package id to name
+	meta_names: Dict[int, str]
+
+	# Meta package id to the ids of the packages that provide it, sorted by id
+	providers: Dict[int, List[int]]
+
+	lock: threading.Lock
+
+	def __init__(self):
+		self.revision = -1
+		self.nodes = {}
+		self.meta_names = {}
+		self.providers = {}
+		self.lock = threading.Lock()
+
+	def _add_node(self, node: DependencyNode):
+		self.nodes[node.id] = node
+		for meta_id in node.provides:
+			bisect.insort(self.providers.setdefault(meta_id, []), node.id)
+
+	def _remove_node(self, package_id: int):
+		node = self.nodes.pop(package_id, None)
+		if node:
+			for meta_id in node.provides:
+				self.providers[meta_id].remove(package_id)
+
+	def _load_meta_names(self, meta_ids: Set[int]):
+		to_load = meta_ids.difference(self.meta_names.keys())
+		if len(to_load) > 0:
+			self.meta_names.update(db.session.query(MetaPackage.id, MetaPackage.name)
+					.filter(MetaPackage.id.in_(to_load)).all())
+
+	def sync(self):
+		with self.lock:
+			revision, changes = get_catalogue_changes(self.revision)
+			if changes is not None and len(changes) == 0:
+				return
+
+			if changes is None or len(RELOAD_ENTITIES.intersection(changes)) > 0:
+				nodes, meta_ids = _load_nodes(None)
+				self.nodes = {}
+				self.providers = {}
+				self.meta_names = {}
+			else:
+				package_ids = set([int(x[8:]) for x in changes if x.startswith("package/")])
+				for package_id in package_ids:
+					self._remove_node(package_id)
+
+				nodes, meta_ids = _load_nodes(package_ids) if len(package_ids) > 0 else ({}, set())
+
+			for node in nodes.values():
+				self._add_node(node)
+
+			self._load_meta_names(meta_ids)
+			self.revision = revision
+
+	def get_approved_providers(self, meta_id: int) -> List[DependencyNode]:
+		nodes = (self.nodes.get(package_id) for package_id in self.providers.get(meta_id, []))
+		return [node for node in nodes if node and node.approved]
+
+	def resolve(self, package_id: int, only_hard: bool, max_depth: Optional[int] = 1) -> Dict[str, List[dict]]:
+		"""
+		Returns the dependencies of a package and the packages it depends on, by package key.
+
+		Dependencies on packages are always followed. Dependencies on modnames are followed
+		using the first approved mod that provides them, up to `max_depth` modnames deep, or
+		with no limit if `max_depth` is None.
+		"""
+		out = {}
+
+		# Packages are visited at the fewest modname dependencies from the root. Following a
+		# package dependency doesn't increase the depth, so those are visited first
+		queue = deque([(package_id, 0)])
+		while queue:
+			node_id, depth = queue.popleft()
+			node = self.nodes.get(node_id)
+			if node is None or node.key in out:
+				continue
+
+			ret = []
+			out[node.key] = ret
+			if node.type != PackageType.MOD:
+				continue
+
+			for optional, dep_package_id, meta_id in node.dependencies:
+				if only_hard and optional:
+					continue
+
+				if dep_package_id is not None:
+					dep_node = self.nodes.get(dep_package_id)
+					if dep_node is None:
+						continue
+
+					ret.append({
+						"name": dep_node.name,
+						"is_optional": optional,
+						"packages": [dep_node.key],
+					})
+					queue.appendleft((dep_package_id, depth))
+				else:
+					providers = self.get_approved_providers(meta_id)
+					ret.append({
+						"name": self.meta_names[meta_id],
+						"is_optional": optional,
+						"packages": [provider.key for provider in providers],
+					})
+
+					if not optional and (max_depth is None or depth < max_depth):
+						most_likely = next((provider for provider in providers if provider.type == PackageType.MOD), None)
+						if most_likely:
+							queue.append((most_likely.id, depth + 1))
+
+		return out
+
+	def get_raw_dependencies(self, node: DependencyNode) -> Tuple[List[str], List[str]]:
+		"""
+		Returns the hard and optional dependencies of a package, as modnames or package keys
+		"""
+		depends = []
+		optional_depends = []
+		for optional, dep_package_id, meta_id in node.dependencies:
+			if dep_package_id is not None:
+				dep_node = self.nodes.get(dep_package_id)
+				if dep_node is None:
+					continue
+				name = dep_node.key
+			else:
+				name = self.meta_names[meta_id]
+
+			(optional_depends if optional else depends).append(name)
+
+		return depends, optional_depends
+
+	def export(self) -> List[dict]:
+		"""
+		Returns the provides and raw dependencies of all approved packages, sorted by package key
+		"""
+		ret = []
+		for node in sorted((node for node in self.nodes.values() if node.approved), key=lambda x: (x.author, x.name)):
+			depends, optional_depends = self.get_raw_dependencies(node)
+			ret.append({
+				"type": node.type.to_name(),
+				"author": node.author,
+				"name": node.name,
+				"provides": sorted(self.meta_names[meta_id] for meta_id in node.provides),
+				"depends": depends,
+				"optional_depends": optional_depends,
+			})
+
+		return ret
+
+
+_graph = DependencyGraph()
+
+
+def get_dependency_graph() -> DependencyGraph:
+	_graph.sync()
+	return _graph
+
+
+# The export is a JSON file of the provides and raw dependencies of all packages, so that
+# tools can get the whole graph in one request. Each export is named after the hash of its
+# contents, and `latest` contains the hash of the current export.
+
+def _get_export_dir() -> str:
+	return os.path.join(app.config["UPLOAD_DIR"], "dependencies")
+
+
+def _write_atomic(export_dir: str, filename: str, data: bytes):
+	fd, temp_path = tempfile.mkstemp(dir=export_dir, suffix=".tmp")
+	try:
+		with os.fdopen(fd, "wb") as f:
+			f.write(data)
+		os.chmod(temp_path, 0o644)
+		os.replace(temp_path, os.path.join(export_dir, filename))
+	except Exception:
+		os.remove(temp_path)
+		raise
+
+
+def get_dependency_export() -> Optional[Tuple[str, str]]:
+	"""
+	Returns the path and content hash of the current export, or None if there isn't one
+	"""
+	export_dir = _get_export_dir()
+	try:
+		with open(os.path.join(export_dir, "latest"), "r") as f:
+			content_hash = f.read().strip()
+	except FileNotFoundError:
+		return None
+
+	return os.path.join(export_dir, f"{content_hash}.json"), content_hash
+
+
+def write_dependency_export() -> Optional[str]:
+	"""
+	Writes the export if it has changed, and returns its content hash. Returns None if another
+	process was writing the export for too long.
+	"""
+	lock = get_lock("dependency_export", timeout=5*60)
+	if not lock.acquire(blocking_timeout=60):
+		return None
+
+	try:
+		# The graph is synced after taking the lock, so that the last writer has the latest changes
+		data = json.dumps(get_dependency_graph().export(), separators=(",", ":")).encode("utf-8")
+		content_hash = hashlib.sha256(data).hexdigest()
+
+		current = get_dependency_export()
+		if current and current[1] == content_hash and os.path.isfile(current[0]):
+			return content_hash
+
+		export_dir = _get_export_dir()
+		os.makedirs(export_dir, exist_ok=True)
+		_write_atomic(export_dir, f"{content_hash}.json", data)
+		_write_atomic(export_dir, "latest", content_hash.encode("utf-8"))
+
+		# The previous export is kept for requests that have already looked up the hash
+		keep = {f"{content_hash}.json", "latest"}
+		if current:
+			keep.add(f"{current[1]}.json")
+
+		for filename in os.listdir(export_dir):
+			if filename not in keep and not filename.endswith(".tmp"):
+				try:
+					os.remove(os.path.join(export_dir, filename))
+				except FileNotFoundError:
+					pass
+
+		return content_hash
+	finally:
+		lock.release()
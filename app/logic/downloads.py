@@ -0,0 +1,281 @@
+# ContentDB
+# Copyright (C) rubenwardy
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import datetime
+import json
+import threading
+import time
+import uuid
+from collections import defaultdict
+from typing import Dict, List, Optional, Tuple, Iterator, Callable
+
+from sqlalchemy import update, values, column, Integer, Float
+
+from app.logic.LogicError import LogicError
+from app.logic.metrics import download_events
+from app.models import db, Package, PackageRelease, PackageDailyStats, User
+from app.rediscache import push_download_event, claim_download_events, complete_download_events, \
+	requeue_download_events, get_downloads_channel, publish_messages, subscribe, acquire_live_stream, release_live_stream, \
+	add_downloads_changed, pop_downloads_changed, push_catalogue_changes, get_lock, DOWNLOAD_PROCESSING_KEY_PREFIX
+
+
+# Downloads are counted write-behind: the download endpoint only appends an event to Redis, and
+# a periodic task aggregates the events and applies them using a few bulk statements. This
+# avoids lock contention on popular packages.
+#
+# The packages with new downloads are only pushed to the catalogue change log every few
+# minutes by `publish_download_changes`, as each change invalidates cached responses.
+
+FLUSH_BATCH_SIZE = 10000
+
+# Flushes are started every few seconds, and skip if the previous one is still running. The lock
+# expires after this long, in case the process holding it was killed.
+FLUSH_LOCK_TIMEOUT_S = 10*60
+
+# Live download streams send a comment this often, so that proxies don't close the connection
+LIVE_HEARTBEAT_S = 15
+
+# Live download streams are closed after this long, clients reconnect automatically
+LIVE_MAX_DURATION_S = 10*60
+
+# Each live download stream holds a worker thread for as long as it is open, so the number of
+# streams is limited to leave threads for other requests. See "Live download streams" in
+# docs/getting_started.md, the app must be run with more threads than this.
+LIVE_MAX_STREAMS_PER_PROCESS = 4
+LIVE_MAX_STREAMS_PER_IP = 2
+
+_live_streams_lock = threading.Lock()
+_live_streams = 0
+
+_REASONS = {
+	"new": "n",
+	"dependency": "d",
+	"update": "u",
+}
+
+_REASON_FIELDS = {
+	"n": "reason_new",
+	"d": "reason_dependency",
+	"u": "reason_update",
+}
+
+_SCORE_BONUSES = {
+	"n": 1,
+	"d": 0.5,
+	"u": 0.5,
+}
+
+
+def record_download(download_key: str, package_id: int, release_id: int, is_minetest: bool, reason: Optional[str]):
+	"""
+	`download_key` identifies the downloader, see `make_download_key`. Only the first download
+	by the same downloader counts towards the download count and score.
+	"""
+	date = datetime.datetime.utcnow().date()
+	event = f"{package_id},{release_id},{date.isoformat()},{int(is_minetest)},{_REASONS.get(reason, '-')}"
+	push_download_event(download_key, event)
+
+
+class DownloadCounts:
+	# (package_id, date) to field to count
+	daily: Dict[Tuple[int, datetime.date], Dict[str, int]]
+
+	# release_id to unique downloads
+	releases: Dict[int, int]
+
+	# package_id to [unique downloads, score bonus]
+	packages: Dict[int, List[float]]
+
+	def __init__(self):
+		self.daily = defaultdict(lambda: defaultdict(int))
+		self.releases = defaultdict(int)
+		self.packages = defaultdict(lambda: [0, 0.0])
+
+	def add(self, event: str):
+		package_id, release_id, date, is_minetest, reason, is_unique = event.split(",")
+		package_id = int(package_id)
+
+		daily = self.daily[(package_id, datetime.date.fromisoformat(date))]
+		daily["platform_minetest" if is_minetest == "1" else "platform_other"] += 1
+		if reason in _REASON_FIELDS:
+			daily[_REASON_FIELDS[reason]] += 1
+
+		if is_unique == "1":
+			self.releases[int(release_id)] += 1
+
+			package = self.packages[package_id]
+			package[0] += 1
+			package[1] += _SCORE_BONUSES.get(reason, 0)
+
+	def apply(self, conn):
+		PackageDailyStats.add_counts(conn, [dict(counts, package_id=package_id, date=date)
+				for (package_id, date), counts in self.daily.items()])
+
+		if len(self.releases) > 0:
+			v = values(column("id", Integer), column("downloads", Integer), name="v") \
+				.data(sorted(self.releases.items()))
+			conn.execute(update(PackageRelease)
+					.where(PackageRelease.id == v.c.id)
+					.values(downloads=PackageRelease.downloads + v.c.downloads))
+
+		if len(self.packages) > 0:
+			v = values(column("id", Integer), column("downloads", Integer), column("bonus", Float), name="v") \
+				.data([(package_id, downloads, bonus) for package_id, (downloads, bonus) in sorted(self.packages.items())])
+			conn.execute(update(Package)
+					.where(Package.id == v.c.id)
+					.values(downloads=Package.downloads + v.c.downloads,
+						score_downloads=Package.score_downloads + v.c.bonus,
+						score=Package.score + v.c.bonus))
+
+	def get_messages(self) -> List[Tuple[str, str]]:
+		"""
+		Returns (channel, message) pairs to publish to live download streams. Each message is a
+		JSON list of the new counts per package and date.
+		"""
+		if len(self.daily) == 0:
+			return []
+
+		package_ids = set(package_id for package_id, _ in self.daily.keys())
+		packages = {row[0]: row for row in db.session.query(Package.id, Package.author_id, User.username, Package.name)
+				.join(Package.author).filter(Package.id.in_(package_ids)).all()}
+
+		channels = defaultdict(list)
+		for (package_id, date), counts in sorted(self.daily.items()):
+			package = packages.get(package_id)
+			if package is None:
+				continue
+
+			_, author_id, username, name = package
+			item = {
+				"package": {
+					"author": username,
+					"name": name,
+				},
+				"date": date.isoformat(),
+				"downloads": counts["platform_minetest"] + counts["platform_other"],
+			}
+			for field in PackageDailyStats.COUNT_FIELDS:
+				item[field] = counts[field]
+
+			channels[get_downloads_channel("package", package_id)].append(item)
+			channels[get_downloads_channel("author", author_id)].append(item)
+
+		return [(channel, json.dumps(items)) for channel, items in channels.items()]
+
+
+def flush_download_events() -> int:
+	"""
+	Applies recorded downloads to the database, returns the number of events. Returns 0 without
+	doing anything if another flush is running.
+	"""
+	lock = get_lock("flush_downloads", timeout=FLUSH_LOCK_TIMEOUT_S)
+	if not lock.acquire(blocking=False):
+		return 0
+
+	try:
+		# No other flush is running, so any processing lists are from a flush that crashed
+		requeue_download_events()
+
+		total = 0
+		while True:
+			processing_key = DOWNLOAD_PROCESSING_KEY_PREFIX + uuid.uuid4().hex
+			events = claim_download_events(processing_key, FLUSH_BATCH_SIZE)
+			if len(events) == 0:
+				return total
+
+			counts = DownloadCounts()
+			for event in events:
+				counts.add(event)
+
+			try:
+				counts.apply(db.session.connection())
+				db.session.commit()
+			except Exception:
+				db.session.rollback()
+				requeue_download_events(processing_key)
+				raise
+
+			complete_download_events(processing_key)
+			add_downloads_changed(counts.packages.keys())
+			download_events.inc(len(events))
+
+			# Each flush is the aggregation window for live downloads
+			publish_messages(counts.get_messages())
+
+			total += len(events)
+			if len(events) < FLUSH_BATCH_SIZE:
+				return total
+	finally:
+		lock.release()
+
+
+def publish_download_changes() -> int:
+	"""
+	Pushes the packages whose downloads and scores have been changed by flushes to the catalogue
+	change log, returns the number of packages
+	"""
+	package_ids = pop_downloads_changed()
+	if len(package_ids) > 0:
+		push_catalogue_changes([f"package/{package_id}" for package_id in package_ids])
+
+	return len(package_ids)
+
+
+def open_live_stream(ip: str) -> Callable[[], None]:
+	"""
+	Reserves a live download stream for a client, raises LogicError if there are too many open streams.
+	Returns a function to call when the stream is closed.
+	"""
+	global _live_streams
+
+	with _live_streams_lock:
+		if _live_streams >= LIVE_MAX_STREAMS_PER_PROCESS:
+			raise LogicError(503, "Too many live streams are open, try again later")
+		_live_streams += 1
+
+	try:
+		if not acquire_live_stream(ip, LIVE_MAX_STREAMS_PER_IP, LIVE_MAX_DURATION_S + 60):
+			raise LogicError(429, f"You can only have {LIVE_MAX_STREAMS_PER_IP} live streams open at a time")
+	except Exception:
+		with _live_streams_lock:
+			_live_streams -= 1
+		raise
+
+	def close():
+		global _live_streams
+		with _live_streams_lock:
+			_live_streams -= 1
+		release_live_stream(ip)
+
+	return close
+
+
+def iter_live_downloads(channel: str) -> Iterator[Optional[str]]:
+	"""
+	Yields messages published to a downloads channel, see `get_downloads_channel`. Yields None
+	when there haven't been any downloads for LIVE_HEARTBEAT_S, and stops after LIVE_MAX_DURATION_S.
+	"""
+	pubsub = subscribe(channel)
+	try:
+		end = time.monotonic() + LIVE_MAX_DURATION_S
+		while time.monotonic() < end:
+			message = pubsub.get_message(timeout=min(LIVE_HEARTBEAT_S, max(0.0, end - time.monotonic())))
+			if message is None:
+				yield None
+			elif message["type"] == "message":
+				yield message["data"].decode("utf-8")
+	finally:
+		pubsub.close()
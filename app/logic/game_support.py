@@ -14,11 +14,16 @@
 # You should have received a copy of the GNU Affero General Public License
 # along with this program.  If not, see <https://www.gnu.org/licenses/>.
 
-from typing import List, Dict, Optional, Tuple
+import threading
+from collections import defaultdict
+from typing import List, Dict, Optional, Tuple, Set
 
 import sqlalchemy
+from sqlalchemy.orm import aliased
 
-from app.models import PackageType, Package, PackageState, PackageGameSupport
+from app.models import db, PackageType, Package, PackageState, PackageGameSupport, User, MetaPackage, Dependency, \
+	PackageProvides
+from app.rediscache import get_catalogue_changes
 from app.utils import post_bot_message
 
 
@@ -92,14 +97,33 @@ class GSPackage:
 	def add_error(self, error: str):
 		return self.errors.add(error)
 
+	def copy(self) -> "GSPackage":
+		"""
+		Returns a copy with the same inputs, but without any detected game support or errors
+		"""
+		ret = GSPackage(self.author, self.name, self.type, set(self.provides))
+		ret.depends = set(self.depends)
+		ret.user_supported_games = self.user_supported_games
+		ret.user_unsupported_games = self.user_unsupported_games
+		ret.supports_all_games = self.supports_all_games
+		ret.detection_disabled = self.detection_disabled
+		return ret
+
 
 class GameSupport:
 	packages: Dict[str, GSPackage]
 	modified_packages: set[GSPackage]
 
+	# Modname to the packages that provide or depend on it. These are built when needed, and
+	# cleared when packages are added or updated, as their provides and depends may have changed
+	_providers: Optional[Dict[str, List[GSPackage]]]
+	_dependers: Optional[Dict[str, List[GSPackage]]]
+
 	def __init__(self):
 		self.packages = {}
 		self.modified_packages = set()
+		self._providers = None
+		self._dependers = None
 
 	@property
 	def all_confirmed(self):
@@ -123,16 +147,34 @@ class GameSupport:
 
 	def add(self, package: GSPackage) -> GSPackage:
 		self.packages[package.id_] = package
+		self._clear_indexes()
 		return package
 
 	def get(self, id_: str) -> Optional[GSPackage]:
 		return self.packages.get(id_)
 
+	def _clear_indexes(self):
+		self._providers = None
+		self._dependers = None
+
+	def _build_indexes(self):
+		self._providers = defaultdict(list)
+		self._dependers = defaultdict(list)
+		for package in self.packages.values():
+			for modname in package.provides:
+				self._providers[modname].append(package)
+			for modname in package.depends:
+				self._dependers[modname].append(package)
+
 	def get_all_that_provide(self, modname: str) -> List[GSPackage]:
-		return [package for package in self.packages.values() if modname in package.provides]
+		if self._providers is None:
+			self._build_indexes()
+		return self._providers.get(modname, [])
 
 	def get_all_that_depend_on(self, modname: str) -> List[GSPackage]:
-		return [package for package in self.packages.values() if modname in package.depends]
+		if self._dependers is None:
+			self._build_indexes()
+		return self._dependers.get(modname, [])
 
 	def _get_supported_games_for_modname(self, depend: str, visited: list[str]):
 		dep_supports_all = False
@@ -216,6 +258,10 @@ class GameSupport:
 		return package.supported_games
 
 	def on_update(self, package: GSPackage, old_provides: Optional[set[str]] = None):
+		self._clear_indexes()
+		self._update(package, old_provides)
+
+	def _update(self, package: GSPackage, old_provides: Optional[set[str]] = None):
 		to_update = {package}
 		checked = set()
 
@@ -243,41 +289,132 @@ class GameSupport:
 		self.on_update(package)
 
 	def on_first_run(self):
+		self._clear_indexes()
 		for package in self.packages.values():
 			if not package.is_confirmed:
-				self.on_update(package)
-
+				self._update(package)
+
+
+def _load_packages(conn, package_ids: Optional[Set[int]] = None, approved_only: bool = True) -> Dict[int, GSPackage]:
+	"""
+	Loads mods and games by id using a fixed number of queries. `package_ids` limits the packages
+	loaded, and `approved_only` should only be False when it's given.
+	"""
+	if package_ids is not None and len(package_ids) == 0:
+		return {}
+
+	query = db.select(Package.id, User.username, Package.name, Package.type, Package.state,
+				Package.enable_game_support_detection, Package.supports_all_games) \
+		.select_from(Package).join(User, Package.author)
+	if approved_only:
+		query = query.where(Package.state == PackageState.APPROVED,
+				Package.type.in_([PackageType.GAME, PackageType.MOD]))
+	if package_ids is not None:
+		query = query.where(Package.id.in_(package_ids))
+
+	rows = conn.execute(query).all()
+	if len(rows) == 0:
+		return {}
+
+	ids = [row[0] for row in rows]
+	provides = defaultdict(set)
+	for package_id, name in conn.execute(db.select(PackageProvides.c.package_id, MetaPackage.name)
+			.select_from(PackageProvides).join(MetaPackage)
+			.where(PackageProvides.c.package_id.in_(ids))).all():
+		provides[package_id].add(name)
+
+	depends = defaultdict(set)
+	for package_id, name in conn.execute(db.select(Dependency.depender_id, MetaPackage.name)
+			.select_from(Dependency).join(MetaPackage, Dependency.meta_package)
+			.where(Dependency.depender_id.in_(ids), Dependency.optional == False)).all():
+		depends[package_id].add(name)
+
+	game = aliased(Package)
+	user_support = defaultdict(list)
+	for package_id, game_name, supports in conn.execute(db.select(PackageGameSupport.package_id, game.name,
+				PackageGameSupport.supports)
+			.select_from(PackageGameSupport).join(game, PackageGameSupport.game_id == game.id)
+			.where(PackageGameSupport.package_id.in_(ids), game.state == PackageState.APPROVED,
+					PackageGameSupport.confidence > 5)).all():
+		user_support[package_id].append((game_name, supports))
+
+	ret = {}
+	for package_id, author, name, type_, state, enable_detection, supports_all_games in rows:
+		# Unapproved packages shouldn't be considered to fulfill anything
+		gs_package = GSPackage(author, name, type_,
+				provides[package_id] if state == PackageState.APPROVED else set())
+		gs_package.depends = depends[package_id]
+		gs_package.detection_disabled = not enable_detection
+		gs_package.supports_all_games = supports_all_games
+		if not supports_all_games:
+			gs_package.user_supported_games = [x[0] for x in user_support[package_id] if x[1]]
+		gs_package.user_unsupported_games = [x[0] for x in user_support[package_id] if not x[1]]
+		ret[package_id] = gs_package
+
+	return ret
+
+
+class _PackageCache:
+	"""
+	The approved mods and games, loaded once per process and kept up-to-date using the
+	catalogue change log. Only changed packages are reloaded, unless a game or username has
+	changed as other packages refer to them by name.
+
+	The cache is loaded using its own connection, so that it only contains committed changes.
+	"""
+
+	revision: int
+	packages: Dict[int, GSPackage]
+	lock: threading.Lock
 
-def _convert_package(support: GameSupport, package: Package) -> GSPackage:
-	# Unapproved packages shouldn't be considered to fulfill anything
-	provides = set()
-	if package.state == PackageState.APPROVED:
-		provides = set([x.name for x in package.provides])
-
-	gs_package = GSPackage(package.author.username, package.name, package.type, provides)
-	gs_package.depends = set([x.meta_package.name for x in package.dependencies if not x.optional])
-	gs_package.detection_disabled = not package.enable_game_support_detection
-	gs_package.supports_all_games = package.supports_all_games
-
-	existing_game_support = (package.supported_games
-			.filter(PackageGameSupport.game.has(state=PackageState.APPROVED),
-					PackageGameSupport.confidence > 5)
-			.all())
-	if not package.supports_all_games:
-		gs_package.user_supported_games = [x.game.name for x in existing_game_support if x.supports]
-	gs_package.user_unsupported_games = [x.game.name for x in existing_game_support if not x.supports]
-	return support.add(gs_package)
+	def __init__(self):
+		self.revision = -1
+		self.packages = {}
+		self.lock = threading.Lock()
+
+	def sync(self):
+		with self.lock:
+			revision, changes = get_catalogue_changes(self.revision)
+			if changes is not None and len(changes) == 0:
+				return
+
+			with db.engine.connect() as conn:
+				full_reload = changes is None or "user" in changes
+				if not full_reload:
+					package_ids = set([int(x[8:]) for x in changes if x.startswith("package/")])
+					loaded = _load_packages(conn, package_ids)
+					changed = [self.packages.get(x) for x in package_ids] + list(loaded.values())
+					full_reload = any(package and package.type == PackageType.GAME for package in changed)
+
+				if full_reload:
+					self.packages = _load_packages(conn)
+				else:
+					for package_id in package_ids:
+						self.packages.pop(package_id, None)
+					self.packages.update(loaded)
+
+			self.revision = revision
+
+	def create_instance(self) -> GameSupport:
+		self.sync()
+		support = GameSupport()
+		for package in self.packages.values():
+			support.add(package.copy())
+		return support
 
 
-def _create_instance(session: sqlalchemy.orm.Session) -> GameSupport:
-	support = GameSupport()
+_cache = _PackageCache()
 
-	packages: List[Package] = (session.query(Package)
-			.filter(Package.state == PackageState.APPROVED, Package.type.in_([PackageType.GAME, PackageType.MOD]))
-			.all())
 
-	for package in packages:
-		_convert_package(support, package)
+def _create_instance(session: sqlalchemy.orm.Session, package: Optional[Package] = None) -> GameSupport:
+	"""
+	Creates a game support instance from the cache. `package` is loaded using the session, so
+	that it includes changes that haven't been committed yet.
+	"""
+	support = _cache.create_instance()
+	if package is not None:
+		for gs_package in _load_packages(session, {package.id}, False).values():
+			support.add(gs_package)
 
 	return support
 
@@ -319,10 +456,8 @@ def _persist(session: sqlalchemy.orm.Session, support: GameSupport):
 
 
 def game_support_update(session: sqlalchemy.orm.Session, package: Package, old_provides: Optional[set[str]]) -> set[str]:
-	support = _create_instance(session)
+	support = _create_instance(session, package)
 	gs_package = support.get(package.get_id())
-	if gs_package is None:
-		gs_package = _convert_package(support, package)
 	support.on_update(gs_package, old_provides)
 	_persist(session, support)
 	return gs_package.errors
@@ -335,10 +470,8 @@ def game_support_update_all(session: sqlalchemy.orm.Session):
 
 
 def game_support_remove(session: sqlalchemy.orm.Session, package: Package):
-	support = _create_instance(session)
+	support = _create_instance(session, package)
 	gs_package = support.get(package.get_id())
-	if gs_package is None:
-		gs_package = _convert_package(support, package)
 	support.on_remove(gs_package)
 	_persist(session, support)
 
@@ -15,10 +15,12 @@
 # along with this program.  If not, see <https://www.gnu.org/licenses/>.
 
 import datetime
+import operator
 from datetime import timedelta
-from typing import Optional
+from typing import Optional, Iterator, Tuple, List, Callable, Iterable
 
-from app.models import User, Package, PackageDailyStats, db, PackageState
+from app.models import User, Package, PackageDailyStats, db, PackageState, PackageStatsRollup, AuthorStatsRollup, \
+	get_stats_period_start
 from sqlalchemy import func
 
 
@@ -27,11 +29,50 @@ def daterange(start_date, end_date):
 		yield start_date + timedelta(n)
 
 
+def _next_period(date: datetime.date, granularity: str) -> datetime.date:
+	if granularity == "week":
+		return date + timedelta(days=7)
+	elif granularity == "month":
+		return (date + timedelta(days=32)).replace(day=1)
+	else:
+		return date + timedelta(days=1)
+
+
+def iter_periods(start_date: datetime.date, end_date: datetime.date, granularity: str = "day") -> Iterator[datetime.date]:
+	"""
+	Yields the first day of each period from the one containing `start_date` to the one containing `end_date`
+	"""
+	date = get_stats_period_start(start_date, granularity)
+	while date <= end_date:
+		yield date
+		date = _next_period(date, granularity)
+
+
+def get_period_index(start_date: datetime.date, granularity: str = "day") -> Callable[[datetime.date], int]:
+	"""
+	Returns a function that gives the index of the period containing a date, where the period
+	containing `start_date` is 0
+	"""
+	start_date = get_stats_period_start(start_date, granularity)
+	if granularity == "week":
+		return lambda date: (date - start_date).days // 7
+	elif granularity == "month":
+		return lambda date: (date.year - start_date.year) * 12 + date.month - start_date.month
+	else:
+		return lambda date: (date - start_date).days
+
+
 keys = ["platform_minetest", "platform_other", "reason_new",
 		"reason_dependency", "reason_update"]
 
+_get_values = operator.attrgetter(*keys)
+
 
-def flatten_data(stats):
+def flatten_data(stats, granularity: str = "day"):
+	"""
+	Converts a list of stats, sorted by date, into a dense list per key. The lists are allocated
+	up front and the stats are scattered into them, rather than looping over every period.
+	"""
 	start_date = stats[0].date
 	end_date = stats[-1].date
 	result = {
@@ -39,86 +80,93 @@ def flatten_data(stats):
 		"end": end_date.isoformat(),
 	}
 
-	for key in keys:
-		result[key] = []
+	get_index = get_period_index(start_date, granularity)
+	length = get_index(end_date) + 1
+	indices = [get_index(stat.date) for stat in stats]
 
-	i = 0
-	for date in daterange(start_date, end_date):
-		stat = stats[i]
-		if stat.date == date:
-			for key in keys:
-				result[key].append(getattr(stat, key))
-
-			i += 1
-		else:
-			for key in keys:
-				result[key].append(0)
+	# Values are extracted a row at a time and then transposed into columns
+	for key, values in zip(keys, zip(*map(_get_values, stats))):
+		column = [0] * length
+		for i, value in zip(indices, values):
+			column[i] = value
+		result[key] = column
 
 	return result
 
 
-def get_package_stats(package: Package, start_date: Optional[datetime.date], end_date: Optional[datetime.date]):
-	query = package.daily_stats.order_by(db.asc(PackageDailyStats.date))
+def _filter_dates(query, column, start_date: Optional[datetime.date], end_date: Optional[datetime.date], granularity: str):
 	if start_date:
-		query = query.filter(PackageDailyStats.date >= start_date)
+		query = query.filter(column >= get_stats_period_start(start_date, granularity))
 	if end_date:
-		query = query.filter(PackageDailyStats.date <= end_date)
+		query = query.filter(column <= end_date)
+	return query
+
+
+def get_package_stats(package: Package, start_date: Optional[datetime.date], end_date: Optional[datetime.date],
+		granularity: str = "day"):
+	if granularity == "day":
+		query = package.daily_stats.order_by(db.asc(PackageDailyStats.date))
+		query = _filter_dates(query, PackageDailyStats.date, start_date, end_date, granularity)
+	else:
+		query = PackageStatsRollup.query \
+			.filter_by(package_id=package.id, granularity=granularity) \
+			.order_by(db.asc(PackageStatsRollup.date))
+		query = _filter_dates(query, PackageStatsRollup.date, start_date, end_date, granularity)
 
 	stats = query.all()
 	if len(stats) == 0:
 		return None
 
-	return flatten_data(stats)
+	return flatten_data(stats, granularity)
 
 
-def get_package_stats_for_user(user: User, start_date: Optional[datetime.date], end_date: Optional[datetime.date]):
-	query = db.session \
-		.query(PackageDailyStats.date,
-			func.sum(PackageDailyStats.platform_minetest).label("platform_minetest"),
-			func.sum(PackageDailyStats.platform_other).label("platform_other"),
-			func.sum(PackageDailyStats.reason_new).label("reason_new"),
-			func.sum(PackageDailyStats.reason_dependency).label("reason_dependency"),
-			func.sum(PackageDailyStats.reason_update).label("reason_update")) \
-		.filter(PackageDailyStats.package.has(author_id=user.id))
+def get_package_stats_for_user(user: User, start_date: Optional[datetime.date], end_date: Optional[datetime.date],
+		granularity: str = "day"):
+	query = AuthorStatsRollup.query \
+		.filter_by(author_id=user.id, granularity=granularity) \
+		.order_by(db.asc(AuthorStatsRollup.date))
+	query = _filter_dates(query, AuthorStatsRollup.date, start_date, end_date, granularity)
 
-	if start_date:
-		query = query.filter(PackageDailyStats.date >= start_date)
-	if end_date:
-		query = query.filter(PackageDailyStats.date <= end_date)
-
-	stats = query.order_by(db.asc(PackageDailyStats.date)) \
-		.group_by(PackageDailyStats.date) \
-		.all()
+	stats = query.all()
 	if len(stats) == 0:
 		return None
 
-	results = flatten_data(stats)
-	results["package_downloads"] = get_package_overview_for_user(user, stats[0].date, stats[-1].date)
+	results = flatten_data(stats, granularity)
+	results["package_downloads"] = get_package_overview_for_user(user, stats[0].date, stats[-1].date, granularity)
 
 	return results
 
 
-def get_package_overview_for_user(user: Optional[User], start_date: datetime.date, end_date: datetime.date):
-	query = db.session \
-		.query(PackageDailyStats.package_id, PackageDailyStats.date,
-			(PackageDailyStats.platform_minetest + PackageDailyStats.platform_other).label("downloads"))
+def scatter_downloads(stats: Iterable, start_date: datetime.date, end_date: datetime.date, granularity: str = "day") \
+		-> Iterator[Tuple[int, List[int]]]:
+	"""
+	Converts stats with `package_id`, `date`, and `downloads`, sorted by package, into (package id,
+	downloads per period). Each row is allocated up front, and the stats are scattered into it.
+	"""
+	get_index = get_period_index(start_date, granularity)
+	length = get_index(end_date) + 1
 
-	if user:
-		query = query.filter(PackageDailyStats.package.has(author_id=user.id))
+	package_id = None
+	row = None
+	for stat in stats:
+		if stat.package_id != package_id:
+			if row is not None:
+				yield package_id, row
 
-	all_stats = query \
-		.filter(PackageDailyStats.package.has(state=PackageState.APPROVED),
-				PackageDailyStats.date >= start_date, PackageDailyStats.date <= end_date) \
-		.order_by(db.asc(PackageDailyStats.package_id), db.asc(PackageDailyStats.date)) \
-		.all()
+			package_id = stat.package_id
+			row = [0] * length
+
+		row[get_index(stat.date)] = stat.downloads
 
-	stats_by_package = {}
-	for stat in all_stats:
-		bucket = stats_by_package.get(stat.package_id, [])
-		stats_by_package[stat.package_id] = bucket
+	if row is not None:
+		yield package_id, row
 
-		bucket.append(stat)
 
+def iter_package_overview_for_user(user: Optional[User], start_date: datetime.date, end_date: datetime.date,
+		granularity: str = "day") -> Iterator[Tuple[str, List[int]]]:
+	"""
+	Yields (package, downloads per period) one package at a time, reading the stats as they're needed
+	"""
 	package_title_by_id = {}
 	pkg_query = user.packages if user else Package.query
 	for package in pkg_query.filter_by(state=PackageState.APPROVED).all():
@@ -127,30 +175,36 @@ def get_package_overview_for_user(user: Optional[User], start_date: datetime.dat
 		else:
 			package_title_by_id[package.id] = package.get_id()
 
-	result = {}
-
-	for package_id, stats in stats_by_package.items():
-		i = 0
-		row = []
-		result[package_title_by_id[package_id]] = row
-		for date in daterange(start_date, end_date):
-			if i >= len(stats):
-				row.append(0)
-				continue
-
-			stat = stats[i]
-			if stat.date == date:
-				row.append(stat.downloads)
-				i += 1
-			elif stat.date > date:
-				row.append(0)
-			else:
-				raise Exception(f"Invalid logic, expected stat {stat.date} to be later than {date}")
+	if granularity == "day":
+		table = PackageDailyStats
+		query = db.session.query(table.package_id, table.date, (table.platform_minetest + table.platform_other).label("downloads"))
+	else:
+		table = PackageStatsRollup
+		query = db.session.query(table.package_id, table.date, (table.platform_minetest + table.platform_other).label("downloads")) \
+			.filter(table.granularity == granularity)
 
-	return result
+	if user:
+		query = query.filter(table.package.has(author_id=user.id))
+
+	all_stats = query \
+		.filter(table.package.has(state=PackageState.APPROVED),
+				table.date >= get_stats_period_start(start_date, granularity), table.date <= end_date) \
+		.order_by(db.asc(table.package_id), db.asc(table.date)) \
+		.yield_per(1000)
+
+	for package_id, row in scatter_downloads(all_stats, start_date, end_date, granularity):
+		yield package_title_by_id[package_id], row
+
+
+def get_package_overview_for_user(user: Optional[User], start_date: datetime.date, end_date: datetime.date,
+		granularity: str = "day"):
+	return dict(iter_package_overview_for_user(user, start_date, end_date, granularity))
 
 
 def get_all_package_stats(start_date: Optional[datetime.date] = None, end_date: Optional[datetime.date] = None):
+	"""
+	package_downloads is an iterator of (package, downloads per day), see `stream_json_object`
+	"""
 	now_date = datetime.datetime.utcnow().date()
 	if end_date is None or end_date > now_date:
 		end_date = now_date
@@ -162,5 +216,5 @@ def get_all_package_stats(start_date: Optional[datetime.date] = None, end_date:
 	return {
 		"start": start_date.isoformat(),
 		"end": end_date.isoformat(),
-		"package_downloads": get_package_overview_for_user(None, start_date, end_date),
+		"package_downloads": iter_package_overview_for_user(None, start_date, end_date),
 	}
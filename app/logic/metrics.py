@@ -0,0 +1,245 @@
+# ContentDB
+# Copyright (C) rubenwardy
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import bisect
+import datetime
+from collections import defaultdict
+from typing import Dict, Iterable, List, Optional, Tuple, Sequence
+
+from sqlalchemy.sql.expression import func
+
+from app.models import Package, db, User, UserRank, PackageState, PackageReview, ThreadReply, Collection, AuditLogEntry, \
+	PackageTranslation
+from app.rediscache import increment_metric, increment_metrics, set_metric_values, get_metric_values, merge_metric_key
+
+
+# Metrics are registered when they're created, and their values are stored in Redis so that
+# they're shared by all web and worker processes. Counters are incremented where the thing
+# they count happens, and gauges are set by `collect_metrics`, which runs periodically. The
+# metrics endpoint only renders the stored values.
+
+_metrics: Dict[str, "Metric"] = {}
+
+
+def _escape_label(value: str) -> str:
+	return value.replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
+
+class Metric:
+	type: str
+
+	def __init__(self, name: str, help_: str, labels: Iterable[str] = ()):
+		assert name not in _metrics
+		self.name = name
+		self.help = help_
+		self.labels = tuple(labels)
+		_metrics[name] = self
+
+	def get_series(self, labels: Dict[str, str]) -> str:
+		assert set(labels.keys()) == set(self.labels)
+		return ",".join(f"{key}=\"{_escape_label(str(labels[key]))}\"" for key in self.labels)
+
+	def render(self, values: Dict[str, str]) -> List[str]:
+		lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.type}"]
+		for series, value in sorted(values.items()):
+			if series:
+				lines.append(f"{self.name}{{{series}}} {value}")
+			else:
+				lines.append(f"{self.name} {value}")
+		return lines
+
+
+class Counter(Metric):
+	type = "counter"
+
+	def inc(self, amount: float = 1, **labels):
+		increment_metric(self.name, self.get_series(labels), amount)
+
+
+class Gauge(Metric):
+	type = "gauge"
+
+	def set(self, value: float, **labels):
+		set_metric_values(self.name, {self.get_series(labels): value}, False)
+
+	def set_all(self, values: Iterable[Tuple[Dict[str, str], float]]):
+		"""Replaces all series, series that aren't in `values` are removed"""
+		set_metric_values(self.name, {self.get_series(labels): value for labels, value in values}, True)
+
+
+class Histogram(Metric):
+	"""
+	Each series is stored as the number of observations in each bucket, and their sum. The
+	buckets are made cumulative when rendering, so an observation only updates one bucket.
+	"""
+	type = "histogram"
+
+	def __init__(self, name: str, help_: str, buckets: Sequence[float], labels: Iterable[str] = ()):
+		super().__init__(name, help_, labels)
+		self.buckets = list(buckets)
+
+	def get_increments(self, value: float, **labels) -> List[Tuple[str, str, float]]:
+		series = self.get_series(labels)
+		bucket = bisect.bisect_left(self.buckets, value)
+		return [(self.name, f"{series}|{bucket}", 1), (self.name, f"{series}|sum", value)]
+
+	def observe(self, value: float, **labels):
+		increment_metrics(self.get_increments(value, **labels))
+
+	def render(self, values: Dict[str, str]) -> List[str]:
+		by_series = defaultdict(dict)
+		for field, value in values.items():
+			series, key = field.rsplit("|", 1)
+			by_series[series][key] = value
+
+		lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.type}"]
+		for series, counts in sorted(by_series.items()):
+			prefix = series + "," if series else ""
+			total = 0
+			for i, bound in enumerate(self.buckets + ["+Inf"]):
+				total += int(float(counts.get(str(i), 0)))
+				lines.append(f"{self.name}_bucket{{{prefix}le=\"{bound}\"}} {total}")
+
+			suffix = f"{{{series}}}" if series else ""
+			lines.append(f"{self.name}_sum{suffix} {counts.get('sum', 0)}")
+			lines.append(f"{self.name}_count{suffix} {total}")
+
+		return lines
+
+
+def observe_many(observations: Iterable[Tuple[Histogram, float, Dict[str, str]]]):
+	"""Records (histogram, value, labels) observations using a single round trip"""
+	increments = []
+	for histogram, value, labels in observations:
+		increments.extend(histogram.get_increments(value, **labels))
+	increment_metrics(increments)
+
+
+def render_metrics() -> str:
+	"""
+	Renders all metrics in the Prometheus text format, metrics without values are skipped
+	"""
+	metrics = list(_metrics.values())
+	lines = []
+	for metric, values in zip(metrics, get_metric_values([metric.name for metric in metrics])):
+		if len(values) > 0:
+			lines.extend(metric.render(values))
+			lines.append("")
+
+	return "".join(line + "\n" for line in lines)
+
+
+emails_sent = Counter("contentdb_emails", "Number of emails sent")
+download_events = Counter("contentdb_download_events", "Number of download events applied to the database")
+
+_DURATION_BUCKETS = [0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10]
+
+request_duration = Histogram("contentdb_request_duration_seconds", "Time taken to handle requests, excluding streamed bodies",
+		_DURATION_BUCKETS, ["endpoint"])
+request_sql_statements = Histogram("contentdb_request_sql_statements", "Number of SQL statements executed per request",
+		[0, 1, 2, 5, 10, 20, 50, 100, 200, 500], ["endpoint"])
+request_sql_duration = Histogram("contentdb_request_sql_duration_seconds", "Time spent executing SQL per request",
+		_DURATION_BUCKETS, ["endpoint"])
+request_response_bytes = Histogram("contentdb_request_response_bytes", "Size of responses, excluding streamed responses",
+		[100, 1000, 10000, 100000, 1000000, 10000000], ["endpoint"])
+
+packages = Gauge("contentdb_packages", "Total packages")
+users = Gauge("contentdb_users", "Number of registered users")
+authors = Gauge("contentdb_authors", "Number of users with packages")
+users_active_1d = Gauge("contentdb_users_active_1d", "Number of daily active registered users")
+users_active_1w = Gauge("contentdb_users_active_1w", "Number of weekly active registered users")
+users_active_1m = Gauge("contentdb_users_active_1m", "Number of monthly active registered users")
+downloads = Gauge("contentdb_downloads", "Total downloads")
+reviews = Gauge("contentdb_reviews", "Number of reviews")
+comments = Gauge("contentdb_comments", "Number of comments")
+collections = Gauge("contentdb_collections", "Number of collections")
+score = Gauge("contentdb_score", "Total package score")
+packages_with_translations = Gauge("contentdb_packages_with_translations", "Number of packages with translations")
+packages_with_translations_meta = Gauge("contentdb_packages_with_translations_meta",
+		"Number of packages with translated meta")
+languages_translated = Gauge("contentdb_languages_translated", "Number of packages per language", ["language"])
+languages_translated_meta = Gauge("contentdb_languages_translated_meta",
+		"Number of packages with translated short desc per language", ["language"])
+
+
+def _get_active_users(now: Optional[datetime.datetime] = None) -> Tuple[int, int, int]:
+	"""
+	Returns the number of users active in the last day, week, and 4 weeks. Users are active
+	when they post a comment or do something that is added to the audit log.
+	"""
+	now = now or datetime.datetime.utcnow()
+	one_day_ago = now - datetime.timedelta(days=1)
+	one_week_ago = now - datetime.timedelta(weeks=1)
+	one_month_ago = now - datetime.timedelta(weeks=4)
+
+	activity = db.union_all(
+		db.select(AuditLogEntry.causer_id.label("user_id"), AuditLogEntry.created_at)
+			.where(AuditLogEntry.created_at > one_month_ago, AuditLogEntry.causer_id.is_not(None)),
+		db.select(ThreadReply.author_id.label("user_id"), ThreadReply.created_at)
+			.where(ThreadReply.created_at > one_month_ago)).subquery()
+
+	last_active = db.select(activity.c.user_id, func.max(activity.c.created_at).label("last_active")) \
+		.group_by(activity.c.user_id) \
+		.subquery()
+
+	return tuple(db.session.execute(db.select(
+				func.count().filter(last_active.c.last_active > one_day_ago),
+				func.count().filter(last_active.c.last_active > one_week_ago),
+				func.count())
+			.select_from(last_active)
+			.join(User, User.id == last_active.c.user_id)
+			.where(User.rank != UserRank.BOT)).one())
+
+
+def collect_metrics():
+	"""
+	Updates the gauges, this is run periodically by a background task
+	"""
+	# Emails used to be counted in a plain key, the count is carried over once after upgrading
+	merge_metric_key("emails_sent", emails_sent.name, emails_sent.get_series({}))
+
+	total_downloads, total_score = db.session.query(
+			func.coalesce(func.sum(Package.downloads), 0), func.coalesce(func.sum(Package.score), 0)).one()
+	downloads.set(total_downloads)
+	score.set(total_score)
+
+	packages.set(Package.query.filter_by(state=PackageState.APPROVED).count())
+	users.set(User.query.filter(User.rank > UserRank.NOT_JOINED, User.rank != UserRank.BOT, User.is_active).count())
+	authors.set(User.query.filter(User.packages.any(state=PackageState.APPROVED)).count())
+
+	active_day, active_week, active_month = _get_active_users()
+	users_active_1d.set(active_day)
+	users_active_1w.set(active_week)
+	users_active_1m.set(active_month)
+
+	reviews.set(PackageReview.query.count())
+	comments.set(ThreadReply.query.count())
+	collections.set(Collection.query.count())
+
+	packages_with_translations.set(db.session.query(PackageTranslation.package_id)
+			.filter(PackageTranslation.language_id != "en")
+			.group_by(PackageTranslation.package_id).count())
+	packages_with_translations_meta.set(db.session.query(PackageTranslation.package_id)
+			.filter(PackageTranslation.short_desc.is_not(None), PackageTranslation.language_id != "en")
+			.group_by(PackageTranslation.package_id).count())
+
+	languages_translated.set_all(({"language": language}, count) for language, count in
+			db.session.query(PackageTranslation.language_id, func.count(PackageTranslation.package_id))
+				.group_by(PackageTranslation.language_id).all())
+	languages_translated_meta.set_all(({"language": language}, count) for language, count in
+			db.session.query(PackageTranslation.language_id, func.count(PackageTranslation.package_id))
+				.filter(PackageTranslation.short_desc.is_not(None))
+				.group_by(PackageTranslation.language_id).all())
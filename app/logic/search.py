@@ -0,0 +1,271 @@
+# ContentDB
+# Copyright (C) rubenwardy
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import bisect
+import math
+import re
+import threading
+from collections import defaultdict
+from typing import Dict, Iterable, List, Set, Tuple
+
+
+# An in-memory inverted index of packages, used for search.
+#
+# Each term maps to the packages that contain it, along with a weighted term frequency. Matches
+# in the name or title count for more than matches in the short description. Results are ranked
+# using BM25, and then blended with the package score so that popular packages come first when
+# the relevance is similar.
+#
+# Query terms match index terms exactly, as a prefix (for search-as-you-type), or, when neither
+# finds anything, by trigram similarity (for typos).
+
+FIELD_WEIGHTS = {
+	"name": 3.0,
+	"title": 3.0,
+	"provides": 2.0,
+	"translated_title": 2.0,
+	"tags": 1.5,
+	"short_desc": 1.0,
+}
+
+BM25_K1 = 1.2
+BM25_B = 0.75
+
+# Multiplies the relevance of prefix and fuzzy matches, relative to an exact match
+PREFIX_FACTOR = 0.7
+FUZZY_FACTOR = 0.5
+
+# Limits the number of index terms that a single query term can expand to
+MAX_EXPANSIONS = 50
+
+MIN_PREFIX_LENGTH = 2
+MIN_FUZZY_LENGTH = 3
+MIN_FUZZY_SIMILARITY = 0.4
+
+# How much the package score affects the ranking
+SCORE_WEIGHT = 0.1
+
+_token_re = re.compile(r"[^\W_]+")
+
+
+def tokenize(text: str) -> List[str]:
+	return _token_re.findall(text.lower())
+
+
+def _trigrams(term: str) -> Set[str]:
+	padded = f"  {term} "
+	return set(padded[i:i + 3] for i in range(len(padded) - 2))
+
+
+class SearchIndex:
+	# Term to package id to weighted term frequency
+	postings: Dict[str, Dict[int, float]]
+
+	# Trigram to the terms that contain it
+	trigrams: Dict[str, Set[str]]
+
+	# Package id to its terms, used to remove packages
+	documents: Dict[int, Set[str]]
+
+	lengths: Dict[int, float]
+	scores: Dict[int, float]
+	total_length: float
+
+	def __init__(self):
+		self.lock = threading.RLock()
+		self.clear()
+
+	def clear(self):
+		with self.lock:
+			self.postings = {}
+			self.trigrams = {}
+			self.documents = {}
+			self.lengths = {}
+			self.scores = {}
+			self.total_length = 0
+			self._sorted_terms = None
+
+			# Postings and trigram sets that aren't shared with a copy, and so can be modified
+			self._owned_postings = set()
+			self._owned_trigrams = set()
+
+	def copy(self) -> "SearchIndex":
+		"""
+		Returns a copy that can be modified without affecting this index. Postings and trigram
+		sets are shared until either index modifies them, so this is cheap.
+		"""
+		with self.lock:
+			ret = SearchIndex()
+			ret.postings = dict(self.postings)
+			ret.trigrams = dict(self.trigrams)
+			ret.documents = dict(self.documents)
+			ret.lengths = dict(self.lengths)
+			ret.scores = dict(self.scores)
+			ret.total_length = self.total_length
+			ret._sorted_terms = self._sorted_terms
+
+			self._owned_postings = set()
+			self._owned_trigrams = set()
+			return ret
+
+	def _own_postings(self, term: str) -> Dict[int, float]:
+		if term not in self._owned_postings:
+			self.postings[term] = dict(self.postings.get(term, ()))
+			self._owned_postings.add(term)
+		return self.postings[term]
+
+	def _own_trigram(self, trigram: str) -> Set[str]:
+		if trigram not in self._owned_trigrams:
+			self.trigrams[trigram] = set(self.trigrams.get(trigram, ()))
+			self._owned_trigrams.add(trigram)
+		return self.trigrams[trigram]
+
+	def __len__(self):
+		return len(self.documents)
+
+	def add(self, package_id: int, score: float, fields: Dict[str, Iterable[str]]):
+		"""
+		Adds or replaces a package. `fields` maps field names in FIELD_WEIGHTS to text.
+		"""
+		frequencies = defaultdict(float)
+		length = 0
+		for field, texts in fields.items():
+			weight = FIELD_WEIGHTS[field]
+			for text in texts:
+				if not text:
+					continue
+
+				for term in tokenize(text):
+					frequencies[term] += weight
+					length += weight
+
+		with self.lock:
+			self.remove(package_id)
+
+			for term, frequency in frequencies.items():
+				if term not in self.postings:
+					for trigram in _trigrams(term):
+						self._own_trigram(trigram).add(term)
+					self._sorted_terms = None
+
+				self._own_postings(term)[package_id] = frequency
+
+			self.documents[package_id] = set(frequencies.keys())
+			self.lengths[package_id] = length
+			self.scores[package_id] = score
+			self.total_length += length
+
+	def remove(self, package_id: int):
+		with self.lock:
+			terms = self.documents.pop(package_id, None)
+			if terms is None:
+				return
+
+			for term in terms:
+				postings = self._own_postings(term)
+				del postings[package_id]
+				if len(postings) == 0:
+					del self.postings[term]
+					self._owned_postings.discard(term)
+					for trigram in _trigrams(term):
+						self._own_trigram(trigram).discard(term)
+					self._sorted_terms = None
+
+			self.total_length -= self.lengths.pop(package_id)
+			del self.scores[package_id]
+
+	def _get_sorted_terms(self) -> List[str]:
+		if self._sorted_terms is None:
+			self._sorted_terms = sorted(self.postings.keys())
+		return self._sorted_terms
+
+	def _expand(self, token: str) -> List[Tuple[str, float]]:
+		"""
+		Returns the index terms that match a query token, with a factor for how good the match is
+		"""
+		ret = []
+		if token in self.postings:
+			ret.append((token, 1.0))
+
+		if len(token) >= MIN_PREFIX_LENGTH:
+			terms = self._get_sorted_terms()
+			i = bisect.bisect_left(terms, token)
+			while i < len(terms) and len(ret) < MAX_EXPANSIONS and terms[i].startswith(token):
+				if terms[i] != token:
+					ret.append((terms[i], PREFIX_FACTOR))
+				i += 1
+
+		if len(ret) == 0 and len(token) >= MIN_FUZZY_LENGTH:
+			token_trigrams = _trigrams(token)
+			shared = defaultdict(int)
+			for trigram in token_trigrams:
+				for term in self.trigrams.get(trigram, ()):
+					shared[term] += 1
+
+			candidates = []
+			for term, count in shared.items():
+				similarity = count / (len(token_trigrams) + len(term) + 1 - count)
+				if similarity >= MIN_FUZZY_SIMILARITY:
+					candidates.append((term, FUZZY_FACTOR * similarity))
+
+			candidates.sort(key=lambda x: x[1], reverse=True)
+			ret.extend(candidates[:MAX_EXPANSIONS])
+
+		return ret
+
+	def search(self, query: str) -> Dict[int, float]:
+		"""
+		Returns the packages that match every term in the query, and their rank. Higher is better.
+		"""
+		tokens = tokenize(query)
+		if len(tokens) == 0:
+			return {}
+
+		with self.lock:
+			num_documents = len(self.documents)
+			if num_documents == 0:
+				return {}
+
+			average_length = self.total_length / num_documents
+
+			results = None
+			for token in dict.fromkeys(tokens):
+				token_results = defaultdict(float)
+				for term, factor in self._expand(token):
+					postings = self.postings[term]
+					idf = math.log(1 + (num_documents - len(postings) + 0.5) / (len(postings) + 0.5))
+					for package_id, frequency in postings.items():
+						if results is not None and package_id not in results:
+							continue
+
+						norm = BM25_K1 * (1 - BM25_B + BM25_B * self.lengths[package_id] / average_length)
+						relevance = factor * idf * frequency * (BM25_K1 + 1) / (frequency + norm)
+
+						# A package matching a token in several ways only counts the best match
+						if relevance > token_results[package_id]:
+							token_results[package_id] = relevance
+
+				if results is None:
+					results = token_results
+				else:
+					results = {package_id: results[package_id] + relevance
+							for package_id, relevance in token_results.items()}
+
+				if len(results) == 0:
+					return {}
+
+			return {package_id: relevance * (1 + SCORE_WEIGHT * math.log1p(max(self.scores[package_id], 0)))
+					for package_id, relevance in results.items()}
@@ -0,0 +1,272 @@
+# ContentDB
+# Copyright (C) rubenwardy
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+from collections import defaultdict
+from typing import Optional, Dict, List, Iterable, Tuple
+
+from flask_babel import gettext, get_locale
+from sqlalchemy.orm import joinedload
+
+from app.models import db, Package, PackageDevState, User, PackageScreenshot, PackageAlias, Tags, Tag, \
+	ContentWarnings, ContentWarning, PackageProvides, MetaPackage, PackageGameSupport, \
+	PackageLatestRelease, MinetestRelease, maintainers
+from .translations import get_translation_store
+
+
+# Serializes packages for the API. Lists of packages are serialized by `as_short_dicts` and `as_dicts`,
+# which load relations for all the packages at once using a fixed number of queries, rather than
+# lazily loading them for each package. A single package that has already been loaded is serialized
+# by `as_short_dict` and `as_dict`, which use its relationships instead.
+
+
+def _group_by_package(rows: Iterable[Tuple]) -> Dict[int, List]:
+	ret = defaultdict(list)
+	for package_id, value in rows:
+		ret[package_id].append(value)
+	return ret
+
+
+class PackageSerializer:
+	def __init__(self, base_url: str, version: Optional[MinetestRelease] = None, lang: Optional[str] = "en"):
+		if lang is None:
+			locale = get_locale()
+			lang = locale.language if locale else "en"
+
+		self.base_url = base_url
+		self.version = version
+		self.lang = lang
+
+	def _get_packages(self, package_ids: List[int], full: bool) -> Dict[int, Package]:
+		options = [joinedload(Package.author)]
+		if full:
+			options += [joinedload(Package.license), joinedload(Package.media_license)]
+
+		packages = Package.query.filter(Package.id.in_(package_ids)).options(*options).all()
+		return {package.id: package for package in packages}
+
+	def _get_releases(self, package_ids: List[int]) -> Dict[int, int]:
+		return dict(db.session.query(PackageLatestRelease.package_id, PackageLatestRelease.release_id)
+				.filter(PackageLatestRelease.minetest_release_id == (self.version.id if self.version else None),
+						PackageLatestRelease.package_id.in_(package_ids)).all())
+
+	def _get_translations(self, package_ids: List[int], load_desc: bool) -> Dict[int, Tuple]:
+		if self.lang == "en":
+			return {}
+
+		store = get_translation_store()
+		metas = store.get_metas(package_ids, self.lang)
+		if not load_desc:
+			return metas
+
+		descs = store.get_descs(package_ids, self.lang)
+		return {package_id: metas.get(package_id, (None, None)) + (descs[package_id],) for package_id in package_ids}
+
+	def _get_thumbnails(self, package_ids: List[int]) -> Dict[int, str]:
+		rows = db.session.query(PackageScreenshot.package_id, PackageScreenshot.url) \
+			.filter(PackageScreenshot.approved == True, PackageScreenshot.package_id.in_(package_ids)) \
+			.order_by(db.asc(PackageScreenshot.package_id), db.asc(PackageScreenshot.order), db.asc(PackageScreenshot.id)) \
+			.distinct(PackageScreenshot.package_id).all()
+		return {package_id: PackageScreenshot.make_thumb_url(url, 1, "png") for package_id, url in rows}
+
+	def _get_aliases(self, package_ids: List[int]) -> Dict[int, List[str]]:
+		rows = db.session.query(PackageAlias.package_id, PackageAlias.author, PackageAlias.name) \
+			.filter(PackageAlias.package_id.in_(package_ids)) \
+			.order_by(db.asc(PackageAlias.id)).all()
+		return _group_by_package((package_id, f"{author}/{name}") for package_id, author, name in rows)
+
+	def _make_thumbnail(self, url: Optional[str]) -> Optional[str]:
+		return (self.base_url + url) if url is not None else None
+
+	def _get_games(self, supports: List[PackageGameSupport]) -> Dict[int, dict]:
+		game_ids = list({support.game_id for support in supports})
+		return dict(zip(game_ids, self.as_short_dicts(game_ids)))
+
+	def _make_short_dict(self, package: Package, release_id: Optional[int], translation: Tuple,
+			thumbnail: Optional[str], aliases: List[str], include_vcs: bool) -> dict:
+		title, short_desc = translation
+		if package.dev_state == PackageDevState.WIP:
+			short_desc = gettext("Work in Progress") + ". " + package.short_desc
+
+		data = {
+			"name": package.name,
+			"title": title or package.title,
+			"author": package.author.username,
+			"short_description": short_desc or package.short_desc,
+			"type": package.type.to_name(),
+			"release": release_id,
+			"thumbnail": self._make_thumbnail(thumbnail),
+		}
+
+		if aliases:
+			data["aliases"] = aliases
+
+		if include_vcs:
+			data["repo"] = package.repo
+
+		return data
+
+	def _make_dict(self, package: Package, release_id: Optional[int], translation: Tuple,
+			screenshots: List[PackageScreenshot], maintainer_names: List[str], tags: List[str],
+			content_warnings: List[str], provides: List[str], supports: List[PackageGameSupport],
+			games: Dict[int, dict], screenshots_dict: bool) -> dict:
+		title, short_desc, desc = translation
+
+		main_screenshot = next((ss for ss in screenshots if ss.approved), None)
+		if screenshots_dict:
+			screenshot_list = [ss.as_short_dict(self.base_url) for ss in screenshots]
+		else:
+			screenshot_list = [self.base_url + ss.url for ss in screenshots]
+
+		return {
+			"author": package.author.username,
+			"maintainers": maintainer_names,
+
+			"state": package.state.name,
+			"dev_state": package.dev_state.name if package.dev_state else None,
+
+			"name": package.name,
+			"title": title or package.title,
+			"short_description": short_desc or package.short_desc,
+			"long_description": desc or package.desc,
+			"type": package.type.to_name(),
+			"created_at": package.created_at.isoformat(),
+
+			"license": package.license.name,
+			"media_license": package.media_license.name,
+
+			"repo": package.repo,
+			"website": package.website,
+			"issue_tracker": package.issueTracker,
+			"forums": package.forums,
+			"forum_url": package.forums_url,
+			"video_url": package.video_url,
+			"video_thumbnail_url": package.get_video_thumbnail_url(True),
+			"donate_url": package.donate_url_actual,
+			"translation_url": package.translation_url,
+
+			"tags": sorted(tags),
+			"content_warnings": sorted(content_warnings),
+
+			"provides": sorted(provides),
+			"thumbnail": self._make_thumbnail(main_screenshot and main_screenshot.get_thumb_url(1, "png")),
+			"screenshots": screenshot_list,
+
+			"url": self.base_url + package.get_url("packages.download"),
+			"release": release_id,
+
+			"score": round(package.score * 10) / 10,
+			"downloads": package.downloads,
+
+			"game_support": [
+				{
+					"supports": support.supports,
+					"confidence": support.confidence,
+					"game": games[support.game_id],
+				} for support in supports if support.game_id in games
+			]
+		}
+
+	def as_short_dict(self, package: Package, include_vcs: bool = False) -> dict:
+		"""
+		Returns the short dict of a loaded package, relationships that are already loaded aren't queried again
+		"""
+		screenshot = package.main_screenshot
+		return self._make_short_dict(package,
+				self._get_releases([package.id]).get(package.id),
+				self._get_translations([package.id], False).get(package.id, (None, None)),
+				screenshot and screenshot.get_thumb_url(1, "png"),
+				[alias.as_dict() for alias in sorted(package.aliases, key=lambda x: x.id)],
+				include_vcs)
+
+	def as_dict(self, package: Package, screenshots_dict: bool = False) -> dict:
+		"""
+		Returns the full dict of a loaded package, relationships that are already loaded aren't queried again
+		"""
+		supports = package.supported_games.order_by(db.asc(PackageGameSupport.id)).all()
+		return self._make_dict(package,
+				self._get_releases([package.id]).get(package.id),
+				self._get_translations([package.id], True).get(package.id, (None, None, None)),
+				package.screenshots.order_by(db.asc(PackageScreenshot.id)).all(),
+				[user.username for user in sorted(package.maintainers, key=lambda x: x.id)],
+				[tag.name for tag in package.tags],
+				[warning.name for warning in package.content_warnings],
+				[meta.name for meta in package.provides],
+				supports, self._get_games(supports), screenshots_dict)
+
+	def as_short_dicts(self, package_ids: List[int], include_vcs: bool = False) -> List[dict]:
+		"""
+		Returns the short dicts of the packages in the same order as package_ids, ids of packages that
+		don't exist are skipped
+		"""
+		if len(package_ids) == 0:
+			return []
+
+		packages = self._get_packages(package_ids, False)
+		releases = self._get_releases(package_ids)
+		translations = self._get_translations(package_ids, False)
+		thumbnails = self._get_thumbnails(package_ids)
+		aliases = self._get_aliases(package_ids)
+
+		return [self._make_short_dict(packages[package_id], releases.get(package_id),
+					translations.get(package_id, (None, None)), thumbnails.get(package_id),
+					aliases.get(package_id, []), include_vcs)
+				for package_id in package_ids if package_id in packages]
+
+	def as_dicts(self, package_ids: List[int], screenshots_dict: bool = False) -> List[dict]:
+		"""
+		Returns the full dicts of the packages in the same order as package_ids, ids of packages that
+		don't exist are skipped
+		"""
+		if len(package_ids) == 0:
+			return []
+
+		packages = self._get_packages(package_ids, True)
+		releases = self._get_releases(package_ids)
+		translations = self._get_translations(package_ids, True)
+
+		screenshots = _group_by_package(db.session.query(PackageScreenshot.package_id, PackageScreenshot)
+				.filter(PackageScreenshot.package_id.in_(package_ids))
+				.order_by(db.asc(PackageScreenshot.order), db.asc(PackageScreenshot.id)).all())
+
+		maintainer_names = _group_by_package(db.session.query(maintainers.c.package_id, User.username)
+				.select_from(maintainers).join(User, User.id == maintainers.c.user_id)
+				.filter(maintainers.c.package_id.in_(package_ids))
+				.order_by(db.asc(User.id)).all())
+
+		tags = _group_by_package(db.session.query(Tags.c.package_id, Tag.name)
+				.select_from(Tags).join(Tag)
+				.filter(Tags.c.package_id.in_(package_ids)).all())
+
+		content_warnings = _group_by_package(db.session.query(ContentWarnings.c.package_id, ContentWarning.name)
+				.select_from(ContentWarnings).join(ContentWarning)
+				.filter(ContentWarnings.c.package_id.in_(package_ids)).all())
+
+		provides = _group_by_package(db.session.query(PackageProvides.c.package_id, MetaPackage.name)
+				.select_from(PackageProvides).join(MetaPackage)
+				.filter(PackageProvides.c.package_id.in_(package_ids)).all())
+
+		game_support = _group_by_package(db.session.query(PackageGameSupport.package_id, PackageGameSupport)
+				.filter(PackageGameSupport.package_id.in_(package_ids))
+				.order_by(db.asc(PackageGameSupport.id)).all())
+
+		games = self._get_games([support for supports in game_support.values() for support in supports])
+
+		return [self._make_dict(packages[package_id], releases.get(package_id),
+					translations.get(package_id, (None, None, None)), screenshots.get(package_id, []),
+					maintainer_names.get(package_id, []), tags.get(package_id, []),
+					content_warnings.get(package_id, []), provides.get(package_id, []),
+					game_support.get(package_id, []), games, screenshots_dict)
+				for package_id in package_ids if package_id in packages]
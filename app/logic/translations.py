@@ -0,0 +1,136 @@
+# ContentDB
+# Copyright (C) rubenwardy
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import threading
+from typing import Optional, Dict, Tuple, Iterable, List
+
+from flask import g, has_request_context
+
+from app.models import db, PackageTranslation
+from app.rediscache import get_catalogue_changes
+
+
+# The translation store is an in-memory copy of the translated package titles and short
+# descriptions, loaded a language at a time when the language is first used. Long descriptions
+# are much larger, so are only loaded for the packages they're needed for. Like the catalogue,
+# each process keeps its own copy and brings it up-to-date using the catalogue change log.
+
+
+class LanguageTranslations:
+	__slots__ = ("metas", "descs")
+
+	# Package id to (title, short_desc), packages without a translation are missing
+	metas: Dict[int, Tuple[Optional[str], Optional[str]]]
+
+	# Package id to desc, None is stored for packages without a translated desc
+	descs: Dict[int, Optional[str]]
+
+	def __init__(self):
+		self.metas = {}
+		self.descs = {}
+
+
+class TranslationStore:
+	revision: int
+	languages: Dict[str, LanguageTranslations]
+	lock: threading.Lock
+
+	def __init__(self):
+		self.revision = -1
+		self.languages = {}
+		self.lock = threading.Lock()
+
+	def sync(self):
+		with self.lock:
+			revision, changes = get_catalogue_changes(self.revision)
+			if changes is not None and len(changes) == 0:
+				return
+
+			# Other reference tables don't affect translations
+			if changes is None or "language" in changes:
+				self.languages = {}
+			elif len(self.languages) > 0:
+				package_ids = set([int(x[8:]) for x in changes if x.startswith("package/")])
+				if len(package_ids) > 0:
+					for language in self.languages.values():
+						for package_id in package_ids:
+							language.metas.pop(package_id, None)
+							language.descs.pop(package_id, None)
+
+					rows = db.session.query(PackageTranslation.language_id, PackageTranslation.package_id,
+								PackageTranslation.title, PackageTranslation.short_desc) \
+						.filter(PackageTranslation.language_id.in_(self.languages.keys()),
+								PackageTranslation.package_id.in_(package_ids)).all()
+					for language_id, package_id, title, short_desc in rows:
+						self.languages[language_id].metas[package_id] = (title, short_desc)
+
+			self.revision = revision
+
+	def _get_language(self, lang: str) -> LanguageTranslations:
+		language = self.languages.get(lang)
+		if language is None:
+			with self.lock:
+				language = self.languages.get(lang)
+				if language is None:
+					language = LanguageTranslations()
+					rows = db.session.query(PackageTranslation.package_id, PackageTranslation.title,
+								PackageTranslation.short_desc) \
+						.filter(PackageTranslation.language_id == lang).all()
+					language.metas = {package_id: (title, short_desc) for package_id, title, short_desc in rows}
+					self.languages[lang] = language
+
+		return language
+
+	def get_meta(self, package_id: int, lang: str) -> Tuple[Optional[str], Optional[str]]:
+		"""
+		Returns the translated (title, short_desc) of a package, either may be None
+		"""
+		return self._get_language(lang).metas.get(package_id, (None, None))
+
+	def get_metas(self, package_ids: Iterable[int], lang: str) -> Dict[int, Tuple[Optional[str], Optional[str]]]:
+		metas = self._get_language(lang).metas
+		return {package_id: metas[package_id] for package_id in package_ids if package_id in metas}
+
+	def get_descs(self, package_ids: List[int], lang: str) -> Dict[int, Optional[str]]:
+		"""
+		Returns the translated desc of each package, which is None when there isn't one
+		"""
+		descs = self._get_language(lang).descs
+		to_load = [package_id for package_id in package_ids if package_id not in descs]
+		if len(to_load) > 0:
+			loaded = dict(db.session.query(PackageTranslation.package_id, PackageTranslation.desc)
+					.filter(PackageTranslation.language_id == lang, PackageTranslation.package_id.in_(to_load)).all())
+			for package_id in to_load:
+				descs[package_id] = loaded.get(package_id)
+
+		return {package_id: descs[package_id] for package_id in package_ids}
+
+
+_store = TranslationStore()
+
+
+def get_translation_store() -> TranslationStore:
+	"""
+	Returns the translation store, it's only synced once per request as it may be used many
+	times when rendering lists of packages
+	"""
+	if not has_request_context():
+		_store.sync()
+	elif not g.get("translation_store_synced"):
+		_store.sync()
+		g.translation_store_synced = True
+
+	return _store
@@ -32,6 +32,8 @@ from .packages import *
 from .users import *
 from .threads import *
 from .collections import *
+from .changes import mark_package_changed, mark_entity_changed
+from .registry import get_tag, get_license, get_content_warning, get_language_ids
 
 
 class APIToken(db.Model):
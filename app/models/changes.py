@@ -0,0 +1,141 @@
+# ContentDB
+# Copyright (C) rubenwardy
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import itertools
+from typing import Optional
+
+from sqlalchemy import event, inspect
+from sqlalchemy.orm import Session
+
+from app.rediscache import push_catalogue_changes
+from .packages import Package, PackageRelease, PackageLatestRelease, PackageScreenshot, PackageAlias, PackageTranslation, \
+	PackageGameSupport, Dependency, Tag, License, ContentWarning, MinetestRelease, Language
+from .threads import PackageReview
+from .collections import Collection, CollectionPackage
+from .users import User
+from .registry import invalidate_registry
+
+
+# Records which packages and reference tables each transaction modifies, and pushes them to
+# the catalogue change log once the transaction is committed.
+#
+# Changes are strings, either `package/<id>` or the name of a reference table. Bulk
+# `Query.update()`s aren't seen by the session, use `mark_package_changed` for those.
+
+_CHANGES_KEY = "catalogue_changes"
+
+_PACKAGE_CHILDREN = {
+	PackageRelease: "package_id",
+	PackageScreenshot: "package_id",
+	PackageAlias: "package_id",
+	PackageTranslation: "package_id",
+	PackageGameSupport: "package_id",
+	PackageReview: "package_id",
+	CollectionPackage: "package_id",
+	Dependency: "depender_id",
+}
+
+_ENTITIES = {
+	Tag: "tag",
+	License: "license",
+	ContentWarning: "content_warning",
+	MinetestRelease: "minetest_release",
+	Language: "language",
+	Collection: "collection",
+}
+
+
+def _get_change(obj) -> Optional[str]:
+	if isinstance(obj, Package):
+		return f"package/{obj.id}"
+
+	child_key = _PACKAGE_CHILDREN.get(type(obj))
+	if child_key:
+		package_id = getattr(obj, child_key)
+		return f"package/{package_id}" if package_id is not None else None
+
+	entity = _ENTITIES.get(type(obj))
+	if entity:
+		return entity
+
+	if isinstance(obj, User) and inspect(obj).attrs.username.history.has_changes():
+		return "user"
+
+	return None
+
+
+def mark_package_changed(session: Session, package_id: int):
+	session.info.setdefault(_CHANGES_KEY, set()).add(f"package/{package_id}")
+
+
+def mark_entity_changed(session: Session, entity: str):
+	session.info.setdefault(_CHANGES_KEY, set()).add(entity)
+
+
+@event.listens_for(Session, "after_flush")
+def _record_changes(session: Session, _flush_context):
+	changes = session.info.setdefault(_CHANGES_KEY, set())
+	for obj in itertools.chain(session.new, session.deleted):
+		change = _get_change(obj)
+		if change:
+			changes.add(change)
+
+	for obj in session.dirty:
+		if session.is_modified(obj):
+			change = _get_change(obj)
+			if change:
+				changes.add(change)
+
+
+@event.listens_for(Session, "after_commit")
+def _publish_changes(session: Session):
+	changes = session.info.pop(_CHANGES_KEY, None)
+	if changes:
+		push_catalogue_changes(sorted(changes))
+		if any(not x.startswith("package/") for x in changes):
+			invalidate_registry()
+
+
+@event.listens_for(Session, "after_rollback")
+def _discard_changes(session: Session):
+	session.info.pop(_CHANGES_KEY, None)
+
+
+# Keeps the latest release index up-to-date. This runs in the flush so that the index is
+# committed in the same transaction as the releases.
+
+_RELEASE_ATTRS = ["approved", "min_rel", "min_rel_id", "max_rel", "max_rel_id", "package", "package_id"]
+
+
+@event.listens_for(Session, "after_flush")
+def _update_latest_releases(session: Session, _flush_context):
+	if any(isinstance(obj, MinetestRelease) for obj in session.new):
+		PackageLatestRelease.update(session.connection())
+		return
+
+	package_ids = set()
+	for obj in itertools.chain(session.new, session.deleted):
+		if isinstance(obj, PackageRelease) and obj.package_id is not None:
+			package_ids.add(obj.package_id)
+
+	for obj in session.dirty:
+		if isinstance(obj, PackageRelease):
+			attrs = inspect(obj).attrs
+			if any(attrs[key].history.has_changes() for key in _RELEASE_ATTRS):
+				package_ids.add(obj.package_id)
+
+	if len(package_ids) > 0:
+		PackageLatestRelease.update(session.connection(), package_ids)
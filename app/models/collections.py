@@ -15,6 +15,7 @@
 # along with this program.  If not, see <https://www.gnu.org/licenses/>.
 
 import datetime
+from typing import Optional
 
 from flask import url_for, current_app
 
@@ -34,9 +35,9 @@ class CollectionPackage(db.Model):
 
 	collection_description_nonempty = db.CheckConstraint("description = NULL OR description != ''")
 
-	def as_dict(self):
+	def as_dict(self, package_dict: Optional[dict] = None):
 		return {
-			"package": self.package.as_short_dict(current_app.config["BASE_URL"]),
+			"package": package_dict or self.package.as_short_dict(current_app.config["BASE_URL"]),
 			"order": self.order,
 			"description": self.description,
 			"created_at": self.created_at.isoformat(),
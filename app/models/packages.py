@@ -430,6 +430,12 @@ class Package(db.Model):
 
 	score        = db.Column(db.Float, nullable=False, default=0)
 	score_downloads = db.Column(db.Float, nullable=False, default=0)
+	score_reviews = db.Column(db.Float, nullable=False, default=0)
+
+	# Number of reviews with each rating, see `get_review_summary`
+	reviews_positive = db.Column(db.Integer, nullable=False, default=0)
+	reviews_neutral = db.Column(db.Integer, nullable=False, default=0)
+	reviews_negative = db.Column(db.Integer, nullable=False, default=0)
 	downloads     = db.Column(db.Integer, nullable=False, default=0)
 
 	review_thread_id = db.Column(db.Integer, db.ForeignKey("thread.id"), nullable=True, default=None)
@@ -560,21 +566,18 @@ class Package(db.Model):
 			else:
 				lang = "en"
 
-		translation: typing.Optional[PackageTranslation] = None
+		title, short_desc, desc = None, None, None
 		if lang != "en":
-			translation = self.translations.filter_by(language_id=lang).first()
-
-		if translation is None:
-			return {
-				"title": self.title,
-				"short_desc": self.short_desc,
-				"desc": self.desc if load_desc else None,
-			}
+			from app.logic.translations import get_translation_store
+			store = get_translation_store()
+			title, short_desc = store.get_meta(self.id, lang)
+			if load_desc:
+				desc = store.get_descs([self.id], lang)[self.id]
 
 		return {
-			"title": translation.title or self.title,
-			"short_desc": translation.short_desc or self.short_desc,
-			"desc": (translation.desc or self.desc) if load_desc else None,
+			"title": title or self.title,
+			"short_desc": short_desc or self.short_desc,
+			"desc": (desc or self.desc) if load_desc else None,
 		}
 
 	def get_sorted_dependencies(self, is_hard=None):
@@ -617,95 +620,19 @@ class Package(db.Model):
 			"type": self.type.to_name(),
 		}
 
-	def as_short_dict(self, base_url, version=None, release_id=None, no_load=False, lang="en", include_vcs=False):
-		tnurl = self.get_thumb_url(1, format="png")
-
-		if release_id is None and no_load == False:
-			release = self.get_download_release(version=version)
-			release_id = release and release.id
-
-		meta = self.get_translated(lang, load_desc=False)
-		short_desc = meta["short_desc"]
-		if self.dev_state == PackageDevState.WIP:
-			short_desc = gettext("Work in Progress") + ". " + self.short_desc
-
-		ret = {
-			"name": self.name,
-			"title": meta["title"],
-			"author": self.author.username,
-			"short_description": short_desc,
-			"type": self.type.to_name(),
-			"release": release_id,
-			"thumbnail": (base_url + tnurl) if tnurl is not None else None,
-			"aliases": [alias.as_dict() for alias in self.aliases],
-		}
-
-		if not ret["aliases"]:
-			del ret["aliases"]
-
-		if include_vcs:
-			ret["repo"] = self.repo
-
-		return ret
+	def as_short_dict(self, base_url, version=None, lang="en", include_vcs=False):
+		"""
+		Use `PackageSerializer` directly to serialize more than one package
+		"""
+		from app.logic.serializers import PackageSerializer
+		return PackageSerializer(base_url, version, lang).as_short_dict(self, include_vcs)
 
 	def as_dict(self, base_url, version=None, lang="en", screenshots_dict=False):
-		tnurl = self.get_thumb_url(1, format="png")
-		release = self.get_download_release(version=version)
-		meta = self.get_translated(lang)
-
-		if screenshots_dict:
-			screenshots = [ss.as_short_dict(base_url) for ss in self.screenshots]
-		else:
-			screenshots = [base_url + ss.url for ss in self.screenshots]
-
-		return {
-			"author": self.author.username,
-			"maintainers": [x.username for x in self.maintainers],
-
-			"state": self.state.name,
-			"dev_state": self.dev_state.name if self.dev_state else None,
-
-			"name": self.name,
-			"title": meta["title"],
-			"short_description": meta["short_desc"],
-			"long_description": meta["desc"],
-			"type": self.type.to_name(),
-			"created_at": self.created_at.isoformat(),
-
-			"license": self.license.name,
-			"media_license": self.media_license.name,
-
-			"repo": self.repo,
-			"website": self.website,
-			"issue_tracker": self.issueTracker,
-			"forums": self.forums,
-			"forum_url": self.forums_url,
-			"video_url": self.video_url,
-			"video_thumbnail_url": self.get_video_thumbnail_url(True),
-			"donate_url": self.donate_url_actual,
-			"translation_url": self.translation_url,
-
-			"tags": sorted([x.name for x in self.tags]),
-			"content_warnings": sorted([x.name for x in self.content_warnings]),
-
-			"provides": sorted([x.name for x in self.provides]),
-			"thumbnail": (base_url + tnurl) if tnurl is not None else None,
-			"screenshots": screenshots,
-
-			"url": base_url + self.get_url("packages.download"),
-			"release": release and release.id,
-
-			"score": round(self.score * 10) / 10,
-			"downloads": self.downloads,
-
-			"game_support": [
-				{
-					"supports": support.supports,
-					"confidence": support.confidence,
-					"game": support.game.as_short_dict(base_url, version)
-				} for support in self.supported_games.all()
-			]
-		}
+		"""
+		Use `PackageSerializer` directly to serialize more than one package
+		"""
+		from app.logic.serializers import PackageSerializer
+		return PackageSerializer(base_url, version, lang).as_dict(self, screenshots_dict)
 
 	def get_thumb_or_placeholder(self, level=2, format="webp"):
 		return self.get_thumb_url(level, False, format) or "/static/placeholder.png"
@@ -853,7 +780,7 @@ class Package(db.Model):
 			"name": self.name,
 			"score": self.score,
 			"score_downloads": self.score_downloads,
-			"score_reviews": self.score - self.score_downloads,
+			"score_reviews": self.score_reviews,
 			"downloads": self.downloads,
 			"reviews": {
 				"positive": reviews[0],
@@ -862,9 +789,58 @@ class Package(db.Model):
 			},
 		}
 
-	def recalculate_score(self):
-		review_scores = [ 150 * r.as_weight() for r in self.reviews ]
-		self.score = self.score_downloads + sum(review_scores)
+	def update_review_aggregates(self, old_rating: typing.Optional[int], new_rating: typing.Optional[int]):
+		"""
+		Updates the score and review counts when a review is created (old_rating is None), edited,
+		or deleted (new_rating is None). The updates are done in SQL, so concurrent reviews don't
+		conflict.
+		"""
+		from app.models import PackageReview
+		delta = PackageReview.get_score(new_rating) - PackageReview.get_score(old_rating)
+		if delta != 0:
+			self.score_reviews = Package.score_reviews + delta
+			self.score = Package.score + delta
+
+		old_field = _get_review_count_field(old_rating)
+		new_field = _get_review_count_field(new_rating)
+		if old_field != new_field:
+			if old_field:
+				setattr(self, old_field, getattr(Package, old_field) - 1)
+			if new_field:
+				setattr(self, new_field, getattr(Package, new_field) + 1)
+
+	@staticmethod
+	def decay_scores(factor: float):
+		"""
+		Decays the score from downloads of every package in one statement
+		"""
+		from app.models import mark_entity_changed
+		Package.query.update({
+			"score_downloads": Package.score_downloads * factor,
+			"score": Package.score_downloads * factor + Package.score_reviews,
+		}, synchronize_session=False)
+		mark_entity_changed(db.session, "package_scores")
+
+	@staticmethod
+	def recalculate_review_aggregates():
+		"""
+		Recalculates the score from reviews and the review counts of every package in one
+		statement, this repairs them if they get out of sync with the reviews
+		"""
+		from app.models import PackageReview, mark_entity_changed
+
+		def aggregate(expr):
+			return db.select(expr).where(PackageReview.package_id == Package.id).scalar_subquery()
+
+		score_reviews = aggregate(func.coalesce(func.sum((PackageReview.rating - 3) * (PackageReview.SCORE_FACTOR / 2.0)), 0.0))
+		Package.query.update({
+			"score_reviews": score_reviews,
+			"score": Package.score_downloads + score_reviews,
+			"reviews_positive": aggregate(func.count(PackageReview.id).filter(PackageReview.rating > 3)),
+			"reviews_neutral": aggregate(func.count(PackageReview.id).filter(PackageReview.rating == 3)),
+			"reviews_negative": aggregate(func.count(PackageReview.id).filter(PackageReview.rating < 3)),
+		}, synchronize_session=False)
+		mark_entity_changed(db.session, "package_scores")
 
 	def get_conf_file_name(self):
 		if self.type == PackageType.MOD:
@@ -875,25 +851,18 @@ class Package(db.Model):
 			return "game.conf"
 
 	def get_review_summary(self):
-		from app.models import PackageReview
-		rows = (db.session.query(PackageReview.rating, func.count(PackageReview.id))
-			.select_from(PackageReview)
-			.where(PackageReview.package_id == self.id)
-			.group_by(PackageReview.rating)
-			.all())
-
-		negative = 0
-		neutral = 0
-		positive = 0
-		for rating, count in rows:
-			if rating > 3:
-				positive += count
-			elif rating == 3:
-				neutral += count
-			else:
-				negative += count
+		return [self.reviews_positive, self.reviews_neutral, self.reviews_negative]
+
 
-		return [positive, neutral, negative]
+def _get_review_count_field(rating: typing.Optional[int]) -> typing.Optional[str]:
+	if rating is None:
+		return None
+	elif rating > 3:
+		return "reviews_positive"
+	elif rating == 3:
+		return "reviews_neutral"
+	else:
+		return "reviews_negative"
 
 
 class Language(db.Model):
@@ -1068,25 +1037,8 @@ class MinetestRelease(db.Model):
 
 	@classmethod
 	def get(cls, version: typing.Optional[str], protocol_num: typing.Optional[str]) -> typing.Optional["MinetestRelease"]:
-		if version:
-			parts = version.strip().split(".")
-			if len(parts) >= 2:
-				major_minor = parts[0] + "." + parts[1]
-				query = MinetestRelease.query.filter(MinetestRelease.name.like("{}%".format(major_minor)))
-				if protocol_num:
-					query = query.filter_by(protocol=protocol_num)
-
-				release = query.one_or_none()
-				if release:
-					return release
-
-		if protocol_num:
-			# Find the closest matching release
-			return MinetestRelease.query.order_by(db.desc(MinetestRelease.protocol),
-							db.desc(MinetestRelease.id)) \
-						.filter(MinetestRelease.protocol <= protocol_num).first()
-
-		return None
+		from .registry import find_minetest_release
+		return find_minetest_release(version, protocol_num)
 
 
 class PackageRelease(db.Model):
@@ -1246,6 +1198,69 @@ class PackageRelease(db.Model):
 			raise Exception("Permission {} is not related to releases".format(perm.name))
 
 
+class PackageLatestRelease(db.Model):
+	"""
+	Index of the latest approved release of each package for each MinetestRelease. A null
+	minetest_release_id is the latest release for any version.
+
+	Kept up-to-date when releases are changed, see app/models/changes.py
+	"""
+
+	id = db.Column(db.Integer, primary_key=True)
+
+	package_id = db.Column(db.Integer, db.ForeignKey("package.id", ondelete="CASCADE"), nullable=False)
+	minetest_release_id = db.Column(db.Integer, db.ForeignKey("minetest_release.id", ondelete="CASCADE"), nullable=True)
+	release_id = db.Column(db.Integer, db.ForeignKey("package_release.id", ondelete="CASCADE"), nullable=False)
+
+	__table_args__ = (db.Index("ix_package_latest_release_version", "minetest_release_id", "package_id"),)
+
+	@staticmethod
+	def update(conn, package_ids: typing.Optional[typing.Iterable[int]] = None):
+		"""
+		Recalculates the index for the given packages, or all packages if package_ids is None
+		"""
+
+		any_version = db.select(PackageRelease.package_id, db.null(), func.max(PackageRelease.id)) \
+			.filter(PackageRelease.approved == True) \
+			.group_by(PackageRelease.package_id)
+
+		per_version = db.select(PackageRelease.package_id, MinetestRelease.id, func.max(PackageRelease.id)) \
+			.select_from(PackageRelease) \
+			.join(MinetestRelease, db.and_(
+				or_(PackageRelease.min_rel_id == None, PackageRelease.min_rel_id <= MinetestRelease.id),
+				or_(PackageRelease.max_rel_id == None, PackageRelease.max_rel_id >= MinetestRelease.id))) \
+			.filter(PackageRelease.approved == True) \
+			.group_by(PackageRelease.package_id, MinetestRelease.id)
+
+		delete = db.delete(PackageLatestRelease)
+
+		if package_ids is not None:
+			package_ids = sorted(package_ids)
+			if len(package_ids) == 0:
+				return
+
+			# Lock the packages to prevent concurrent updates from duplicating rows
+			conn.execute(db.select(Package.id).filter(Package.id.in_(package_ids)).order_by(Package.id).with_for_update())
+
+			any_version = any_version.filter(PackageRelease.package_id.in_(package_ids))
+			per_version = per_version.filter(PackageRelease.package_id.in_(package_ids))
+			delete = delete.where(PackageLatestRelease.package_id.in_(package_ids))
+
+		columns = ["package_id", "minetest_release_id", "release_id"]
+		conn.execute(delete)
+		conn.execute(db.insert(PackageLatestRelease).from_select(columns, any_version))
+		conn.execute(db.insert(PackageLatestRelease).from_select(columns, per_version))
+
+	@staticmethod
+	def get_all(version: typing.Optional[MinetestRelease]) -> typing.List[typing.Tuple[int, int]]:
+		"""
+		Returns (package_id, release_id) for the latest release of each package supporting version
+		"""
+		return db.session.query(PackageLatestRelease.package_id, PackageLatestRelease.release_id) \
+			.filter(PackageLatestRelease.minetest_release_id == (version.id if version else None)) \
+			.all()
+
+
 class PackageScreenshot(db.Model):
 	HARD_MIN_SIZE = (920, 517)
 	SOFT_MIN_SIZE = (1280, 720)
@@ -1307,7 +1322,11 @@ class PackageScreenshot(db.Model):
 				id=self.id)
 
 	def get_thumb_url(self, level=2, format="webp"):
-		url = self.url.replace("/uploads/", "/thumbnails/{:d}/".format(level))
+		return PackageScreenshot.make_thumb_url(self.url, level, format)
+
+	@staticmethod
+	def make_thumb_url(upload_url: str, level=2, format="webp"):
+		url = upload_url.replace("/uploads/", "/thumbnails/{:d}/".format(level))
 		if format is not None:
 			start = url[:url.rfind(".")]
 			url = f"{start}.{format}"
@@ -1438,36 +1457,158 @@ class PackageDailyStats(db.Model):
 	reason_dependency = db.Column(db.Integer, nullable=False, default=0)
 	reason_update = db.Column(db.Integer, nullable=False, default=0)
 
+	COUNT_FIELDS = ["platform_minetest", "platform_other", "reason_new", "reason_dependency", "reason_update"]
+
 	@staticmethod
-	def update(package: Package, is_minetest: bool, reason: str):
-		date = datetime.datetime.utcnow().date()
+	def add_counts(conn, rows: typing.List[dict]):
+		"""
+		Adds to the counts of many days at once, and to the weekly, monthly, and author rollups.
+		Each row is a dictionary with `package_id`, `date`, and any of COUNT_FIELDS.
+		"""
+		if len(rows) == 0:
+			return
 
-		to_update = dict()
-		kwargs = {
-			"package_id": package.id, "date": date
-		}
+		package_ids = set([row["package_id"] for row in rows])
+		author_ids = dict(conn.execute(db.select(Package.id, Package.author_id).where(Package.id.in_(package_ids))).all())
+
+		daily = {}
+		package_rollups = {}
+		author_rollups = {}
+
+		for row in rows:
+			package_id = row["package_id"]
+			author_id = author_ids.get(package_id)
+			if author_id is None:
+				continue
+
+			_add_counts(daily, (package_id, row["date"]), row)
+			_add_counts(author_rollups, (author_id, "day", row["date"]), row)
+			for granularity in ["week", "month"]:
+				date = get_stats_period_start(row["date"], granularity)
+				_add_counts(package_rollups, (package_id, granularity, date), row)
+				_add_counts(author_rollups, (author_id, granularity, date), row)
+
+		# Rows are sorted to lock them in a consistent order
+		_upsert_counts(conn, PackageDailyStats, ["package_id", "date"], daily)
+		_upsert_counts(conn, PackageStatsRollup, ["package_id", "granularity", "date"], package_rollups)
+		_upsert_counts(conn, AuthorStatsRollup, ["author_id", "granularity", "date"], author_rollups)
+
+	@staticmethod
+	def move_author_rollups(conn, package_id: int, old_author_id: int, new_author_id: int):
+		"""
+		Moves a package's counts from the old author's rollups to the new author's, call this in the
+		same transaction as changing the package's author.
+		"""
+		if old_author_id == new_author_id:
+			return
+
+		fields = PackageDailyStats.COUNT_FIELDS
+		rows = conn.execute(db.select(PackageDailyStats.date, *[getattr(PackageDailyStats, field) for field in fields])
+				.where(PackageDailyStats.package_id == package_id)).all()
+
+		author_rollups = {}
+		for row in rows:
+			counts = row._asdict()
+			removed = { field: -counts[field] for field in fields }
+			for granularity in STATS_GRANULARITIES:
+				date = get_stats_period_start(row.date, granularity)
+				_add_counts(author_rollups, (old_author_id, granularity, date), removed)
+				_add_counts(author_rollups, (new_author_id, granularity, date), counts)
+
+		# Negative counts are added to the old author's existing rows
+		_upsert_counts(conn, AuthorStatsRollup, ["author_id", "granularity", "date"], author_rollups)
+
+	@staticmethod
+	def rebuild_rollups(conn):
+		"""
+		Recalculates PackageStatsRollup and AuthorStatsRollup from the daily stats, ie: if they
+		have become inconsistent.
+		"""
+		fields = PackageDailyStats.COUNT_FIELDS
+		sums = [func.sum(getattr(PackageDailyStats, field)).label(field) for field in fields]
+
+		conn.execute(db.delete(PackageStatsRollup))
+		conn.execute(db.delete(AuthorStatsRollup))
+
+		for granularity in ["day", "week", "month"]:
+			date = func.date_trunc(granularity, PackageDailyStats.date).cast(db.Date).label("date")
+
+			if granularity != "day":
+				conn.execute(db.insert(PackageStatsRollup).from_select(["package_id", "granularity", "date"] + fields,
+						db.select(PackageDailyStats.package_id, db.literal(granularity), date, *sums)
+							.group_by(PackageDailyStats.package_id, date)))
+
+			conn.execute(db.insert(AuthorStatsRollup).from_select(["author_id", "granularity", "date"] + fields,
+					db.select(Package.author_id, db.literal(granularity), date, *sums)
+						.select_from(PackageDailyStats).join(Package, Package.id == PackageDailyStats.package_id)
+						.group_by(Package.author_id, date)))
+
+
+STATS_GRANULARITIES = ["day", "week", "month"]
+
+
+def get_stats_period_start(date: datetime.date, granularity: str) -> datetime.date:
+	"""Weeks start on Monday, like Postgres' date_trunc"""
+	if granularity == "week":
+		return date - datetime.timedelta(days=date.weekday())
+	elif granularity == "month":
+		return date.replace(day=1)
+	else:
+		return date
 
-		field_platform = "platform_minetest" if is_minetest else "platform_other"
-		to_update[field_platform] = getattr(PackageDailyStats, field_platform) + 1
-		kwargs[field_platform] = 1
-
-		field_reason = None
-		if reason == "new":
-			field_reason = "reason_new"
-		elif reason == "dependency":
-			field_reason = "reason_dependency"
-		elif reason == "update":
-			field_reason = "reason_update"
-
-		if field_reason:
-			to_update[field_reason] = getattr(PackageDailyStats, field_reason) + 1
-			kwargs[field_reason] = 1
-
-		stmt = insert(PackageDailyStats).values(**kwargs)
-		stmt = stmt.on_conflict_do_update(
-			index_elements=[PackageDailyStats.package_id, PackageDailyStats.date],
-			set_=to_update
-		)
-
-		conn = db.session.connection()
-		conn.execute(stmt)
+
+def _add_counts(to: typing.Dict[tuple, dict], key: tuple, row: dict):
+	counts = to.get(key)
+	if counts is None:
+		counts = to[key] = dict.fromkeys(PackageDailyStats.COUNT_FIELDS, 0)
+	for field in PackageDailyStats.COUNT_FIELDS:
+		counts[field] += row.get(field, 0)
+
+
+def _upsert_counts(conn, model, keys: typing.List[str], rows: typing.Dict[tuple, dict]):
+	if len(rows) == 0:
+		return
+
+	values = [dict(zip(keys, key), **counts) for key, counts in sorted(rows.items())]
+	stmt = insert(model).values(values)
+	stmt = stmt.on_conflict_do_update(
+		index_elements=[getattr(model, key) for key in keys],
+		set_={ field: getattr(model, field) + getattr(stmt.excluded, field) for field in PackageDailyStats.COUNT_FIELDS }
+	)
+
+	conn.execute(stmt)
+
+
+class PackageStatsRollup(db.Model):
+	"""
+	Weekly and monthly sums of PackageDailyStats, maintained by `PackageDailyStats.add_counts`.
+	`date` is the first day of the period.
+	"""
+	package_id = db.Column(db.Integer, db.ForeignKey("package.id", ondelete="CASCADE"), primary_key=True)
+	package = db.relationship("Package", foreign_keys=[package_id])
+	granularity = db.Column(db.String(5), primary_key=True)
+	date = db.Column(db.Date, primary_key=True)
+
+	platform_minetest = db.Column(db.Integer, nullable=False, default=0)
+	platform_other = db.Column(db.Integer, nullable=False, default=0)
+
+	reason_new = db.Column(db.Integer, nullable=False, default=0)
+	reason_dependency = db.Column(db.Integer, nullable=False, default=0)
+	reason_update = db.Column(db.Integer, nullable=False, default=0)
+
+
+class AuthorStatsRollup(db.Model):
+	"""
+	Daily, weekly, and monthly sums of PackageDailyStats over each author's packages, maintained by
+	`PackageDailyStats.add_counts`. `date` is the first day of the period.
+	"""
+	author_id = db.Column(db.Integer, db.ForeignKey("user.id", ondelete="CASCADE"), primary_key=True)
+	granularity = db.Column(db.String(5), primary_key=True)
+	date = db.Column(db.Date, primary_key=True)
+
+	platform_minetest = db.Column(db.Integer, nullable=False, default=0)
+	platform_other = db.Column(db.Integer, nullable=False, default=0)
+
+	reason_new = db.Column(db.Integer, nullable=False, default=0)
+	reason_dependency = db.Column(db.Integer, nullable=False, default=0)
+	reason_update = db.Column(db.Integer, nullable=False, default=0)
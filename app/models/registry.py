@@ -0,0 +1,129 @@
+# ContentDB
+# Copyright (C) rubenwardy
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import threading
+import time
+from typing import Dict, List, Optional, Set
+
+from sqlalchemy.orm import Session
+
+from app.rediscache import get_catalogue_changes
+from . import db
+from .packages import Tag, License, ContentWarning, Language, MinetestRelease
+
+
+# Process-local copy of the small reference tables, so that looking them up doesn't need SQL.
+#
+# The objects are loaded in their own session and are detached, lookups merge them into
+# `db.session` so that they can be used like any other object. Commits in this process
+# invalidate the registry straight away, changes from other processes are picked up from the
+# catalogue change log within SYNC_INTERVAL_S.
+
+SYNC_INTERVAL_S = 1
+
+ENTITIES = {"tag", "license", "content_warning", "language", "minetest_release"}
+
+
+class _Registry:
+	revision: Optional[int] = None
+	checked_at: float = 0
+	tags: Dict[str, Tag]
+	licenses: Dict[str, License]
+	content_warnings: Dict[str, ContentWarning]
+	languages: Dict[str, Language]
+	minetest_releases: List[MinetestRelease]
+
+	def __init__(self):
+		self.lock = threading.Lock()
+
+	def invalidate(self):
+		self.revision = None
+
+	def sync(self):
+		now = time.monotonic()
+		if self.revision is not None and now - self.checked_at < SYNC_INTERVAL_S:
+			return
+
+		with self.lock:
+			revision, changes = get_catalogue_changes(self.revision if self.revision is not None else -1)
+			self.checked_at = now
+			if self.revision is not None and changes is not None and len(ENTITIES.intersection(changes)) == 0:
+				self.revision = revision
+				return
+
+			with Session(db.engine) as session:
+				self.tags = {x.name: x for x in session.query(Tag).all()}
+				self.licenses = {x.name.lower(): x for x in session.query(License).all()}
+				self.content_warnings = {x.name: x for x in session.query(ContentWarning).all()}
+				self.languages = {x.id: x for x in session.query(Language).all()}
+				self.minetest_releases = session.query(MinetestRelease).order_by(db.asc(MinetestRelease.id)).all()
+
+			self.revision = revision
+
+
+_registry = _Registry()
+
+
+def _merge(obj):
+	return db.session.merge(obj, load=False) if obj is not None else None
+
+
+def invalidate_registry():
+	_registry.invalidate()
+
+
+def get_tag(name: str) -> Optional[Tag]:
+	_registry.sync()
+	return _merge(_registry.tags.get(name))
+
+
+def get_license(name: str) -> Optional[License]:
+	"""Case-insensitive"""
+	_registry.sync()
+	return _merge(_registry.licenses.get(name.lower()))
+
+
+def get_content_warning(name: str) -> Optional[ContentWarning]:
+	_registry.sync()
+	return _merge(_registry.content_warnings.get(name))
+
+
+def get_language_ids() -> Set[str]:
+	_registry.sync()
+	return set(_registry.languages.keys())
+
+
+def find_minetest_release(version: Optional[str], protocol_num: Optional[int]) -> Optional[MinetestRelease]:
+	"""See `MinetestRelease.get`"""
+	_registry.sync()
+	releases = _registry.minetest_releases
+
+	if version:
+		parts = version.strip().split(".")
+		if len(parts) >= 2:
+			major_minor = parts[0] + "." + parts[1]
+			matches = [x for x in releases if x.name.startswith(major_minor) and
+					(not protocol_num or x.protocol == int(protocol_num))]
+			if len(matches) == 1:
+				return _merge(matches[0])
+
+	if protocol_num:
+		# Find the closest matching release
+		matches = [x for x in releases if x.protocol <= int(protocol_num)]
+		if len(matches) > 0:
+			return _merge(max(matches, key=lambda x: (x.protocol, x.id)))
+
+	return None
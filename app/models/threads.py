@@ -15,7 +15,7 @@
 # along with this program.  If not, see <https://www.gnu.org/licenses/>.
 
 import datetime
-from typing import Tuple, List
+from typing import Tuple, List, Optional
 
 from flask import url_for
 from sqlalchemy import select, func, text
@@ -194,6 +194,9 @@ class PackageReview(db.Model):
 
 	score      = db.Column(db.Integer, nullable=False, default=1)
 
+	# Each review adds its weight multiplied by this to the package's score
+	SCORE_FACTOR = 150
+
 	def get_totals(self, current_user = None) -> Tuple[int,int,bool]:
 		votes: List[PackageReviewVote] = self.votes
 		pos = sum([ 1 for vote in votes if vote.is_positive ])
@@ -234,6 +237,15 @@ class PackageReview(db.Model):
 		"""
 		return (self.rating - 3.0) / 2.0
 
+	@staticmethod
+	def get_score(rating: Optional[int]) -> float:
+		"""
+		The amount a review with `rating` adds to the package's score, None means no review
+		"""
+		if rating is None:
+			return 0
+		return PackageReview.SCORE_FACTOR * (rating - 3.0) / 2.0
+
 	def get_edit_url(self):
 		return self.package.get_url("packages.review")
 
@@ -15,16 +15,32 @@
 # along with this program.  If not, see <https://www.gnu.org/licenses/>.
 
 from typing import Optional, List
-from flask import abort, current_app, request, make_response
+from flask import abort, request, make_response
 from flask_babel import lazy_gettext, gettext, get_locale
-from sqlalchemy import or_, and_
-from sqlalchemy.orm import subqueryload
+from sqlalchemy import or_, and_, false, bindparam
+from sqlalchemy.dialects import postgresql
+from sqlalchemy.orm import selectinload
 from sqlalchemy.sql.expression import func
 from sqlalchemy_searchable import search
 
 from .models import db, PackageType, Package, ForumTopic, License, MinetestRelease, PackageRelease, User, Tag, \
-	ContentWarning, PackageState, PackageDevState
+	ContentWarning, PackageState, PackageDevState, get_tag, get_license, get_content_warning
 from .utils import is_yes, get_int_or_abort
+from .utils.pagination import KeysetKeys
+
+
+def _filter_by_ids_in_order(query, package_ids: List[int]):
+	"""
+	Filters the query to the given packages, ordered like package_ids. The ids are joined with
+	their position, as array_position would search the whole array for each row.
+	"""
+	if len(package_ids) == 0:
+		return query.filter(false())
+
+	# The ids are bound as one array parameter, so the statement is the same however many there are
+	ids = func.unnest(bindparam("package_ids", package_ids, type_=postgresql.ARRAY(db.Integer))) \
+		.table_valued("id", with_ordinality="position").render_derived()
+	return query.join(ids, ids.c.id == Package.id).order_by(ids.c.position)
 
 
 class QueryBuilder:
@@ -106,7 +122,7 @@ class QueryBuilder:
 
 		# Get tags types
 		tags = args.getlist("tag")
-		tags = [Tag.query.filter_by(name=tname).first() for tname in tags]
+		tags = [get_tag(tname) for tname in tags]
 		if not emit_http_errors:
 			tags = [tag for tag in tags if tag is not None]
 		elif any([tag is None for tag in tags]):
@@ -117,7 +133,7 @@ class QueryBuilder:
 
 		self.hide_tags = []
 		for flag in set(self.hide_flags):
-			tag = Tag.query.filter_by(name=flag).first()
+			tag = get_tag(flag)
 			if tag is not None:
 				self.hide_tags.append(tag)
 				self.hide_flags.remove(flag)
@@ -126,7 +142,7 @@ class QueryBuilder:
 		self.flags = set(args.getlist("flag"))
 
 		# License
-		self.licenses = [License.query.filter(func.lower(License.name) == name.lower()).first() for name in args.getlist("license")]
+		self.licenses = [get_license(name) for name in args.getlist("license")]
 		if emit_http_errors and any(map(lambda x: x is None, self.licenses)):
 			all_licenses = db.session.query(License.name).order_by(db.asc(License.name)).all()
 			all_licenses = [x[0] for x in all_licenses]
@@ -199,33 +215,22 @@ class QueryBuilder:
 			self.order_by = name
 			self.order_dir = dir
 
-	def get_releases(self):
-		releases_query = db.session.query(PackageRelease.package_id, func.max(PackageRelease.id)) \
-			.select_from(PackageRelease).filter(PackageRelease.approved) \
-			.group_by(PackageRelease.package_id)
-
-		if self.version:
-			releases_query = releases_query \
-				.filter(or_(PackageRelease.min_rel_id==None,
-					PackageRelease.min_rel_id <= self.version.id)) \
-				.filter(or_(PackageRelease.max_rel_id==None,
-					PackageRelease.max_rel_id >= self.version.id))
-
-		return releases_query.all()
+	def get_package_ids(self) -> List[int]:
+		"""
+		Returns the ids of the matching packages in order, using the in-memory catalogue
+		"""
+		from app.logic.catalogue import get_catalogue
+		return [entry.id for entry in get_catalogue().query(self)]
 
-	def convert_to_dictionary(self, packages, include_vcs: bool):
-		releases = {}
-		for [package_id, release_id] in self.get_releases():
-			releases[package_id] = release_id
-
-		def to_json(package: Package):
-			release_id = releases.get(package.id)
-			return package.as_short_dict(current_app.config["BASE_URL"], release_id=release_id, no_load=True,
-					lang=self.lang, include_vcs=include_vcs)
+	def build_package_query(self):
+		if self.only_approved and self.order_by != "last_release":
+			# Filter and order in memory, so the database only needs to load the packages by id. The
+			# state is checked again in case the catalogue hasn't seen a package being unapproved yet
+			query = _filter_by_ids_in_order(Package.query, self.get_package_ids()) \
+				.filter(Package.state == PackageState.APPROVED)
 
-		return [to_json(pkg) for pkg in packages]
+			return query.options(selectinload(Package.main_screenshot), selectinload(Package.aliases))
 
-	def build_package_query(self):
 		if self.order_by == "last_release":
 			query = db.session.query(Package).select_from(PackageRelease).join(Package)
 		else:
@@ -234,7 +239,7 @@ class QueryBuilder:
 		if self.only_approved:
 			query = query.filter(Package.state == PackageState.APPROVED)
 
-		query = query.options(subqueryload(Package.main_screenshot), subqueryload(Package.aliases))
+		query = query.options(selectinload(Package.main_screenshot), selectinload(Package.aliases))
 
 		query = self.order_package_query(self.filter_package_query(query))
 
@@ -270,7 +275,7 @@ class QueryBuilder:
 			query = query.filter(~ Package.content_warnings.any())
 		else:
 			for flag in self.hide_flags:
-				warning = ContentWarning.query.filter_by(name=flag).first()
+				warning = get_content_warning(flag)
 				if warning:
 					query = query.filter(~ Package.content_warnings.any(ContentWarning.id == warning.id))
 				elif self.emit_http_errors:
@@ -292,7 +297,7 @@ class QueryBuilder:
 			flags.discard("*")
 		else:
 			for flag in flags:
-				warning = ContentWarning.query.filter_by(name=flag).first()
+				warning = get_content_warning(flag)
 				if warning:
 					query = query.filter(Package.content_warnings.any(ContentWarning.id == warning.id))
 
@@ -318,7 +323,16 @@ class QueryBuilder:
 		return query
 
 	def order_package_query(self, query):
-		if self.search:
+		if self.search and self.only_approved:
+			# The search index only contains approved packages
+			from app.logic.catalogue import get_catalogue
+			ranks = get_catalogue().search(self.search)
+			package_ids = sorted(ranks.keys(), key=lambda x: ranks[x], reverse=True)
+			if self.order_by is None:
+				query = _filter_by_ids_in_order(query, package_ids)
+			else:
+				query = query.filter(Package.id.in_(package_ids))
+		elif self.search:
 			query = search(query, self.search, sort=self.order_by is None)
 
 		if self.random:
@@ -328,25 +342,10 @@ class QueryBuilder:
 		to_order = None
 		if self.order_by is None and self.search:
 			pass
-		elif self.order_by is None or self.order_by == "score":
-			to_order = Package.score
-		elif self.order_by == "reviews":
-			query = query.filter(Package.reviews.any())
-			to_order = (Package.score - Package.score_downloads)
-		elif self.order_by == "name":
-			to_order = Package.name
-		elif self.order_by == "title":
-			to_order = Package.title
-		elif self.order_by == "downloads":
-			to_order = Package.downloads
-		elif self.order_by == "created_at" or self.order_by == "date":
-			to_order = Package.created_at
-		elif self.order_by == "approved_at" or self.order_by == "date":
-			to_order = Package.approved_at
-		elif self.order_by == "last_release":
-			to_order = PackageRelease.created_at
 		else:
-			abort(400)
+			if self.order_by == "reviews":
+				query = query.filter(Package.reviews.any())
+			to_order = self.get_order_column()
 
 		if to_order is not None:
 			if self.order_dir == "asc":
@@ -360,6 +359,39 @@ class QueryBuilder:
 
 		return query
 
+	def get_order_column(self):
+		if self.order_by is None or self.order_by == "score":
+			return Package.score
+		elif self.order_by == "reviews":
+			return Package.score - Package.score_downloads
+		elif self.order_by == "name":
+			return Package.name
+		elif self.order_by == "title":
+			return Package.title
+		elif self.order_by == "downloads":
+			return Package.downloads
+		elif self.order_by == "created_at" or self.order_by == "date":
+			return Package.created_at
+		elif self.order_by == "approved_at":
+			return Package.approved_at
+		elif self.order_by == "last_release":
+			return PackageRelease.created_at
+		else:
+			abort(400)
+
+	def get_keyset_keys(self) -> Optional[KeysetKeys]:
+		"""
+		Returns the sort keys for keyset pagination, or None if the order doesn't support it
+		"""
+		if self.search or self.random or self.limit or self.order_by == "last_release":
+			return None
+
+		if self.order_dir != "asc" and self.order_dir != "desc":
+			abort(400)
+
+		desc = self.order_dir == "desc"
+		return [(self.get_order_column(), desc), (Package.id, desc)]
+
 	def build_topic_query(self, show_added=False):
 		query = ForumTopic.query
 
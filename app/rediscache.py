@@ -14,6 +14,11 @@
 # You should have received a copy of the GNU Affero General Public License
 # along with this program.  If not, see <https://www.gnu.org/licenses/>.
 
+import hashlib
+import math
+import time
+import typing
+
 from . import redis_client
 
 # This file acts as a facade between the rest of the code and redis,
@@ -41,3 +46,461 @@ def increment_key(key):
 
 def get_key(key, default=None):
 	return redis_client.get(key) or default
+
+
+def get_lock(name: str, timeout: int):
+	"""
+	Returns a lock shared between processes, which is released after `timeout` seconds if the
+	holder doesn't release it
+	"""
+	return redis_client.lock(f"lock/{name}", timeout=timeout)
+
+
+# The catalogue change log is used to keep in-process caches up-to-date across workers.
+# Each committed transaction increments the revision and records the changes it made, see
+# app/models/changes.py. Only the most recent changes are kept, a reader that falls too far
+# behind needs to do a full reload.
+
+CATALOGUE_REVISION_KEY = "catalogue/revision"
+CATALOGUE_CHANGES_KEY = "catalogue/changes"
+CATALOGUE_MAX_CHANGES = 5000
+
+_push_changes_script = redis_client.register_script("""
+local revision = redis.call("INCR", KEYS[1])
+local evict = { ARGV[2] }
+for i = 3, #ARGV do
+	redis.call("ZADD", KEYS[2], revision, revision .. ":" .. ARGV[i])
+	table.insert(evict, ARGV[i])
+end
+redis.call("ZREMRANGEBYRANK", KEYS[2], 0, -tonumber(ARGV[1]) - 1)
+
+for _, tag in ipairs(evict) do
+	local tag_key = KEYS[3] .. tag
+	local keys = redis.call("SMEMBERS", tag_key)
+	for _, key in ipairs(keys) do
+		redis.call("DEL", key)
+	end
+	redis.call("DEL", tag_key)
+end
+
+return revision
+""")
+
+
+def push_catalogue_changes(changes: typing.Iterable[str]) -> int:
+	changes = list(changes)
+	return int(_push_changes_script(keys=[CATALOGUE_REVISION_KEY, CATALOGUE_CHANGES_KEY, RESPONSE_TAG_PREFIX],
+			args=[CATALOGUE_MAX_CHANGES + len(changes), RESPONSE_TAG_ANY] + changes))
+
+
+def get_catalogue_revision() -> int:
+	return int(redis_client.get(CATALOGUE_REVISION_KEY) or 0)
+
+
+def get_catalogue_changes(since: int) -> typing.Tuple[int, typing.Optional[typing.Set[str]]]:
+	"""
+	Returns the current revision and the changes made after revision `since`.
+	The changes are None if they're no longer available, meaning a full reload is needed.
+	"""
+
+	pipe = redis_client.pipeline()
+	pipe.get(CATALOGUE_REVISION_KEY)
+	pipe.zrange(CATALOGUE_CHANGES_KEY, 0, 0, withscores=True)
+	pipe.zrangebyscore(CATALOGUE_CHANGES_KEY, f"({since}", "+inf")
+	revision, oldest, entries = pipe.execute()
+
+	revision = int(revision or 0)
+	if revision == since:
+		return revision, set()
+	elif revision < since or len(oldest) == 0 or oldest[0][1] > since:
+		return revision, None
+
+	return revision, set([entry.decode("utf-8").split(":", 1)[1] for entry in entries])
+
+
+# Shared cache of API responses. Each response is tagged with the catalogue changes that
+# invalidate it, see `push_catalogue_changes`. Responses tagged with RESPONSE_TAG_ANY are
+# removed on any change.
+
+RESPONSE_KEY_PREFIX = "response/"
+RESPONSE_TAG_PREFIX = "response_tags/"
+RESPONSE_TAG_ANY = "*"
+
+_set_response_script = redis_client.register_script("""
+if tonumber(redis.call("GET", KEYS[1]) or "0") ~= tonumber(ARGV[1]) then
+	return 0
+end
+
+local expiry = tonumber(ARGV[2])
+redis.call("HSET", KEYS[2], "mimetype", ARGV[3], "vary", ARGV[4], "data", ARGV[5])
+redis.call("EXPIRE", KEYS[2], expiry)
+for i = 6, #ARGV do
+	local tag_key = KEYS[3] .. ARGV[i]
+	redis.call("SADD", tag_key, KEYS[2])
+	if redis.call("TTL", tag_key) < expiry then
+		redis.call("EXPIRE", tag_key, expiry)
+	end
+end
+return 1
+""")
+
+
+def get_cached_response(key: str) -> typing.Optional[typing.Tuple[str, str, bytes]]:
+	"""Returns (mimetype, vary, data) or None"""
+	value = redis_client.hgetall(RESPONSE_KEY_PREFIX + key)
+	if not value:
+		return None
+
+	return value[b"mimetype"].decode("utf-8"), value[b"vary"].decode("utf-8"), value[b"data"]
+
+
+def set_cached_response(key: str, revision: int, expiry: int, tags: typing.Iterable[str],
+		mimetype: str, vary: str, data: bytes) -> bool:
+	"""
+	Caches a response that was generated at catalogue revision `revision`. Nothing is cached if
+	the catalogue has changed since, as the response may be out of date.
+	"""
+	return bool(_set_response_script(keys=[CATALOGUE_REVISION_KEY, RESPONSE_KEY_PREFIX + key, RESPONSE_TAG_PREFIX],
+			args=[revision, expiry, mimetype, vary, data] + list(tags)))
+
+
+# Rotating Bloom filters are used to remember which IPs have done something recently, such as
+# downloading a package, without needing a key per IP. Each filter is split into buckets of
+# `period_s` seconds. Items are added to the current bucket, and checked against the last
+# `periods` buckets. Old buckets expire, so memory use is bounded by the number of buckets
+# times the bucket size, which is derived from the expected items per bucket and error rate.
+
+BLOOM_KEY_PREFIX = "bloom/"
+
+# Checks whether the item is in any of the buckets KEYS[first_key..], and adds it to the
+# first bucket if not. ARGV[first_arg] is the expiry, and the rest of ARGV are the bit offsets.
+_BLOOM_ADD_LUA = """
+local function bloom_add(first_key, first_arg)
+	for k = first_key, #KEYS do
+		local seen = true
+		for i = first_arg + 1, #ARGV do
+			if redis.call("GETBIT", KEYS[k], ARGV[i]) == 0 then
+				seen = false
+				break
+			end
+		end
+
+		if seen then
+			return false
+		end
+	end
+
+	for i = first_arg + 1, #ARGV do
+		redis.call("SETBIT", KEYS[first_key], ARGV[i], 1)
+	end
+	redis.call("EXPIRE", KEYS[first_key], ARGV[first_arg])
+	return true
+end
+"""
+
+_bloom_add_script = redis_client.register_script(_BLOOM_ADD_LUA + """
+if bloom_add(1, 1) then
+	return 1
+end
+return 0
+""")
+
+
+class RotatingBloomFilter:
+	name: str
+	capacity: int
+	error_rate: float
+	period_s: int
+	periods: int
+
+	# Number of bits per bucket
+	size: int
+
+	# Number of hash functions
+	hashes: int
+
+	def __init__(self, name: str, capacity: int, error_rate: float, period_s: int, periods: int):
+		"""
+		`capacity` is the expected number of items added per period, and `error_rate` is the
+		acceptable probability of a new item being reported as seen.
+		"""
+		self.name = name
+		self.capacity = capacity
+		self.error_rate = error_rate
+		self.period_s = period_s
+		self.periods = periods
+
+		# Items are checked against every bucket, so the error rate is split between them
+		bucket_error_rate = error_rate / periods
+		self.size = math.ceil(-capacity * math.log(bucket_error_rate) / (math.log(2) ** 2))
+		self.hashes = max(1, round(self.size / capacity * math.log(2)))
+
+	def get_keys(self) -> typing.List[str]:
+		"""Bucket keys, newest first"""
+		current = int(time.time()) // self.period_s
+		return [f"{BLOOM_KEY_PREFIX}{self.name}/{current - i}" for i in range(self.periods)]
+
+	def get_offsets(self, item: str) -> typing.List[int]:
+		digest = hashlib.blake2b(item.encode("utf-8"), digest_size=16).digest()
+		h1 = int.from_bytes(digest[:8], "little")
+		h2 = int.from_bytes(digest[8:], "little") | 1
+		return [(h1 + i * h2) % self.size for i in range(self.hashes)]
+
+	def get_expiry(self) -> int:
+		return self.period_s * self.periods
+
+	def add(self, item: str) -> bool:
+		"""
+		Adds an item, returns True if it wasn't seen in the last `periods` periods.
+		This is a single round-trip to Redis.
+		"""
+		return bool(_bloom_add_script(keys=self.get_keys(), args=[self.get_expiry()] + self.get_offsets(item)))
+
+	def get_stats(self) -> dict:
+		keys = self.get_keys()
+
+		pipe = redis_client.pipeline()
+		for key in keys:
+			pipe.bitcount(key)
+			pipe.strlen(key)
+		results = pipe.execute()
+
+		memory_bytes = 0
+		items = 0
+		error_rate = 1.0
+		for i in range(len(keys)):
+			bits_set, size_bytes = results[i * 2], results[i * 2 + 1]
+			memory_bytes += size_bytes
+
+			fill = bits_set / self.size
+			if fill < 1:
+				items += -self.size / self.hashes * math.log(1 - fill)
+
+			error_rate *= 1 - fill ** self.hashes
+
+		return {
+			"name": self.name,
+			"buckets": len(keys),
+			"period_s": self.period_s,
+			"bits_per_bucket": self.size,
+			"hashes": self.hashes,
+			"capacity_per_bucket": self.capacity,
+			"target_error_rate": self.error_rate,
+			"estimated_error_rate": 1 - error_rate,
+			"estimated_items": round(items),
+			"memory_bytes": memory_bytes,
+		}
+
+
+downloads_filter = RotatingBloomFilter("downloads", 1000000, 0.01, 24*60*60, EXPIRY_TIME_S // (24*60*60))
+tag_views_filter = RotatingBloomFilter("tag_views", 200000, 0.01, 24*60*60, EXPIRY_TIME_S // (24*60*60))
+
+
+def get_bloom_filters() -> typing.List[RotatingBloomFilter]:
+	return [downloads_filter, tag_views_filter]
+
+
+def add_tag_view(ip: str, tag_name: str) -> bool:
+	"""Returns True if the IP hasn't recently viewed the tag"""
+	return tag_views_filter.add(f"{ip}/{tag_name}")
+
+
+# Downloads are recorded as events in a list, and applied to the database in batches by
+# `app.logic.downloads.flush_download_events`. Each event is a comma-separated string:
+# `package_id,release_id,date,is_minetest,reason,is_unique`.
+#
+# A flush moves a batch into its own processing list, and only deletes that list once the batch
+# has been committed. Processing lists left behind by a flush that crashed are put back by
+# `requeue_download_events`.
+
+DOWNLOAD_EVENTS_KEY = "download_events"
+DOWNLOAD_PROCESSING_KEY_PREFIX = "download_events/processing/"
+
+_push_download_script = redis_client.register_script(_BLOOM_ADD_LUA + """
+local is_unique = "0"
+if bloom_add(2, 2) then
+	is_unique = "1"
+end
+redis.call("RPUSH", KEYS[1], ARGV[1] .. "," .. is_unique)
+""")
+
+_claim_downloads_script = redis_client.register_script("""
+local events = {}
+for i = 1, tonumber(ARGV[1]) do
+	local event = redis.call("LMOVE", KEYS[1], KEYS[2], "LEFT", "RIGHT")
+	if not event then
+		break
+	end
+	events[i] = event
+end
+return events
+""")
+
+_requeue_downloads_script = redis_client.register_script("""
+local count = 0
+while redis.call("LMOVE", KEYS[2], KEYS[1], "RIGHT", "LEFT") do
+	count = count + 1
+end
+return count
+""")
+
+
+def push_download_event(download_key: str, event: str):
+	"""
+	Appends a download event. The event is marked as unique if `download_key` hasn't been
+	seen in the last EXPIRY_TIME_S, see `downloads_filter`.
+	"""
+	_push_download_script(keys=[DOWNLOAD_EVENTS_KEY] + downloads_filter.get_keys(),
+			args=[event, downloads_filter.get_expiry()] + downloads_filter.get_offsets(download_key))
+
+
+def claim_download_events(processing_key: str, count: int) -> typing.List[str]:
+	"""
+	Moves up to `count` events from the start of the list to `processing_key`, and returns them.
+	`processing_key` must be deleted once the events have been applied, see `complete_download_events`
+	"""
+	events = _claim_downloads_script(keys=[DOWNLOAD_EVENTS_KEY, processing_key], args=[count])
+	return [x.decode("utf-8") for x in events]
+
+
+def complete_download_events(processing_key: str):
+	redis_client.delete(processing_key)
+
+
+def requeue_download_events(processing_key: typing.Optional[str] = None) -> int:
+	"""
+	Puts the events of a processing list back at the start of the list, used when they couldn't be
+	applied. If `processing_key` is None, all processing lists are put back; only do this when no
+	flush is running. Returns the number of events.
+	"""
+	if processing_key is None:
+		keys = list(redis_client.scan_iter(match=DOWNLOAD_PROCESSING_KEY_PREFIX + "*"))
+	else:
+		keys = [processing_key]
+
+	return sum(_requeue_downloads_script(keys=[DOWNLOAD_EVENTS_KEY, key]) for key in keys)
+
+
+# Flushes change the download counts and scores of packages without going through the
+# session, so the packages are collected here and pushed to the catalogue change log
+# periodically, see `app.logic.downloads.publish_download_changes`.
+
+DOWNLOADS_CHANGED_KEY = "downloads_changed"
+
+
+def add_downloads_changed(package_ids: typing.Iterable[int]):
+	package_ids = list(package_ids)
+	if len(package_ids) > 0:
+		redis_client.sadd(DOWNLOADS_CHANGED_KEY, *package_ids)
+
+
+def pop_downloads_changed() -> typing.List[int]:
+	pipe = redis_client.pipeline()
+	pipe.smembers(DOWNLOADS_CHANGED_KEY)
+	pipe.delete(DOWNLOADS_CHANGED_KEY)
+	package_ids, _ = pipe.execute()
+	return sorted(int(x) for x in package_ids)
+
+
+# After each flush, the new download counts are published to a channel per package and per
+# author, so that dashboards can show downloads as they happen. See `iter_live_downloads`.
+
+DOWNLOADS_CHANNEL_PREFIX = "downloads/"
+
+
+def get_downloads_channel(kind: str, id_: int) -> str:
+	"""`kind` is either package or author"""
+	return f"{DOWNLOADS_CHANNEL_PREFIX}{kind}/{id_}"
+
+
+def publish_messages(messages: typing.Iterable[typing.Tuple[str, str]]):
+	"""Publishes (channel, message) pairs using a single round trip"""
+	pipe = redis_client.pipeline(transaction=False)
+	for channel, message in messages:
+		pipe.publish(channel, message)
+	pipe.execute()
+
+
+def subscribe(channel: str):
+	pubsub = redis_client.pubsub(ignore_subscribe_messages=True)
+	pubsub.subscribe(channel)
+	return pubsub
+
+
+# Number of open live download streams of each client IP, across all processes
+
+LIVE_STREAMS_KEY_PREFIX = "live_streams/"
+
+_acquire_live_stream_script = redis_client.register_script("""
+local count = redis.call("INCR", KEYS[1])
+redis.call("EXPIRE", KEYS[1], ARGV[2])
+if count > tonumber(ARGV[1]) then
+	redis.call("DECR", KEYS[1])
+	return 0
+end
+return 1
+""")
+
+
+def acquire_live_stream(ip: str, limit: int, expiry: int) -> bool:
+	"""
+	Returns whether the client has fewer than `limit` open streams, and if so counts the new one. The
+	count expires after `expiry` seconds, so that streams of processes that were killed are forgotten
+	"""
+	return _acquire_live_stream_script(keys=[LIVE_STREAMS_KEY_PREFIX + ip], args=[limit, expiry]) == 1
+
+
+def release_live_stream(ip: str):
+	redis_client.decr(LIVE_STREAMS_KEY_PREFIX + ip)
+
+
+# Metric values, see `app.logic.metrics`. Each metric is a hash from series, the formatted
+# labels, to value.
+
+METRICS_KEY_PREFIX = "metrics/"
+
+
+def increment_metric(name: str, series: str, amount: float):
+	redis_client.hincrbyfloat(METRICS_KEY_PREFIX + name, series, amount)
+
+
+def increment_metrics(increments: typing.Iterable[typing.Tuple[str, str, float]]):
+	"""Applies (name, series, amount) increments using a single round trip"""
+	pipe = redis_client.pipeline(transaction=False)
+	for name, series, amount in increments:
+		pipe.hincrbyfloat(METRICS_KEY_PREFIX + name, series, amount)
+	pipe.execute()
+
+
+def set_metric_values(name: str, values: typing.Dict[str, float], replace: bool):
+	"""Sets the values of series, removing all other series when `replace` is true"""
+	pipe = redis_client.pipeline()
+	if replace:
+		pipe.delete(METRICS_KEY_PREFIX + name)
+	if len(values) > 0:
+		pipe.hset(METRICS_KEY_PREFIX + name, mapping=values)
+	pipe.execute()
+
+
+_merge_metric_key_script = redis_client.register_script("""
+local value = redis.call("GET", KEYS[1])
+if value then
+	redis.call("HINCRBYFLOAT", KEYS[2], ARGV[1], value)
+	redis.call("DEL", KEYS[1])
+end
+return value
+""")
+
+
+def merge_metric_key(key: str, name: str, series: str):
+	"""Adds the value of a counter stored in a plain key to a series, and deletes the key"""
+	_merge_metric_key_script(keys=[key, METRICS_KEY_PREFIX + name], args=[series])
+
+
+def get_metric_values(names: typing.List[str]) -> typing.List[typing.Dict[str, str]]:
+	pipe = redis_client.pipeline(transaction=False)
+	for name in names:
+		pipe.hgetall(METRICS_KEY_PREFIX + name)
+
+	return [{series.decode("utf-8"): value.decode("utf-8") for series, value in values.items()}
+			for values in pipe.execute()]
@@ -82,6 +82,26 @@ CELERYBEAT_SCHEDULE = {
 		'task': 'app.tasks.pkgtasks.update_package_scores',
 		'schedule': crontab(minute=10, hour=1), # 0110
 	},
+	'repair_review_aggregates': {
+		'task': 'app.tasks.pkgtasks.repair_review_aggregates',
+		'schedule': crontab(minute=20, hour=1, day_of_week=0), # 0120 on Sundays
+	},
+	'flush_downloads': {
+		'task': 'app.tasks.pkgtasks.flush_downloads',
+		'schedule': 5.0, # every 5 seconds
+	},
+	'publish_downloads': {
+		'task': 'app.tasks.pkgtasks.publish_downloads',
+		'schedule': crontab(minute='*/5'), # every 5 minutes
+	},
+	'collect_metrics': {
+		'task': 'app.tasks.pkgtasks.collect_metrics',
+		'schedule': 60.0, # every minute
+	},
+	'export_dependencies': {
+		'task': 'app.tasks.importtasks.export_dependencies',
+		'schedule': crontab(minute='*/10'), # every 10 minutes
+	},
 	'check_for_updates': {
 		'task': 'app.tasks.importtasks.check_for_updates',
 		'schedule': crontab(minute=10, hour=2), # 0210
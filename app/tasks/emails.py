@@ -25,7 +25,7 @@ from markupsafe import escape
 
 from app import mail
 from app.models import Notification, db, EmailSubscription, User
-from app.rediscache import increment_key
+from app.logic.metrics import emails_sent
 from app.tasks import celery
 from app.utils import abs_url_for, abs_url, random_string
 
@@ -73,7 +73,7 @@ def send_verify_email(email, token, locale):
 
 		msg.html = render_template("emails/verify.html", token=token, sub=sub)
 		mail.send(msg)
-		increment_key("emails_sent")
+		emails_sent.inc()
 
 
 @celery.task()
@@ -93,7 +93,7 @@ def send_unsubscribe_verify(email, locale):
 
 		msg.html = render_template("emails/verify_unsubscribe.html", sub=sub)
 		mail.send(msg)
-		increment_key("emails_sent")
+		emails_sent.inc()
 
 
 @celery.task(rate_limit="25/m")
@@ -113,7 +113,7 @@ def send_email_with_reason(email: str, locale: str, subject: str, text: str, htm
 			conn.send(msg)
 		else:
 			mail.send(msg)
-		increment_key("emails_sent")
+		emails_sent.inc()
 
 
 @celery.task(rate_limit="25/m")
@@ -149,7 +149,7 @@ def send_single_email(notification, locale):
 
 		msg.html = render_template("emails/notification.html", notification=notification, sub=sub)
 		mail.send(msg)
-		increment_key("emails_sent")
+		emails_sent.inc()
 
 
 def send_notification_digest(notifications: [Notification], locale):
@@ -172,7 +172,7 @@ def send_notification_digest(notifications: [Notification], locale):
 
 		msg.html = render_template("emails/notification_digest.html", notifications=notifications, user=user, sub=sub)
 		mail.send(msg)
-		increment_key("emails_sent")
+		emails_sent.inc()
 
 
 @celery.task()
@@ -32,7 +32,7 @@ from sqlalchemy.dialects.postgresql import insert
 
 from app.models import AuditSeverity, db, NotificationType, PackageRelease, MetaPackage, Dependency, PackageType, \
 	MinetestRelease, Package, PackageState, PackageScreenshot, PackageUpdateTrigger, PackageUpdateConfig, \
-	PackageGameSupport, PackageTranslation, Language
+	PackageGameSupport, PackageTranslation, get_language_ids, mark_package_changed
 from app.tasks import celery, TaskError
 from app.utils import random_string, post_bot_message, add_system_notification, add_system_audit_log, \
 	get_games_from_list, add_audit_log
@@ -43,6 +43,7 @@ from app import app
 from app.logic.LogicError import LogicError
 from app.logic.packages import do_edit_package, ALIASES
 from app.logic.game_support import game_support_update, game_support_set, game_support_update_all, game_support_remove
+from app.logic.dependencies import write_dependency_export
 from app.utils.image import get_image_size
 
 
@@ -95,6 +96,11 @@ def update_all_game_support():
 	db.session.commit()
 
 
+@celery.task()
+def export_dependencies():
+	write_dependency_export()
+
+
 @celery.task()
 def update_package_game_support(package_id: int):
 	package = Package.query.get(package_id)
@@ -251,7 +257,7 @@ def post_release_check_update(self, release: PackageRelease, path):
 
 
 def update_translations(package: Package, tree: PackageTreeNode):
-	allowed_languages = set([x[0] for x in db.session.query(Language.id).all()])
+	allowed_languages = get_language_ids()
 	allowed_languages.discard("en")
 	conn = db.session.connection()
 	for language in tree.get_supported_languages():
@@ -279,6 +285,10 @@ def update_translations(package: Package, tree: PackageTreeNode):
 			.filter_by(package_id=package.id, language_id=raw_translation.language) \
 			.update(to_update)
 
+	# The translations are changed using bulk queries, so need to be marked manually. This
+	# invalidates the translation store and catalogue
+	mark_package_changed(db.session, package.id)
+
 
 def _check_zip_file(temp_dir: str, zf: ZipFile) -> bool:
 	# No more than 300MB
@@ -337,6 +347,8 @@ def check_zip_release(self, id, path):
 		release.approve(release.package.author)
 		db.session.commit()
 
+	export_dependencies.delay()
+
 
 @celery.task()
 def check_all_zip_files():
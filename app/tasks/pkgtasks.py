@@ -27,6 +27,8 @@ import urllib3
 from app import app
 from sqlalchemy import or_, and_
 
+from app.logic.downloads import flush_download_events, publish_download_changes
+from app.logic import metrics
 from app.markdown import get_links, render_markdown
 from app.models import Package, db, PackageState, AuditLogEntry, AuditSeverity
 from app.tasks import celery, TaskError
@@ -35,15 +37,31 @@ from app.utils import post_bot_message, post_to_approval_thread, get_system_user
 
 @celery.task()
 def update_package_scores():
-	Package.query.update({ "score_downloads": Package.score_downloads * 0.93 })
+	Package.decay_scores(0.93)
 	db.session.commit()
 
-	for package in Package.query.all():
-		package.recalculate_score()
 
+@celery.task()
+def repair_review_aggregates():
+	Package.recalculate_review_aggregates()
 	db.session.commit()
 
 
+@celery.task()
+def flush_downloads():
+	flush_download_events()
+
+
+@celery.task()
+def publish_downloads():
+	publish_download_changes()
+
+
+@celery.task()
+def collect_metrics():
+	metrics.collect_metrics()
+
+
 def desc_contains(desc: str, search_str: str):
 	if search_str.startswith("https://forum.luanti.org/viewtopic.php?%t="):
 		reg = re.compile(search_str.replace(".", "\\.").replace("/", "\\/").replace("?", "\\?").replace("%", ".*"))
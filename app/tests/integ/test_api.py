@@ -15,8 +15,24 @@
 # along with this program.  If not, see <https://www.gnu.org/licenses/>.
 
 
+import os
+import shutil
+from urllib.parse import parse_qsl
+
+import flask_babel
+from sqlalchemy import event, update
+from werkzeug.datastructures import MultiDict
+
+from app import app, redis_client
 from app.default_data import populate_test_data
-from app.models import db, Package, PackageState
+from app.logic.catalogue import get_catalogue
+from app.logic.dependencies import write_dependency_export
+from app.logic.downloads import record_download, flush_download_events, publish_download_changes
+from app.logic.serializers import PackageSerializer
+from app.models import db, Package, PackageState, Language, PackageTranslation, mark_package_changed, License, \
+	User, PackageType, MetaPackage, Dependency, PackageGameSupport
+from app.querybuilder import QueryBuilder
+from app.rediscache import DOWNLOAD_EVENTS_KEY, DOWNLOADS_CHANGED_KEY, RESPONSE_KEY_PREFIX, downloads_filter
 from .utils import parse_json, validate_package_list
 from .utils import client # noqa
 
@@ -44,22 +60,122 @@ def test_packages_with_contents(client):
 	validate_package_list(packages)
 
 
-# def test_packages_with_query(client):
-# 	"""Start with a test database."""
-#
-# 	populate_test_data(db.session)
-# 	db.session.commit()
-#
-# 	rv = client.get("/api/packages/?q=food")
-#
-# 	packages = parse_json(rv.data)
-#
-# 	assert len(packages) == 2
-#
-# 	validate_package_list(packages)
-#
-# 	assert (packages[0]["name"] == "food" and packages[1]["name"] == "food_sweet") or \
-# 		(packages[1]["name"] == "food" and packages[0]["name"] == "food_sweet")
+def test_packages_matches_database(client):
+	"""The in-memory catalogue should give the same results as the database query."""
+
+	populate_test_data(db.session)
+	db.session.commit()
+
+	queries = [
+		"sort=name&order=asc",
+		"type=mod&sort=name&order=asc",
+		"type=game&type=txp&sort=created_at&order=asc",
+		"author=rubenwardy&sort=name&order=desc",
+		"hide=nonfree&sort=name&order=asc",
+		"protocol_version=100&sort=name&order=asc",
+		"sort=name&order=asc&limit=3",
+		"tag=mapgen&hide=player_effects&sort=name&order=asc",
+		"flag=wip&sort=name&order=asc",
+		"lang=de&sort=name&order=asc",
+		"license=MIT&license=CC0&sort=name&order=asc",
+	]
+
+	for query in queries:
+		qb = QueryBuilder(MultiDict(parse_qsl(query)), lang="en")
+		sql_query = qb.order_package_query(qb.filter_package_query(Package.query.filter_by(state=PackageState.APPROVED)))
+		if qb.limit:
+			sql_query = sql_query.limit(qb.limit)
+		expected = [f"{pkg.author.username}/{pkg.name}" for pkg in sql_query.all()]
+
+		packages = parse_json(client.get("/api/packages/?" + query).data)
+		assert [f"{pkg['author']}/{pkg['name']}" for pkg in packages] == expected, query
+
+
+def test_package_facets(client):
+	populate_test_data(db.session)
+	db.session.commit()
+
+	for query in ["", "type=mod", "q=food", "tag=mapgen"]:
+		qb = QueryBuilder(MultiDict(parse_qsl(query)), lang="en")
+		packages = qb.build_package_query().all()
+
+		tags = {}
+		for package in packages:
+			for tag in package.tags:
+				tags[tag.name] = tags.get(tag.name, 0) + 1
+
+		facets = parse_json(client.get("/api/packages/facets/?" + query).data)
+		assert facets["total"] == len(packages), query
+		assert sum(facets["types"].values()) == len(packages), query
+		assert facets["tags"] == tags, query
+
+
+def test_packages_checks_state_of_catalogue_results(client):
+	"""Packages that the catalogue hasn't seen being unapproved shouldn't be returned."""
+
+	populate_test_data(db.session)
+	db.session.commit()
+
+	qb = QueryBuilder(MultiDict(), lang="en")
+	packages = qb.build_package_query().all()
+	assert len(packages) > 1
+
+	# Bypasses the session, so the catalogue isn't told about the change
+	db.session.execute(update(Package).where(Package.id == packages[0].id).values(state=PackageState.WIP))
+	db.session.commit()
+
+	assert [x.id for x in qb.build_package_query().all()] == [x.id for x in packages[1:]]
+
+
+def test_packages_sees_changes(client):
+	"""Changes should be visible straight after they're committed."""
+
+	populate_test_data(db.session)
+	db.session.commit()
+
+	packages = parse_json(client.get("/api/packages/?sort=name&order=asc").data)
+	package = Package.get_by_key(f"{packages[0]['author']}/{packages[0]['name']}")
+	package.title = "Changed Title"
+	db.session.commit()
+
+	packages = parse_json(client.get("/api/packages/?sort=name&order=asc").data)
+	assert packages[0]["title"] == "Changed Title"
+
+	package.state = PackageState.WIP
+	db.session.commit()
+
+	packages = parse_json(client.get("/api/packages/?sort=name&order=asc").data)
+	assert package.name not in [pkg["name"] for pkg in packages]
+
+
+def test_packages_with_query(client):
+	"""Start with a test database."""
+
+	populate_test_data(db.session)
+	db.session.commit()
+
+	rv = client.get("/api/packages/?q=food")
+
+	packages = parse_json(rv.data)
+
+	assert len(packages) == 2
+
+	validate_package_list(packages)
+
+	assert (packages[0]["name"] == "food" and packages[1]["name"] == "food_sweet") or \
+		(packages[1]["name"] == "food" and packages[0]["name"] == "food_sweet")
+
+
+def test_packages_with_query_prefix_and_typo(client):
+	populate_test_data(db.session)
+	db.session.commit()
+
+	for query in ["foo", "fod", "Food sweet"]:
+		packages = parse_json(client.get("/api/packages/?q=" + query).data)
+		assert "food_sweet" in [pkg["name"] for pkg in packages], query
+
+	packages = parse_json(client.get("/api/packages/?q=food&sort=name&order=desc").data)
+	assert [pkg["name"] for pkg in packages] == ["food_sweet", "food"]
 
 
 def test_dependencies(client):
@@ -75,3 +191,318 @@ def test_dependencies(client):
 	assert not deps[0]["is_optional"]
 	assert len(deps[0]["packages"]) == 1
 	assert deps[0]["packages"][0] == "rubenwardy/food"
+
+
+def test_dependencies_export(client):
+	"""The export should match the paginated dependencies, and support ETags and ranges."""
+
+	populate_test_data(db.session)
+	db.session.commit()
+
+	items = parse_json(client.get("/api/dependencies/?n=300").data)["items"]
+	items.sort(key=lambda x: (x["author"], x["name"]))
+
+	# The export isn't generated by requests
+	shutil.rmtree(os.path.join(app.config["UPLOAD_DIR"], "dependencies"), ignore_errors=True)
+	assert client.get("/api/dependencies/export/").status_code == 503
+
+	write_dependency_export()
+
+	rv = client.get("/api/dependencies/export/")
+	assert rv.status_code == 200
+	assert parse_json(rv.data) == items
+	etag = rv.headers["ETag"]
+
+	assert client.get("/api/dependencies/export/", headers={"If-None-Match": etag}).status_code == 304
+
+	rv = client.get("/api/dependencies/export/", headers={"Range": "bytes=0-9"})
+	assert rv.status_code == 206
+	assert len(rv.data) == 10
+
+	package = Package.query.filter_by(state=PackageState.APPROVED).first()
+	package.provides.append(MetaPackage("export_test"))
+	db.session.commit()
+	write_dependency_export()
+
+	rv = client.get("/api/dependencies/export/", headers={"If-None-Match": etag})
+	assert rv.status_code == 200
+	assert rv.headers["ETag"] != etag
+	assert "export_test" in [x for item in parse_json(rv.data) for x in item["provides"]]
+
+
+def test_dependencies_depth(client):
+	"""Modname dependencies should be followed up to the requested depth."""
+
+	license = License.query.filter_by(name="MIT").first()
+	author = User.query.first()
+
+	packages = []
+	for name in ["chain_a", "chain_b", "chain_c", "chain_d"]:
+		package = Package()
+		package.state = PackageState.APPROVED
+		package.name = name
+		package.title = name
+		package.license = license
+		package.media_license = license
+		package.type = PackageType.MOD
+		package.author = author
+		package.short_desc = "Short desc"
+		package.desc = "Long desc"
+		package.provides.append(MetaPackage(name))
+		db.session.add(package)
+		packages.append(package)
+
+	for depender, dependency in zip(packages, packages[1:]):
+		db.session.add(Dependency(depender, meta=dependency.provides[0]))
+	db.session.commit()
+
+	def get_keys(query: str):
+		url = f"/api/packages/{author.username}/chain_a/dependencies/{query}"
+		return sorted(parse_json(client.get(url).data).keys())
+
+	keys = [f"{author.username}/{package.name}" for package in packages]
+	assert get_keys("") == keys[:2]
+	assert get_keys("?depth=0") == keys[:1]
+	assert get_keys("?depth=2") == keys[:3]
+	assert get_keys("?depth=all") == keys
+	assert client.get(f"/api/packages/{author.username}/chain_a/dependencies/?depth=-1").status_code == 400
+
+	deps = parse_json(client.get(f"/api/packages/{author.username}/chain_b/dependencies/").data)
+	assert deps[keys[1]] == [{"name": "chain_c", "is_optional": False, "packages": [keys[2]]}]
+
+
+def test_packages_etag(client):
+	"""Unchanged responses should be answered with 304 Not Modified."""
+
+	populate_test_data(db.session)
+	db.session.commit()
+
+	rv = client.get("/api/packages/")
+	assert rv.status_code == 200
+	assert len(parse_json(rv.data)) > 0
+	etag = rv.headers["ETag"]
+
+	rv = client.get("/api/packages/", headers={"If-None-Match": etag})
+	assert rv.status_code == 304
+	assert rv.data == b""
+
+	rv = client.get("/api/packages/?type=mod", headers={"If-None-Match": etag})
+	assert rv.status_code == 200
+	assert len(parse_json(rv.data)) > 0
+
+	package = Package.query.filter_by(state=PackageState.APPROVED).first()
+	package.title = "Changed Title"
+	db.session.commit()
+
+	rv = client.get("/api/packages/", headers={"If-None-Match": etag})
+	assert rv.status_code == 200
+	assert rv.headers["ETag"] != etag
+	assert "Changed Title" in [pkg["title"] for pkg in parse_json(rv.data)]
+
+
+def test_packages_etag_follows_downloads(client):
+	"""Download counts are applied outside the session, but should still change the ETag once published."""
+
+	populate_test_data(db.session)
+	db.session.commit()
+
+	rv = client.get("/api/packages/?sort=score&order=desc")
+	assert rv.status_code == 200
+	etag = rv.headers["ETag"]
+	last = parse_json(rv.data)[-1]
+
+	package = Package.query.filter_by(author=User.query.filter_by(username=last["author"]).one(), name=last["name"]).one()
+	redis_client.delete(DOWNLOAD_EVENTS_KEY, DOWNLOADS_CHANGED_KEY, *downloads_filter.get_keys())
+	for i in range(50):
+		record_download(f"10.0.0.{i}", package.id, 0, True, "new")
+	flush_download_events()
+
+	# Not published yet
+	rv = client.get("/api/packages/?sort=score&order=desc", headers={"If-None-Match": etag})
+	assert rv.status_code == 304
+
+	assert publish_download_changes() > 0
+	rv = client.get("/api/packages/?sort=score&order=desc", headers={"If-None-Match": etag})
+	assert rv.status_code == 200
+	assert rv.headers["ETag"] != etag
+	assert parse_json(rv.data)[0]["name"] == package.name
+
+
+def test_package_view_cache(client):
+	"""Cached responses should be evicted when the package changes."""
+
+	populate_test_data(db.session)
+	db.session.commit()
+
+	package = Package.query.filter_by(state=PackageState.APPROVED).first()
+	url = f"/api/packages/{package.author.username}/{package.name}/"
+
+	assert parse_json(client.get(url).data)["title"] == package.title
+	assert parse_json(client.get(url).data)["title"] == package.title
+
+	package.title = "Changed Title"
+	db.session.commit()
+
+	assert parse_json(client.get(url).data)["title"] == "Changed Title"
+
+	# The response also contains the titles of supported games
+	game = Package.query.filter(Package.state == PackageState.APPROVED, Package.id != package.id).first()
+	support = PackageGameSupport()
+	support.package = package
+	support.game = game
+	db.session.add(support)
+	db.session.commit()
+	assert parse_json(client.get(url).data)["game_support"][0]["game"]["title"] == game.title
+
+	game.title = "Changed Game Title"
+	db.session.commit()
+	assert parse_json(client.get(url).data)["game_support"][0]["game"]["title"] == "Changed Game Title"
+
+
+def test_package_view_cache_locale(client, monkeypatch):
+	"""Responses should be cached per locale, and not at all for requests with a session."""
+
+	monkeypatch.setitem(app.config["LANGUAGES"], "de", "Deutsch")
+	populate_test_data(db.session)
+	db.session.commit()
+
+	package = Package.query.filter_by(state=PackageState.APPROVED).first()
+	url = f"/api/packages/{package.author.username}/{package.name}/"
+	for key in redis_client.keys(RESPONSE_KEY_PREFIX + "*"):
+		redis_client.delete(key)
+
+	def count_cached():
+		return len(redis_client.keys(RESPONSE_KEY_PREFIX + "*"))
+
+	assert client.get(url).status_code == 200
+	assert count_cached() == 1
+
+	# The locale is remembered by the test's app context, which is shared by requests
+	client.set_cookie("locale", "de")
+	flask_babel.refresh()
+	assert client.get(url).status_code == 200
+	assert count_cached() == 2
+
+	client.set_cookie("session", "x")
+	assert client.get(url).status_code == 200
+	assert count_cached() == 2
+
+
+def test_serializer_query_count(client):
+	"""Serializing packages should use a fixed number of queries, however many packages there are."""
+
+	populate_test_data(db.session)
+	language = Language.query.get("de") or Language(id="de", title="Deutsch")
+	db.session.add(language)
+	packages = Package.query.filter_by(state=PackageState.APPROVED).order_by(db.asc(Package.id)).all()
+	db.session.add(PackageTranslation(package=packages[0], language=language, title="Übersetzt"))
+	db.session.commit()
+	package_ids = [package.id for package in packages]
+
+	statements = []
+
+	def count_statement(*_args):
+		statements.append(1)
+
+	event.listen(db.engine, "after_cursor_execute", count_statement)
+	try:
+		db.session.expire_all()
+		short_dicts = PackageSerializer("", lang="de").as_short_dicts(package_ids)
+		short_count = len(statements)
+
+		db.session.expire_all()
+		statements.clear()
+		dicts = PackageSerializer("", lang="de").as_dicts(package_ids)
+		full_count = len(statements)
+	finally:
+		event.remove(db.engine, "after_cursor_execute", count_statement)
+
+	assert len(package_ids) > 5
+	assert short_count <= 5
+	assert full_count <= 15
+
+	assert [x["title"] for x in dicts] == [x["title"] for x in short_dicts]
+	assert short_dicts[0]["title"] == "Übersetzt"
+	catalogue = get_catalogue()
+	catalogue.sync()
+	assert short_dicts == [catalogue.entries[id_].as_short_dict("", None, "de") for id_ in package_ids]
+
+	# A single package is serialized from its relationships, which aren't loaded again by later calls
+	serializer = PackageSerializer("", lang="de")
+	assert [serializer.as_short_dict(package) for package in packages] == short_dicts
+	assert [serializer.as_dict(package) for package in packages] == dicts
+
+	event.listen(db.engine, "after_cursor_execute", count_statement)
+	try:
+		statements.clear()
+		serializer.as_dict(packages[0])
+		single_count = len(statements)
+	finally:
+		event.remove(db.engine, "after_cursor_execute", count_statement)
+
+	assert single_count <= 3
+
+
+def test_translations_see_bulk_updates(client):
+	"""Translations changed by bulk queries should be seen once the package is marked as changed."""
+
+	populate_test_data(db.session)
+	language = Language.query.get("de") or Language(id="de", title="Deutsch")
+	db.session.add(language)
+	package = Package.query.filter_by(state=PackageState.APPROVED).first()
+	db.session.add(PackageTranslation(package=package, language=language, title="Erste", desc="Lang"))
+	db.session.commit()
+
+	assert package.get_translated("de")["title"] == "Erste"
+	assert package.get_translated("de")["desc"] == "Lang"
+	assert package.get_translated("de")["short_desc"] == package.short_desc
+
+	PackageTranslation.query.filter_by(package_id=package.id, language_id="de") \
+		.update({"title": "Zweite", "desc": None})
+	mark_package_changed(db.session, package.id)
+	db.session.commit()
+
+	assert package.get_translated("de")["title"] == "Zweite"
+	assert package.get_translated("de")["desc"] == package.desc
+	assert PackageSerializer("", lang="de").as_short_dicts([package.id])[0]["title"] == "Zweite"
+
+
+def test_dependencies_cursor_pagination(client):
+	"""Walking the cursor pages should give the same results as a single page."""
+
+	populate_test_data(db.session)
+	db.session.commit()
+
+	for sort in ["sort=name&order=asc", "sort=score&order=desc", "sort=approved_at&order=asc", "sort=title&order=desc"]:
+		expected = parse_json(client.get(f"/api/dependencies/?{sort}&n=300&cursor=").data)["items"]
+		assert len(expected) > 2
+
+		items = []
+		url = f"/api/dependencies/?{sort}&n=2&cursor="
+		while url:
+			page = parse_json(client.get(url).data)
+			assert len(page["items"]) <= 2
+			items.extend(page["items"])
+			url = page["urls"]["next"]
+
+		assert items == expected, sort
+
+
+def test_releases_cursor_pagination(client):
+	"""The next page is given in the Link header."""
+
+	populate_test_data(db.session)
+	db.session.commit()
+
+	expected = parse_json(client.get("/api/releases/?n=100").data)
+	assert len(expected) > 2
+
+	releases = []
+	url = "/api/releases/?n=2"
+	while url:
+		rv = client.get(url)
+		releases.extend(parse_json(rv.data))
+		link = rv.headers.get("Link")
+		url = link[1:link.index(">")] if link else None
+
+	assert releases == expected
@@ -0,0 +1,279 @@
+# ContentDB
+# Copyright (C) rubenwardy
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import datetime
+import json
+
+import pytest
+
+from app import redis_client
+from app.logic import downloads
+from app.logic.downloads import flush_download_events, iter_live_downloads, publish_download_changes, \
+	LIVE_MAX_STREAMS_PER_IP
+from app.models import db, Package, PackageRelease, PackageDailyStats, AuthorStatsRollup, User
+from app.rediscache import DOWNLOAD_EVENTS_KEY, DOWNLOADS_CHANGED_KEY, DOWNLOAD_PROCESSING_KEY_PREFIX, \
+	RotatingBloomFilter, downloads_filter, get_downloads_channel, LIVE_STREAMS_KEY_PREFIX, get_catalogue_revision, \
+	get_catalogue_changes, claim_download_events, get_lock
+from .test_releases_queries import make_package
+from .utils import client, parse_json, login # noqa
+
+
+def test_downloads_are_counted_when_flushed(client):
+	release_id, = make_package("Bob", [(None, None)])
+	db.session.commit()
+
+	package = Package.query.filter_by(name="bob").one()
+	redis_client.delete(DOWNLOAD_EVENTS_KEY, DOWNLOADS_CHANGED_KEY, *downloads_filter.get_keys())
+
+	url = f"/packages/{package.author.username}/bob/releases/{release_id}/download/"
+	for ip, reason in [("1.2.3.4", "new"), ("1.2.3.4", "update"), ("5.6.7.8", "dependency")]:
+		rv = client.get(url + "?reason=" + reason, headers={ "User-Agent": "Luanti/5.10.0", "X-Forwarded-For": ip })
+		assert rv.status_code == 302
+
+	# Nothing is written until the events are flushed
+	assert package.downloads == 0
+	assert flush_download_events() == 3
+	assert flush_download_events() == 0
+
+	db.session.expire_all()
+	package = Package.query.filter_by(name="bob").one()
+	assert package.downloads == 2
+	assert package.score_downloads == 1.5
+	assert PackageRelease.query.get(release_id).downloads == 2
+
+	stats = PackageDailyStats.query.filter_by(package_id=package.id).one()
+	assert stats.platform_minetest == 3
+	assert stats.platform_other == 0
+	assert stats.reason_new == 1
+	assert stats.reason_update == 1
+	assert stats.reason_dependency == 1
+
+	# The new download counts are published to the catalogue change log
+	revision = get_catalogue_revision()
+	assert publish_download_changes() == 1
+	assert get_catalogue_changes(revision) == (revision + 1, {f"package/{package.id}"})
+	assert publish_download_changes() == 0
+
+
+def test_download_events_are_kept_until_committed(client, monkeypatch):
+	release_id, = make_package("Bob", [(None, None)])
+	db.session.commit()
+
+	package = Package.query.filter_by(name="bob").one()
+	redis_client.delete(DOWNLOAD_EVENTS_KEY, *downloads_filter.get_keys())
+	for key in redis_client.scan_iter(match=DOWNLOAD_PROCESSING_KEY_PREFIX + "*"):
+		redis_client.delete(key)
+
+	url = f"/packages/{package.author.username}/bob/releases/{release_id}/download/"
+	for ip in ["1.2.3.4", "5.6.7.8", "9.10.11.12"]:
+		rv = client.get(url, headers={ "User-Agent": "Luanti/5.10.0", "X-Forwarded-For": ip })
+		assert rv.status_code == 302
+
+	events = redis_client.lrange(DOWNLOAD_EVENTS_KEY, 0, -1)
+
+	# A failed flush puts the events back in order
+	def fail(self, conn):
+		raise RuntimeError("Database is down")
+
+	with monkeypatch.context() as m:
+		m.setattr(downloads.DownloadCounts, "apply", fail)
+		with pytest.raises(RuntimeError):
+			flush_download_events()
+
+	assert redis_client.lrange(DOWNLOAD_EVENTS_KEY, 0, -1) == events
+
+	# Flushes skip while another flush is running
+	lock = get_lock("flush_downloads", timeout=60)
+	assert lock.acquire(blocking=False)
+	try:
+		assert flush_download_events() == 0
+	finally:
+		lock.release()
+
+	# Events claimed by a flush that crashed are applied by the next flush
+	assert claim_download_events(DOWNLOAD_PROCESSING_KEY_PREFIX + "crashed", 2) == [x.decode("utf-8") for x in events[:2]]
+	assert redis_client.llen(DOWNLOAD_EVENTS_KEY) == 1
+	assert flush_download_events() == 3
+	assert redis_client.llen(DOWNLOAD_EVENTS_KEY) == 0
+	assert not redis_client.exists(DOWNLOAD_PROCESSING_KEY_PREFIX + "crashed")
+
+	db.session.expire_all()
+	assert Package.query.filter_by(name="bob").one().downloads == 3
+
+
+def test_rotating_bloom_filter(client):
+	bloom_filter = RotatingBloomFilter("test", 1000, 0.01, 60, 3)
+	redis_client.delete(*bloom_filter.get_keys())
+
+	assert bloom_filter.add("a")
+	assert not bloom_filter.add("a")
+	assert bloom_filter.add("b")
+
+	false_positives = sum(0 if bloom_filter.add(f"item{i}") else 1 for i in range(500))
+	assert false_positives < 10
+
+	stats = bloom_filter.get_stats()
+	assert stats["memory_bytes"] <= bloom_filter.size // 8 + 1
+	assert 480 < stats["estimated_items"] < 520
+	assert stats["estimated_error_rate"] < 0.01
+
+	redis_client.delete(*bloom_filter.get_keys())
+
+
+def test_dedup_stats(client):
+	stats = parse_json(client.get("/metrics/dedup/").data)
+	assert [x["name"] for x in stats] == ["downloads", "tag_views"]
+
+
+def test_stats_granularity(client):
+	make_package("Bob", [(None, None)])
+	db.session.commit()
+
+	package = Package.query.filter_by(name="bob").one()
+	PackageDailyStats.add_counts(db.session.connection(), [
+		{ "package_id": package.id, "date": datetime.date(2022, 3, 30), "platform_minetest": 1 },
+		{ "package_id": package.id, "date": datetime.date(2022, 4, 3), "platform_minetest": 2 },
+		{ "package_id": package.id, "date": datetime.date(2022, 4, 4), "platform_other": 4 },
+	])
+	db.session.commit()
+
+	def get_stats(url):
+		return parse_json(client.get(url).data)
+
+	for url in [f"/api/packages/{package.author.username}/bob/stats/", f"/api/users/{package.author.username}/stats/"]:
+		stats = get_stats(url + "?granularity=week")
+		assert stats["start"] == "2022-03-28"
+		assert stats["platform_minetest"] == [3, 0]
+		assert stats["platform_other"] == [0, 4]
+
+		stats = get_stats(url + "?granularity=month&start=2022-04-02")
+		assert stats["start"] == "2022-04-01"
+		assert stats["platform_minetest"] == [2]
+
+		stats = get_stats(url)
+		assert stats["platform_minetest"] == [1, 0, 0, 0, 2, 0]
+
+	stats = get_stats(f"/api/users/{package.author.username}/stats/?granularity=week")
+	assert stats["package_downloads"] == { "Bob": [3, 4] }
+
+	# Rebuilding gives the same result
+	PackageDailyStats.rebuild_rollups(db.session.connection())
+	db.session.commit()
+	assert get_stats(f"/api/users/{package.author.username}/stats/?granularity=week") == stats
+
+	assert client.get(f"/api/users/{package.author.username}/stats/?granularity=year").status_code == 400
+
+
+def test_transfer_moves_author_stats(client):
+	make_package("Bob", [(None, None)])
+	db.session.commit()
+
+	db.session.add(User("StatsReceiver"))
+	package = Package.query.filter_by(name="bob").one()
+	old_author = package.author.username
+	PackageDailyStats.add_counts(db.session.connection(), [
+		{ "package_id": package.id, "date": datetime.date(2022, 3, 30), "platform_minetest": 1 },
+		{ "package_id": package.id, "date": datetime.date(2022, 4, 4), "platform_other": 4 },
+	])
+	db.session.commit()
+
+	login(client, "rubenwardy", "tuckfrump")
+	rv = client.post("/admin/transfer/", data={
+		"old_username": old_author,
+		"new_username": "StatsReceiver",
+		"package": "bob",
+	})
+	assert rv.status_code == 302
+
+	new_stats = parse_json(client.get("/api/users/StatsReceiver/stats/?granularity=month&start=2022-03-01&end=2022-04-30").data)
+	assert new_stats["platform_minetest"] == [1, 0]
+	assert new_stats["package_downloads"]["Bob"] == [1, 4]
+
+	old_stats = parse_json(client.get(f"/api/users/{old_author}/stats/?granularity=month&start=2022-03-01&end=2022-04-30").data)
+	assert "Bob" not in old_stats["package_downloads"]
+
+	# The rollups match what rebuilding them would give
+	rollups = [(x.author_id, x.granularity, x.date, x.platform_minetest, x.platform_other)
+			for x in AuthorStatsRollup.query.order_by(AuthorStatsRollup.author_id, AuthorStatsRollup.granularity,
+					AuthorStatsRollup.date).all()]
+	PackageDailyStats.rebuild_rollups(db.session.connection())
+	assert [x for x in rollups if x[3] != 0 or x[4] != 0] == \
+		[(x.author_id, x.granularity, x.date, x.platform_minetest, x.platform_other)
+			for x in AuthorStatsRollup.query.order_by(AuthorStatsRollup.author_id, AuthorStatsRollup.granularity,
+					AuthorStatsRollup.date).all()]
+	db.session.rollback()
+
+
+def test_live_downloads_are_published_when_flushed(client):
+	release_id, = make_package("Bob", [(None, None)])
+	db.session.commit()
+
+	package = Package.query.filter_by(name="bob").one()
+	redis_client.delete(DOWNLOAD_EVENTS_KEY, *downloads_filter.get_keys())
+
+	package_stream = iter_live_downloads(get_downloads_channel("package", package.id))
+	author_stream = iter_live_downloads(get_downloads_channel("author", package.author_id))
+
+	# Subscribes and returns the heartbeat for the subscription confirmation
+	assert next(package_stream) is None
+	assert next(author_stream) is None
+
+	url = f"/packages/{package.author.username}/bob/releases/{release_id}/download/"
+	rv = client.get(url + "?reason=new", headers={ "User-Agent": "Luanti/5.10.0", "X-Forwarded-For": "1.2.3.4" })
+	assert rv.status_code == 302
+	assert flush_download_events() == 1
+
+	for stream in [package_stream, author_stream]:
+		items = json.loads(next(x for x in stream if x is not None))
+		assert items == [{
+			"package": { "author": package.author.username, "name": "bob" },
+			"date": datetime.datetime.utcnow().date().isoformat(),
+			"downloads": 1,
+			"platform_minetest": 1,
+			"platform_other": 0,
+			"reason_new": 1,
+			"reason_dependency": 0,
+			"reason_update": 0,
+		}]
+		stream.close()
+
+
+def test_live_downloads_are_limited_per_ip(client):
+	make_package("Bob", [(None, None)])
+	db.session.commit()
+
+	redis_client.delete(LIVE_STREAMS_KEY_PREFIX + "1.2.3.5")
+	package = Package.query.filter_by(name="bob").one()
+	url = f"/api/packages/{package.author.username}/bob/stats/live/"
+
+	streams = [client.get(url, headers={ "X-Forwarded-For": "1.2.3.5" }) for _ in range(LIVE_MAX_STREAMS_PER_IP)]
+	assert all(rv.status_code == 200 for rv in streams)
+
+	rv = client.get(url, headers={ "X-Forwarded-For": "1.2.3.5" })
+	assert rv.status_code == 429
+
+	# Addresses added by the client before the proxy's are ignored
+	rv = client.get(url, headers={ "X-Forwarded-For": "9.9.9.9, 1.2.3.5" })
+	assert rv.status_code == 429
+
+	# Closing a stream frees it up
+	streams.pop().close()
+	rv = client.get(url, headers={ "X-Forwarded-For": "1.2.3.5" })
+	assert rv.status_code == 200
+
+	for stream in streams + [rv]:
+		stream.close()
+	assert int(redis_client.get(LIVE_STREAMS_KEY_PREFIX + "1.2.3.5")) == 0
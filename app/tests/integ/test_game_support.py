@@ -0,0 +1,79 @@
+# ContentDB
+# Copyright (C) rubenwardy
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+from typing import List
+
+from app.logic.game_support import game_support_update
+from app.models import db, License, User, Package, PackageState, PackageType, MetaPackage, Dependency
+from .utils import client # noqa
+
+
+def make_package(name: str, type_: PackageType, provides: List[str], depends: List[str]) -> Package:
+	license = License.query.filter_by(name="MIT").first()
+
+	package = Package()
+	package.state = PackageState.APPROVED
+	package.name = name
+	package.title = name
+	package.license = license
+	package.media_license = license
+	package.type = type_
+	package.author = User.query.first()
+	package.short_desc = "Short desc"
+	package.desc = "Long desc"
+	db.session.add(package)
+
+	for modname in provides:
+		package.provides.append(MetaPackage.query.filter_by(name=modname).first() or MetaPackage(modname))
+	for modname in depends:
+		meta = MetaPackage.query.filter_by(name=modname).first() or MetaPackage(modname)
+		db.session.add(Dependency(package, meta=meta))
+
+	return package
+
+
+def get_detected_games(package: Package) -> List[str]:
+	return sorted(x.game.name for x in package.supported_games.all() if x.supports)
+
+
+def test_game_support_follows_changes(client):
+	"""Game support should see packages changed since it was last used, and uncommitted changes."""
+
+	make_package("game_one", PackageType.GAME, ["gs_default"], [])
+	mod = make_package("gs_mod", PackageType.MOD, ["gs_mod"], ["gs_default"])
+	db.session.commit()
+
+	assert len(game_support_update(db.session, mod, None)) == 0
+	db.session.commit()
+	assert get_detected_games(mod) == ["game_one"]
+
+	game_two = make_package("game_two", PackageType.GAME, ["gs_default"], [])
+	db.session.commit()
+
+	game_support_update(db.session, game_two, None)
+	db.session.commit()
+	assert get_detected_games(mod) == ["game_one", "game_two"]
+
+	game_two.provides.append(MetaPackage("gs_only_two"))
+	db.session.commit()
+
+	# The new mod hasn't been committed, but should still be seen
+	lib = make_package("gs_lib", PackageType.MOD, ["gs_lib"], ["gs_only_two"])
+	db.session.flush()
+	assert len(game_support_update(db.session, lib, None)) == 0
+	db.session.commit()
+	assert get_detected_games(lib) == ["game_two"]
+	assert get_detected_games(mod) == ["game_one", "game_two"]
@@ -0,0 +1,111 @@
+# ContentDB
+# Copyright (C) rubenwardy
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import pytest
+
+from app import redis_client
+from app.logic import metrics
+from app.logic.metrics import collect_metrics, Counter, Gauge, Histogram, emails_sent
+from app.models import db, AuditLogEntry, AuditSeverity, User
+from app.rediscache import METRICS_KEY_PREFIX, get_metric_values
+from .utils import client # noqa
+
+
+@pytest.fixture
+def isolated_metrics(monkeypatch):
+	"""Metrics created by the test are registered in a copy of the registry, which is discarded afterwards"""
+	monkeypatch.setattr(metrics, "_metrics", dict(metrics._metrics))
+
+
+def test_metrics_render_stored_values(client, isolated_metrics):
+	redis_client.delete(*redis_client.keys(METRICS_KEY_PREFIX + "*"))
+
+	counter = Counter("test_counter", "Test counter", ["kind"])
+	counter.inc(kind="a")
+	counter.inc(2, kind="a")
+	counter.inc(kind="b\"")
+
+	gauge = Gauge("test_gauge", "Test gauge", ["language"])
+	gauge.set_all([({"language": "de"}, 1), ({"language": "fr"}, 2)])
+	gauge.set_all([({"language": "de"}, 3)])
+
+	text = client.get("/metrics").data.decode("utf-8")
+	assert "# TYPE test_counter counter\ntest_counter{kind=\"a\"} 3\ntest_counter{kind=\"b\\\"\"} 1\n" in text
+	assert "# TYPE test_gauge gauge\ntest_gauge{language=\"de\"} 3\n\n" in text
+
+	# Metrics aren't rendered until they have a value
+	assert "contentdb_emails" not in text
+	emails_sent.inc()
+	assert "contentdb_emails 1\n" in client.get("/metrics").data.decode("utf-8")
+
+
+def test_collect_metrics(client):
+	redis_client.delete(*redis_client.keys(METRICS_KEY_PREFIX + "*"))
+
+	user = User.query.first()
+	db.session.add(AuditLogEntry(user, AuditSeverity.NORMAL, "Did something", None))
+	db.session.commit()
+
+	collect_metrics()
+
+	text = client.get("/metrics").data.decode("utf-8")
+	assert "contentdb_users_active_1d 1\n" in text
+	assert "contentdb_users_active_1m 1\n" in text
+	assert "contentdb_reviews 0\n" in text
+
+
+def test_collect_metrics_carries_over_email_count(client):
+	redis_client.delete("emails_sent", *redis_client.keys(METRICS_KEY_PREFIX + "*"))
+	redis_client.set("emails_sent", 41)
+	emails_sent.inc()
+
+	collect_metrics()
+	collect_metrics()
+
+	assert "contentdb_emails 42\n" in client.get("/metrics").data.decode("utf-8")
+	assert not redis_client.exists("emails_sent")
+
+
+def test_request_metrics(client):
+	redis_client.delete(*redis_client.keys(METRICS_KEY_PREFIX + "*"))
+
+	assert client.get("/api/tags/").status_code == 200
+
+	text = client.get("/metrics").data.decode("utf-8")
+	assert "# TYPE contentdb_request_duration_seconds histogram\n" in text
+	assert "contentdb_request_duration_seconds_bucket{endpoint=\"api.tags\",le=\"+Inf\"} 1\n" in text
+	assert "contentdb_request_duration_seconds_count{endpoint=\"api.tags\"} 1\n" in text
+	assert "contentdb_request_sql_statements_bucket{endpoint=\"api.tags\",le=\"0\"} 0\n" in text
+	assert "contentdb_request_sql_statements_count{endpoint=\"api.tags\"} 1\n" in text
+	assert "contentdb_request_response_bytes_count{endpoint=\"api.tags\"} 1\n" in text
+
+
+def test_histogram_buckets_are_cumulative(client, isolated_metrics):
+	redis_client.delete(*redis_client.keys(METRICS_KEY_PREFIX + "*"))
+
+	histogram = Histogram("test_histogram", "Test histogram", [1, 10])
+	for value in [0.5, 1, 5, 20]:
+		histogram.observe(value)
+
+	assert histogram.render(get_metric_values(["test_histogram"])[0]) == [
+		"# HELP test_histogram Test histogram",
+		"# TYPE test_histogram histogram",
+		"test_histogram_bucket{le=\"1\"} 2",
+		"test_histogram_bucket{le=\"10\"} 3",
+		"test_histogram_bucket{le=\"+Inf\"} 4",
+		"test_histogram_sum 26.5",
+		"test_histogram_count 4",
+	]
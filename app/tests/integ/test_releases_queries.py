@@ -217,3 +217,33 @@ def test_packages_with_protocol_options(client):
 	assert len(packages) == 0
 
 	validate_package_list(packages, True)
+
+
+def test_updates_follows_release_changes(client):
+	"""Start with a blank database."""
+
+	rels = make_package("Bob", [(None, "5.0"), ("5.1", None)])
+	db.session.commit()
+
+	assert parse_json(client.get("/api/updates/").data) == {"rubenwardy/bob": rels[1]}
+	assert parse_json(client.get("/api/updates/?protocol_version=37").data) == {"rubenwardy/bob": rels[0]}
+	assert parse_json(client.get("/api/updates/?protocol_version=38").data) == {"rubenwardy/bob": rels[1]}
+
+	release = PackageRelease.query.get(rels[1])
+	release.approved = False
+	db.session.commit()
+
+	assert parse_json(client.get("/api/updates/").data) == {"rubenwardy/bob": rels[0]}
+	assert parse_json(client.get("/api/updates/?protocol_version=38").data) == {}
+
+	release.approved = True
+	release.min_rel = None
+	db.session.commit()
+
+	assert parse_json(client.get("/api/updates/?protocol_version=37").data) == {"rubenwardy/bob": rels[1]}
+
+	db.session.delete(release)
+	db.session.commit()
+
+	assert parse_json(client.get("/api/updates/").data) == {"rubenwardy/bob": rels[0]}
+	assert parse_json(client.get("/api/updates/?protocol_version=38").data) == {}
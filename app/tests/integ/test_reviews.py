@@ -0,0 +1,120 @@
+# ContentDB
+# Copyright (C) rubenwardy
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+from app.models import db, Package, PackageReview, User, Thread
+from .test_releases_queries import make_package
+from .utils import client, parse_json, login # noqa
+
+
+def add_review(package: Package, author: User, rating: int) -> PackageReview:
+	review = PackageReview()
+	review.package = package
+	review.author = author
+	review.rating = rating
+	db.session.add(review)
+	package.update_review_aggregates(None, rating)
+	db.session.commit()
+	return review
+
+
+def test_review_scores_are_maintained(client):
+	make_package("Bob", [])
+	db.session.commit()
+
+	package = Package.query.filter_by(name="bob").one()
+	package.score_downloads = 10
+	package.score = 10
+	db.session.commit()
+
+	users = User.query.filter(User.id != package.author_id).all()
+	review = add_review(package, users[0], 5)
+	assert package.score_reviews == 150
+	assert package.score == 160
+	assert package.get_review_summary() == [1, 0, 0]
+
+	package.update_review_aggregates(review.rating, 1)
+	review.rating = 1
+	db.session.commit()
+	assert package.score_reviews == -150
+	assert package.score == -140
+	assert package.get_review_summary() == [0, 0, 1]
+
+	Package.decay_scores(0.5)
+	db.session.commit()
+	db.session.expire_all()
+	assert package.score_downloads == 5
+	assert package.score == -145
+
+	# Repairs the aggregates
+	package.score_reviews = 0
+	package.reviews_positive = 3
+	package.reviews_negative = 0
+	db.session.commit()
+	Package.recalculate_review_aggregates()
+	db.session.commit()
+	db.session.expire_all()
+	assert package.score_reviews == -150
+	assert package.score == -145
+	assert package.get_review_summary() == [0, 0, 1]
+
+	package.update_review_aggregates(review.rating, None)
+	db.session.delete(review)
+	db.session.commit()
+	assert package.score_reviews == 0
+	assert package.score == 5
+	assert package.get_review_summary() == [0, 0, 0]
+
+
+def test_scores_api_uses_review_counts(client):
+	make_package("Bob", [])
+	db.session.commit()
+
+	package = Package.query.filter_by(name="bob").one()
+	users = User.query.filter(User.id != package.author_id).all()
+	add_review(package, users[0], 3)
+
+	rv = client.get("/api/scores/")
+	assert rv.status_code == 200
+	scores = [x for x in parse_json(rv.data) if x["name"] == "bob"]
+	assert len(scores) == 1
+	assert scores[0]["reviews"] == { "positive": 0, "neutral": 1, "negative": 0 }
+
+
+def test_deleting_review_thread_updates_scores(client):
+	make_package("Bob", [])
+	db.session.commit()
+
+	package = Package.query.filter_by(name="bob").one()
+	users = User.query.filter(User.id != package.author_id).all()
+	review = add_review(package, users[0], 5)
+
+	thread = Thread()
+	thread.author = users[0]
+	thread.package = package
+	thread.review = review
+	thread.title = "Review"
+	db.session.add(thread)
+	db.session.commit()
+	assert package.get_review_summary() == [1, 0, 0]
+
+	login(client, "rubenwardy", "tuckfrump")
+	rv = client.post(f"/threads/{thread.id}/delete/")
+	assert rv.status_code == 302
+
+	db.session.expire_all()
+	assert PackageReview.query.filter_by(package_id=package.id).count() == 0
+	assert package.score_reviews == 0
+	assert package.get_review_summary() == [0, 0, 0]
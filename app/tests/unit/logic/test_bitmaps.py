@@ -0,0 +1,45 @@
+# ContentDB
+# Copyright (C) rubenwardy
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+from app.logic.bitmaps import BitmapIndex
+
+
+def test_bitmap_index():
+	index = BitmapIndex()
+	index.add(10, "a", [("tag", 1), ("tag", 2)])
+	index.add(20, "b", [("tag", 2)])
+	index.add(30, "c", [])
+
+	assert index.get_items(index.all) == ["a", "b", "c"]
+	assert index.get_items(index.get(("tag", 2)) & ~index.get(("tag", 1))) == ["b"]
+	assert index.get_items(index.get_any([("tag", 1), ("tag", 3)])) == ["a"]
+	assert index.get_items(index.from_ids([30, 10, 99])) == ["a", "c"]
+
+	copy = index.copy()
+	copy.remove(10)
+	assert index.get_items(index.get(("tag", 1))) == ["a"]
+	assert copy.get(("tag", 1)) == 0
+	assert ("tag", 1) not in copy.bitmaps
+
+	# Ordinals are reused
+	copy.add(40, "d", [("tag", 1)])
+	assert copy.get_items(copy.all) == ["d", "b", "c"]
+	assert copy.get_items(copy.get(("tag", 1))) == ["d"]
+
+	# Re-adding replaces the keys
+	copy.add(20, "b2", [("tag", 3)])
+	assert copy.get_items(copy.get(("tag", 2))) == []
+	assert copy.get_items(copy.get(("tag", 3))) == ["b2"]
@@ -15,8 +15,12 @@
 # along with this program.  If not, see <https://www.gnu.org/licenses/>.
 
 import datetime
+import os
+import time
 
-from app.logic.graphs import flatten_data
+import pytest
+
+from app.logic.graphs import flatten_data, iter_periods, scatter_downloads, daterange
 
 
 class DailyStat:
@@ -47,3 +51,95 @@ def test_flatten_data():
 	assert res["start"] == "2022-03-28"
 	assert res["end"] == "2022-04-02"
 	assert res["platform_minetest"] == [3, 10, 0, 0, 5, 1]
+
+
+def test_flatten_data_monthly():
+	res = flatten_data([
+		DailyStat("2022-01-01", 3),
+		DailyStat("2022-03-01", 10),
+		DailyStat("2022-04-01", 5),
+	], "month")
+
+	assert res["start"] == "2022-01-01"
+	assert res["end"] == "2022-04-01"
+	assert res["platform_minetest"] == [3, 0, 10, 5]
+
+
+def test_iter_periods():
+	start = datetime.date.fromisoformat("2022-03-30")
+	end = datetime.date.fromisoformat("2022-04-12")
+
+	assert [x.isoformat() for x in iter_periods(start, end, "week")] == ["2022-03-28", "2022-04-04", "2022-04-11"]
+	assert [x.isoformat() for x in iter_periods(start, end, "month")] == ["2022-03-01", "2022-04-01"]
+	assert len(list(iter_periods(start, end))) == 14
+
+
+class DownloadStat:
+	__slots__ = ("package_id", "date", "downloads")
+
+	def __init__(self, package_id: int, date: datetime.date, downloads: int):
+		self.package_id = package_id
+		self.date = date
+		self.downloads = downloads
+
+
+def _fill_downloads_loop(stats, start_date: datetime.date, end_date: datetime.date):
+	"""The previous implementation, which loops over every day of every package"""
+	i = 0
+	row = []
+	for date in daterange(start_date, end_date):
+		if i < len(stats) and stats[i].date == date:
+			row.append(stats[i].downloads)
+			i += 1
+		else:
+			row.append(0)
+
+	return row
+
+
+def _make_download_stats(packages: int, days: int):
+	start = datetime.date(2023, 1, 1)
+	end = start + datetime.timedelta(days=days - 1)
+	dates = list(daterange(start, end))
+
+	# Downloads on a fifth of the days
+	stats = [DownloadStat(package_id, date, package_id + i)
+			for package_id in range(packages)
+			for i, date in enumerate(dates) if (package_id + i) % 5 == 0]
+
+	return stats, start, end
+
+
+def _fill_all_downloads_loop(stats, start_date: datetime.date, end_date: datetime.date):
+	ret = {}
+	i = 0
+	while i < len(stats):
+		j = i
+		while j < len(stats) and stats[j].package_id == stats[i].package_id:
+			j += 1
+		ret[stats[i].package_id] = _fill_downloads_loop(stats[i:j], start_date, end_date)
+		i = j
+
+	return ret
+
+
+def test_scatter_downloads():
+	stats, start, end = _make_download_stats(20, 30)
+	assert dict(scatter_downloads(stats, start, end)) == _fill_all_downloads_loop(stats, start, end)
+
+
+@pytest.mark.skipif(not os.environ.get("CDB_BENCHMARK"), reason="Benchmarks only run when CDB_BENCHMARK is set")
+def test_scatter_downloads_benchmark():
+	"""Compares the speed of scattering with the previous loop, run with CDB_BENCHMARK=1 pytest -s"""
+	stats, start, end = _make_download_stats(5000, 365)
+
+	begin = time.perf_counter()
+	expected = _fill_all_downloads_loop(stats, start, end)
+	loop_time = time.perf_counter() - begin
+
+	begin = time.perf_counter()
+	actual = dict(scatter_downloads(stats, start, end))
+	scatter_time = time.perf_counter() - begin
+
+	print(f"\nLoop: {loop_time:.3f}s, scatter: {scatter_time:.3f}s, speedup: {loop_time / scatter_time:.1f}x")
+	assert actual == expected
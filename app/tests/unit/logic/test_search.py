@@ -0,0 +1,114 @@
+# ContentDB
+# Copyright (C) rubenwardy
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+from app.logic.search import SearchIndex, tokenize
+
+
+def make_index() -> SearchIndex:
+	index = SearchIndex()
+	index.add(1, 100, {
+		"name": ["mesecons"],
+		"title": ["Mesecons"],
+		"short_desc": ["Adds digital circuitry, including wires, buttons, lights, and programmable controllers"],
+		"provides": ["mesecons", "mesecons_lamp", "mesecons_button"],
+		"tags": ["technology"],
+	})
+	index.add(2, 50, {
+		"name": ["digilines"],
+		"title": ["Digilines"],
+		"short_desc": ["Adds digital communication wires, compatible with mesecons"],
+		"provides": ["digilines"],
+		"tags": ["technology"],
+	})
+	index.add(3, 10, {
+		"name": ["farming"],
+		"title": ["Farming Redo"],
+		"short_desc": ["Adds crops"],
+		"translated_title": ["Agriculture"],
+	})
+	return index
+
+
+def test_tokenize():
+	assert tokenize("Mesecons_lamp: Lights, etc.") == ["mesecons", "lamp", "lights", "etc"]
+
+
+def test_exact():
+	index = make_index()
+	results = index.search("mesecons")
+	assert set(results.keys()) == {1, 2}
+	assert results[1] > results[2]
+
+
+def test_all_terms_must_match():
+	index = make_index()
+	assert set(index.search("digital wires").keys()) == {1, 2}
+	assert set(index.search("communication wires").keys()) == {2}
+	assert index.search("communication crops") == {}
+
+
+def test_prefix():
+	index = make_index()
+	assert set(index.search("digil").keys()) == {2}
+	assert set(index.search("farm").keys()) == {3}
+	assert set(index.search("agri").keys()) == {3}
+
+
+def test_fuzzy():
+	index = make_index()
+	assert set(index.search("mesecosn").keys()) == {1, 2}
+	assert set(index.search("farmign").keys()) == {3}
+	assert index.search("xyzzy") == {}
+
+
+def test_update_and_remove():
+	index = make_index()
+	index.add(3, 10, {
+		"name": ["farming"],
+		"title": ["Farming Undo"],
+	})
+	assert index.search("redo") == {}
+	assert set(index.search("undo").keys()) == {3}
+
+	index.remove(2)
+	assert set(index.search("mesecons").keys()) == {1}
+	assert index.search("digilines") == {}
+	assert "digilines" not in index.postings
+	assert len(index) == 2
+
+
+def test_copy_doesnt_change_original():
+	index = make_index()
+	expected = {query: index.search(query) for query in ["mesecons", "digilines", "wires", "farming", "mesecon"]}
+
+	copy = index.copy()
+	copy.remove(2)
+	copy.add(1, 100, {
+		"name": ["mesecons"],
+		"short_desc": ["Adds wireless circuitry"],
+	})
+	copy.add(4, 10, {
+		"name": ["wirelesss"],
+	})
+	assert set(copy.search("digilines").keys()) == set()
+	assert set(copy.search("wireless").keys()) == {1, 4}
+
+	assert {query: index.search(query) for query in expected} == expected
+	assert index.search("wireless") == {}
+
+	# The original can still be modified without affecting the copy
+	index.remove(1)
+	assert set(copy.search("mesecons").keys()) == {1}
@@ -0,0 +1,66 @@
+# ContentDB
+# Copyright (C) rubenwardy
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import base64
+import datetime
+import json
+
+import pytest
+from werkzeug.exceptions import BadRequest
+
+from app.models import Package
+from app.utils.pagination import _encode_cursor, _decode_cursor
+
+
+def _forge_cursor(values) -> str:
+	return base64.urlsafe_b64encode(json.dumps(values).encode("utf-8")).decode("utf-8").rstrip("=")
+
+
+def test_cursor_round_trip():
+	created_at = datetime.datetime(2024, 5, 1, 12, 30)
+	keys = [(Package.created_at, True), (Package.id, True)]
+	assert _decode_cursor(_encode_cursor([created_at, 12]), keys) == [created_at, 12]
+	assert _decode_cursor(_encode_cursor([None, 12]), keys) == [None, 12]
+
+	keys = [(Package.score, True), (Package.id, True)]
+	assert _decode_cursor(_forge_cursor([3, 12]), keys) == [3.0, 12]
+	assert _decode_cursor(_forge_cursor([3.5, 12]), keys) == [3.5, 12]
+
+
+@pytest.mark.parametrize("keys,values", [
+	([(Package.created_at, True), (Package.id, True)], [12, 12]),
+	([(Package.created_at, True), (Package.id, True)], ["not a date", 12]),
+	([(Package.created_at, True), (Package.id, True)], ["2024-05-01T12:30:00", "12"]),
+	([(Package.score, True), (Package.id, True)], ["1 OR 1=1", 12]),
+	([(Package.score, True), (Package.id, True)], [1.0, 12.5]),
+	([(Package.score, True), (Package.id, True)], [True, 12]),
+	([(Package.name, False), (Package.id, False)], [{"a": 1}, 12]),
+	([(Package.name, False), (Package.id, False)], [["a"], 12]),
+	([(Package.name, False), (Package.id, False)], ["a"]),
+])
+def test_forged_cursor_is_rejected(keys, values):
+	with pytest.raises(BadRequest):
+		_decode_cursor(_forge_cursor(values), keys)
+
+
+def test_malformed_cursor_is_rejected():
+	keys = [(Package.id, True)]
+	with pytest.raises(BadRequest):
+		_decode_cursor("!!!", keys)
+	with pytest.raises(BadRequest):
+		_decode_cursor(base64.urlsafe_b64encode(b"{not json").decode("utf-8"), keys)
+	with pytest.raises(BadRequest):
+		_decode_cursor(_forge_cursor({"id": 1}), keys)
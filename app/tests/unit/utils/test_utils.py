@@ -16,7 +16,7 @@
 
 import user_agents
 
-from app.utils import make_valid_username
+from app.utils import make_valid_username, stream_server_sent_events
 
 
 def test_make_valid_username():
@@ -40,3 +40,9 @@ def test_crawlers_are_bots():
 	assert user_agents.parse("Mozilla/5.0 (Linux; Android 6.0.1; Nexus 5X Build/MMB29P) AppleWebKit/537.36 (KHTML, "
 			"like Gecko) Chrome/W.X.Y.Z Mobile Safari/537.36 (compatible; Googlebot/2.1; "
 			"+http://www.google.com/bot.html)").is_bot
+
+
+def test_server_sent_events():
+	res = stream_server_sent_events(iter(["[1]", None, "a\nb"]))
+	assert res.mimetype == "text/event-stream"
+	assert res.get_data() == b"retry: 5000\n\ndata: [1]\n\n:\n\ndata: a\ndata: b\n\n"
@@ -15,16 +15,19 @@
 # along with this program.  If not, see <https://www.gnu.org/licenses/>.
 
 import datetime
+import hashlib
+import time
 import typing
 from functools import wraps
 from urllib.parse import urljoin, urlparse, urlunparse
 
 import user_agents
-from flask import request, abort, url_for, Response
+from flask import request, abort, url_for, Response, current_app, stream_with_context
 from flask_babel import LazyString, lazy_gettext
 from werkzeug.datastructures import MultiDict
 
 from app import app
+from app.rediscache import get_catalogue_revision
 
 
 def is_safe_url(target):
@@ -177,6 +180,120 @@ def cached(max_age: int):
 	return decorator
 
 
+def cached_with_etag(max_age: int, period: typing.Optional[int] = None):
+	"""
+	Like `cached`, but also sets a strong ETag based on the catalogue revision and answers
+	If-None-Match with 304 Not Modified without running the view.
+
+	Only use this for views that depend on nothing but the catalogue and the request. Download
+	counts and scores are part of the revision, but only published every few minutes, see
+	`app.logic.downloads.publish_download_changes`. `period` changes the ETag every `period`
+	seconds, for views with data that isn't tracked by the revision at all.
+	"""
+	def decorator(f):
+		@wraps(f)
+		def inner(*args, **kwargs):
+			parts = [str(get_catalogue_revision()), request.full_path, request.headers.get("Accept-Language", "")]
+			if period:
+				parts.append(str(int(time.time()) // period))
+
+			etag = hashlib.sha1("\n".join(parts).encode("utf-8")).hexdigest()
+			if request.if_none_match.contains(etag):
+				res = Response(status=304)
+				res.set_etag(etag)
+			else:
+				res = f(*args, **kwargs)
+				if res.status_code == 200:
+					res.set_etag(etag)
+
+			res.cache_control.max_age = max_age
+			return res
+		return inner
+
+	return decorator
+
+
+STREAM_CHUNK_SIZE = 64 * 1024
+
+
+def _iter_chunks(parts: typing.Iterable[str]) -> typing.Iterator[str]:
+	buffer = []
+	size = 0
+	for part in parts:
+		buffer.append(part)
+		size += len(part)
+		if size >= STREAM_CHUNK_SIZE:
+			yield "".join(buffer)
+			buffer = []
+			size = 0
+
+	if len(buffer) > 0:
+		yield "".join(buffer)
+
+
+def _dumps(value) -> str:
+	return current_app.json.dumps(value, separators=(",", ":"))
+
+
+def _iter_json_list(items: typing.Iterable) -> typing.Iterator[str]:
+	yield "["
+	for i, item in enumerate(items):
+		yield "," + _dumps(item) if i > 0 else _dumps(item)
+	yield "]"
+
+
+def _iter_json_object(obj: typing.Union[dict, typing.Iterator[typing.Tuple[str, typing.Any]]]) -> typing.Iterator[str]:
+	yield "{"
+	pairs = sorted(obj.items()) if isinstance(obj, dict) else obj
+	for i, (key, value) in enumerate(pairs):
+		if i > 0:
+			yield ","
+
+		yield _dumps(str(key)) + ":"
+		if isinstance(value, typing.Iterator):
+			yield from _iter_json_object(value)
+		else:
+			yield _dumps(value)
+	yield "}"
+
+
+def stream_json_list(items: typing.Iterable) -> Response:
+	"""
+	Like jsonify, but serialises one item at a time as the response is sent. `items` may be
+	a generator that reads rows as they're needed, ie: using `query.yield_per()`.
+	"""
+	return Response(stream_with_context(_iter_chunks(_iter_json_list(items))), mimetype="application/json")
+
+
+def stream_json_object(obj: dict) -> Response:
+	"""
+	Like `stream_json_list`, but for a dictionary. Values that are iterators of (key, value) are
+	streamed as objects.
+	"""
+	return Response(stream_with_context(_iter_chunks(_iter_json_object(obj))), mimetype="application/json")
+
+
+def _iter_server_sent_events(messages: typing.Iterator[typing.Optional[str]], retry_ms: int) -> typing.Iterator[str]:
+	yield f"retry: {retry_ms}\n\n"
+	for message in messages:
+		if message is None:
+			yield ":\n\n"
+		else:
+			yield "".join(f"data: {line}\n" for line in message.split("\n")) + "\n"
+
+
+def stream_server_sent_events(messages: typing.Iterator[typing.Optional[str]], retry_ms: int = 5000) -> Response:
+	"""
+	Returns a text/event-stream response, None messages are sent as comments to keep the
+	connection alive. The request context isn't kept for the stream, so that long-lived
+	connections don't hold on to a database connection.
+	"""
+	res = Response(_iter_server_sent_events(messages, retry_ms), mimetype="text/event-stream")
+	res.headers["Cache-Control"] = "no-cache"
+	res.headers["X-Accel-Buffering"] = "no"
+	return res
+
+
 def cors_allowed(f):
 	@wraps(f)
 	def inner(*args, **kwargs):
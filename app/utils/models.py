@@ -14,17 +14,21 @@
 # You should have received a copy of the GNU Affero General Public License
 # along with this program.  If not, see <https://www.gnu.org/licenses/>.
 
+import hashlib
 import typing
 from functools import wraps
 from typing import List
+from urllib.parse import urlencode
 
 import sqlalchemy.orm
-from flask import abort, redirect, url_for, request
+from flask import abort, redirect, url_for, request, Response, current_app
+from flask_babel import get_locale
 from flask_login import current_user
 from sqlalchemy import or_, and_
 from sqlalchemy.orm import sessionmaker
 
-from app.models import User, NotificationType, Package, UserRank, Notification, db, AuditSeverity, AuditLogEntry, ThreadReply, Thread, PackageState, PackageType, PackageAlias
+from app.models import User, NotificationType, Package, UserRank, Notification, db, AuditSeverity, AuditLogEntry, ThreadReply, Thread, PackageState, PackageType, PackageAlias, get_language_ids
+from app.rediscache import get_cached_response, set_cached_response, get_catalogue_revision
 
 
 def get_package_by_info(author, name):
@@ -73,6 +77,66 @@ def is_package_page(f):
 	return decorated_function
 
 
+def _store_when_finished(chunks: typing.Iterable, store: typing.Callable[[bytes], None]):
+	data = []
+	for chunk in chunks:
+		data.append(chunk.encode("utf-8") if isinstance(chunk, str) else chunk)
+		yield chunk
+
+	store(b"".join(data))
+
+
+def response_cached(expiry: int, tags: List[str]):
+	"""
+	Caches successful responses to anonymous requests in Redis, shared between processes.
+	Requests with a session are never cached, as the user may have a different locale.
+
+	`tags` are the catalogue changes that invalidate the response, see app/models/changes.py.
+	They're formatted using the view's arguments, ie: "package/{package.id}". Use "*" for
+	responses that may be affected by any change.
+	"""
+	def decorator(f):
+		@wraps(f)
+		def inner(*args, **kwargs):
+			if "Authorization" in request.headers or \
+					current_app.config["SESSION_COOKIE_NAME"] in request.cookies or \
+					current_app.config.get("REMEMBER_COOKIE_NAME", "remember_token") in request.cookies:
+				return f(*args, **kwargs)
+
+			# Responses may contain both package translations, which use Accept-Language, and
+			# gettext strings, which use the locale (including the locale cookie)
+			allowed_languages = get_language_ids()
+			lang = request.accept_languages.best_match(allowed_languages) or ""
+			locale = get_locale() or ""
+			query = urlencode(sorted(request.args.items(multi=True)))
+			key = hashlib.sha1(f"{request.path}?{query}\n{lang}\n{locale}".encode("utf-8")).hexdigest()
+
+			cached = get_cached_response(key)
+			if cached:
+				mimetype, vary, data = cached
+				res = Response(data, mimetype=mimetype)
+				if vary:
+					res.headers["Vary"] = vary
+				return res
+
+			revision = get_catalogue_revision()
+			res = f(*args, **kwargs)
+			if res.status_code == 200:
+				def store(data: bytes):
+					set_cached_response(key, revision, expiry, [tag.format(**kwargs) for tag in tags],
+							res.mimetype, res.headers.get("Vary", ""), data)
+
+				if res.is_streamed:
+					res.response = _store_when_finished(res.response, store)
+				else:
+					store(res.get_data())
+
+			return res
+		return inner
+
+	return decorator
+
+
 def add_notification(target, causer: User, type: NotificationType, title: str, url: str,
 			package: Package = None, session: sqlalchemy.orm.Session = None):
 	if session is None:
@@ -0,0 +1,136 @@
+# ContentDB
+# Copyright (C) rubenwardy
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import base64
+import binascii
+import datetime
+import json
+from typing import List, Optional, Tuple, Any
+
+from flask import abort
+from sqlalchemy import and_, or_, false
+from sqlalchemy.sql.elements import ColumnElement
+
+
+# Keyset pagination continues from the sort key of the last item on the previous page,
+# rather than skipping rows using OFFSET. This means that deep pages are as fast as the first
+# page, and that there's no need to count the total.
+#
+# Sort keys are a list of (column, descending). The last column must be unique, usually the id.
+# Nulls are ordered like Postgres does by default: last when ascending, first when descending.
+
+KeysetKeys = List[Tuple[ColumnElement, bool]]
+
+
+class KeysetPagination:
+	items: list
+	per_page: int
+	cursor: Optional[str]
+	next_cursor: Optional[str]
+
+	def __init__(self, items: list, per_page: int, cursor: Optional[str], next_cursor: Optional[str]):
+		self.items = items
+		self.per_page = per_page
+		self.cursor = cursor
+		self.next_cursor = next_cursor
+
+	@property
+	def has_next(self) -> bool:
+		return self.next_cursor is not None
+
+
+def _encode_cursor(values: List[Any]) -> str:
+	values = [x.isoformat() if isinstance(x, datetime.datetime) else x for x in values]
+	return base64.urlsafe_b64encode(json.dumps(values).encode("utf-8")).decode("utf-8").rstrip("=")
+
+
+def _decode_cursor(cursor: str, keys: KeysetKeys) -> List[Any]:
+	try:
+		values = json.loads(base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)))
+		if not isinstance(values, list) or len(values) != len(keys):
+			abort(400)
+
+		return [_decode_value(column, value) for value, (column, _) in zip(values, keys)]
+	except (binascii.Error, ValueError, TypeError, NotImplementedError):
+		abort(400)
+
+
+def _decode_value(column: ColumnElement, value: Any) -> Any:
+	"""
+	Converts a JSON value from a cursor back to the column's type. Cursors come from the client, so
+	anything that doesn't match the column is rejected rather than passed on to the database.
+	"""
+	if value is None:
+		return None
+
+	python_type = column.type.python_type
+	if python_type == datetime.datetime:
+		if not isinstance(value, str):
+			raise ValueError("Expected a datetime string")
+		return datetime.datetime.fromisoformat(value)
+
+	# bool is a subclass of int, and JSON ints are valid floats
+	if isinstance(value, bool) and python_type != bool:
+		raise TypeError("Unexpected bool")
+	if python_type == float and isinstance(value, int):
+		return float(value)
+	if not isinstance(value, python_type):
+		raise TypeError(f"Expected {python_type.__name__}")
+
+	return value
+
+
+def _is_after(column: ColumnElement, desc: bool, value):
+	if value is None:
+		return column.is_not(None) if desc else None
+	elif desc:
+		return column < value
+	else:
+		return or_(column > value, column.is_(None))
+
+
+def _is_equal(column: ColumnElement, value):
+	return column.is_(None) if value is None else column == value
+
+
+def keyset_paginate(query, keys: KeysetKeys, cursor: Optional[str], per_page: int) -> KeysetPagination:
+	"""
+	Orders the query by `keys`, and returns the page after `cursor`. An empty or None cursor
+	is the first page.
+	"""
+	if cursor:
+		values = _decode_cursor(cursor, keys)
+
+		conditions = []
+		for i, (column, desc) in enumerate(keys):
+			after = _is_after(column, desc, values[i])
+			if after is not None:
+				conditions.append(and_(*[_is_equal(keys[j][0], values[j]) for j in range(i)], after))
+
+		query = query.filter(or_(*conditions) if conditions else false())
+
+	query = query.order_by(None) \
+		.order_by(*[column.desc() if desc else column.asc() for column, desc in keys]) \
+		.add_columns(*[column.label(f"keyset_{i}") for i, (column, _) in enumerate(keys)]) \
+		.limit(per_page + 1)
+
+	rows = query.all()
+	next_cursor = None
+	if len(rows) > per_page:
+		rows = rows[:per_page]
+		next_cursor = _encode_cursor(list(rows[-1][1:]))
+
+	return KeysetPagination([row[0] for row in rows], per_page, cursor or None, next_cursor)
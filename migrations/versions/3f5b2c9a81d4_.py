@@ -0,0 +1,51 @@
+"""empty message
+
+Revision ID: 3f5b2c9a81d4
+Revises: daa040b727b2
+Create Date: 2026-10-18 10:12:41.201934
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+# revision identifiers, used by Alembic.
+revision = "3f5b2c9a81d4"
+down_revision = "daa040b727b2"
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table("package_latest_release",
+    sa.Column("id", sa.Integer(), nullable=False),
+    sa.Column("package_id", sa.Integer(), nullable=False),
+    sa.Column("minetest_release_id", sa.Integer(), nullable=True),
+    sa.Column("release_id", sa.Integer(), nullable=False),
+    sa.ForeignKeyConstraint(["package_id"], ["package.id"], ondelete="CASCADE"),
+    sa.ForeignKeyConstraint(["minetest_release_id"], ["minetest_release.id"], ondelete="CASCADE"),
+    sa.ForeignKeyConstraint(["release_id"], ["package_release.id"], ondelete="CASCADE"),
+    sa.PrimaryKeyConstraint("id")
+    )
+    with op.batch_alter_table("package_latest_release", schema=None) as batch_op:
+        batch_op.create_index("ix_package_latest_release_version", ["minetest_release_id", "package_id"], unique=False)
+
+    op.execute("""
+        INSERT INTO package_latest_release (package_id, minetest_release_id, release_id)
+        SELECT package_id, NULL, MAX(id) FROM package_release
+        WHERE approved
+        GROUP BY package_id;
+
+        INSERT INTO package_latest_release (package_id, minetest_release_id, release_id)
+        SELECT r.package_id, m.id, MAX(r.id) FROM package_release r
+        JOIN minetest_release m ON (r.min_rel_id IS NULL OR r.min_rel_id <= m.id)
+            AND (r.max_rel_id IS NULL OR r.max_rel_id >= m.id)
+        WHERE r.approved
+        GROUP BY r.package_id, m.id;
+    """)
+
+
+def downgrade():
+    with op.batch_alter_table("package_latest_release", schema=None) as batch_op:
+        batch_op.drop_index("ix_package_latest_release_version")
+
+    op.drop_table("package_latest_release")
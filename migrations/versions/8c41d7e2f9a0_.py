@@ -0,0 +1,64 @@
+"""empty message
+
+Revision ID: 8c41d7e2f9a0
+Revises: 3f5b2c9a81d4
+Create Date: 2026-10-18 12:04:19.530218
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+# revision identifiers, used by Alembic.
+revision = "8c41d7e2f9a0"
+down_revision = "3f5b2c9a81d4"
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table("package_stats_rollup",
+    sa.Column("package_id", sa.Integer(), nullable=False),
+    sa.Column("granularity", sa.String(length=5), nullable=False),
+    sa.Column("date", sa.Date(), nullable=False),
+    sa.Column("platform_minetest", sa.Integer(), nullable=False),
+    sa.Column("platform_other", sa.Integer(), nullable=False),
+    sa.Column("reason_new", sa.Integer(), nullable=False),
+    sa.Column("reason_dependency", sa.Integer(), nullable=False),
+    sa.Column("reason_update", sa.Integer(), nullable=False),
+    sa.ForeignKeyConstraint(["package_id"], ["package.id"], ondelete="CASCADE"),
+    sa.PrimaryKeyConstraint("package_id", "granularity", "date")
+    )
+    op.create_table("author_stats_rollup",
+    sa.Column("author_id", sa.Integer(), nullable=False),
+    sa.Column("granularity", sa.String(length=5), nullable=False),
+    sa.Column("date", sa.Date(), nullable=False),
+    sa.Column("platform_minetest", sa.Integer(), nullable=False),
+    sa.Column("platform_other", sa.Integer(), nullable=False),
+    sa.Column("reason_new", sa.Integer(), nullable=False),
+    sa.Column("reason_dependency", sa.Integer(), nullable=False),
+    sa.Column("reason_update", sa.Integer(), nullable=False),
+    sa.ForeignKeyConstraint(["author_id"], ["user.id"], ondelete="CASCADE"),
+    sa.PrimaryKeyConstraint("author_id", "granularity", "date")
+    )
+
+    op.execute("""
+        INSERT INTO package_stats_rollup (package_id, granularity, date, platform_minetest, platform_other,
+            reason_new, reason_dependency, reason_update)
+        SELECT package_id, g.granularity, date_trunc(g.granularity, date)::date, SUM(platform_minetest),
+            SUM(platform_other), SUM(reason_new), SUM(reason_dependency), SUM(reason_update)
+        FROM package_daily_stats, (VALUES ('week'), ('month')) AS g(granularity)
+        GROUP BY package_id, g.granularity, date_trunc(g.granularity, date);
+
+        INSERT INTO author_stats_rollup (author_id, granularity, date, platform_minetest, platform_other,
+            reason_new, reason_dependency, reason_update)
+        SELECT p.author_id, g.granularity, date_trunc(g.granularity, s.date)::date, SUM(s.platform_minetest),
+            SUM(s.platform_other), SUM(s.reason_new), SUM(s.reason_dependency), SUM(s.reason_update)
+        FROM package_daily_stats s JOIN package p ON p.id = s.package_id,
+            (VALUES ('day'), ('week'), ('month')) AS g(granularity)
+        GROUP BY p.author_id, g.granularity, date_trunc(g.granularity, s.date);
+    """)
+
+
+def downgrade():
+    op.drop_table("author_stats_rollup")
+    op.drop_table("package_stats_rollup")
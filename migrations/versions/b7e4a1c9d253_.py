@@ -0,0 +1,34 @@
+"""empty message
+
+Revision ID: b7e4a1c9d253
+Revises: 8c41d7e2f9a0
+Create Date: 2026-10-18 15:21:47.102938
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+# revision identifiers, used by Alembic.
+revision = "b7e4a1c9d253"
+down_revision = "8c41d7e2f9a0"
+branch_labels = None
+depends_on = None
+
+# Score of each point of rating above or below neutral, PackageReview.SCORE_FACTOR / 2 at the time
+# of this migration. Copied so that the migration doesn't change if the model does.
+REVIEW_SCORE_PER_RATING = 75.0
+
+
+def upgrade():
+    op.add_column("package", sa.Column("score_reviews", sa.Float(), nullable=False, server_default="0"))
+
+    op.execute(f"""
+        UPDATE package SET score_reviews = COALESCE(
+            (SELECT SUM((rating - 3) * {REVIEW_SCORE_PER_RATING}) FROM package_review
+                WHERE package_review.package_id = package.id), 0)
+    """)
+    op.execute("UPDATE package SET score = score_downloads + score_reviews")
+
+
+def downgrade():
+    op.drop_column("package", "score_reviews")
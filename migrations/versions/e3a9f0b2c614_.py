@@ -0,0 +1,43 @@
+"""empty message
+
+Revision ID: e3a9f0b2c614
+Revises: b7e4a1c9d253
+Create Date: 2026-10-18 16:02:13.481026
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+# revision identifiers, used by Alembic.
+revision = "e3a9f0b2c614"
+down_revision = "b7e4a1c9d253"
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column("package", sa.Column("reviews_positive", sa.Integer(), nullable=False, server_default="0"))
+    op.add_column("package", sa.Column("reviews_neutral", sa.Integer(), nullable=False, server_default="0"))
+    op.add_column("package", sa.Column("reviews_negative", sa.Integer(), nullable=False, server_default="0"))
+
+    op.execute("""
+        UPDATE package SET
+            reviews_positive = counts.positive,
+            reviews_neutral = counts.neutral,
+            reviews_negative = counts.negative
+        FROM (
+            SELECT package_id,
+                COUNT(*) FILTER (WHERE rating > 3) AS positive,
+                COUNT(*) FILTER (WHERE rating = 3) AS neutral,
+                COUNT(*) FILTER (WHERE rating < 3) AS negative
+            FROM package_review
+            GROUP BY package_id
+        ) AS counts
+        WHERE counts.package_id = package.id
+    """)
+
+
+def downgrade():
+    op.drop_column("package", "reviews_negative")
+    op.drop_column("package", "reviews_neutral")
+    op.drop_column("package", "reviews_positive")
@@ -16,5 +16,6 @@ if [ "$FLASK_DEBUG" -eq "1" ]; then
 	FLASK_APP=app/__init__.py FLASK_CONFIG=../config.cfg FLASK_RUN_PORT=5123 flask run --host=0.0.0.0
 else
 	ENV="-e FLASK_APP=app/__init__.py -e FLASK_CONFIG=../config.cfg -e FLASK_DEBUG=$FLASK_DEBUG"
-	gunicorn -w 4 -b :5123 $ENV app:app
+	# Threaded workers, as live download streams hold a thread each. See docs/getting_started.md
+	gunicorn -w 4 -k gthread --threads 12 -b :5123 $ENV app:app
 fi
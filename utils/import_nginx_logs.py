@@ -14,136 +14,383 @@
 # You should have received a copy of the GNU Affero General Public License
 # along with this program.  If not, see <https://www.gnu.org/licenses/>.
 
+# Imports download stats from nginx access logs.
+#
+# Usage:
+#
+#     python utils/import_nginx_logs.py LOGS_DIR [--workers N] [--checkpoint FILE]
+#     python utils/import_nginx_logs.py --tail /var/log/nginx/mirror.log --before none
+#
+# Log files are parsed in parallel by a pool of processes, each returning the counts per
+# (package, date) for its file. The counts are merged and written using bulk upserts, and
+# files are recorded in the checkpoint file once their counts are committed. Rerunning the
+# import skips files that have already been imported.
+#
+# ContentDB has counted downloads itself since 2022-11-06, so by default only downloads before
+# that date are imported. Tail mode is only for logs of downloads that ContentDB doesn't count
+# itself, such as a mirror, so it requires an explicit --before to avoid counting them twice.
+
+import argparse
 import datetime
+import gzip
 import inspect
+import json
+import multiprocessing
 import os
 import re
 import sys
-import gzip
+import time
+from functools import partial
+from typing import Dict, List, Optional, Tuple
+from urllib.parse import unquote
+
 import user_agents
-from urllib.parse import urlparse, parse_qs, unquote
 
 if not "FLASK_CONFIG" in os.environ:
 	os.environ["FLASK_CONFIG"] = "../config.cfg"
 
-logs_dir = sys.argv[1].strip()
-if not os.path.isdir(logs_dir):
-	sys.exit(1)
-
 # Allow finding the `app` module
 currentdir = os.path.dirname(os.path.abspath(inspect.getfile(inspect.currentframe())))
 parentdir = os.path.dirname(currentdir)
 sys.path.insert(0,parentdir)
 
-from app.models import db, Package, PackageDailyStats
+from app import app
+from app.models import db, Package, PackageDailyStats, User
+
+
+STATS_START_DATE = datetime.date(2022, 11, 6)
+
+FIELDS = PackageDailyStats.COUNT_FIELDS
+PLATFORM_MINETEST, PLATFORM_OTHER, REASON_NEW, REASON_DEPENDENCY, REASON_UPDATE = range(len(FIELDS))
+
+REASON_INDICES = {
+	b"new": REASON_NEW,
+	b"dependency": REASON_DEPENDENCY,
+	b"update": REASON_UPDATE,
+}
+
+# Matches a download in the combined log format, capturing the time, author, package name,
+# reason, and user agent:
+#
+#     1.2.3.4 - - [06/Nov/2022:13:55:36 +0000] "GET /packages/author/name/releases/12/download/?reason=new HTTP/1.1" 302 0 "-" "Minetest/5.6.1"
+line_re = re.compile(
+	rb'\[([^\]]+)\] "[A-Z]+ [^" ]*?/packages/([^/" ]+)/([^/" ]+)/releases/[0-9]+/download/'
+	rb'(?:\?(?:[^" &]*&)*reason=(\w+))?[^" ]*[^"]*" .*"([^"]*)"$')
+
+
+# (author/name, date) to counts, ordered as FIELDS
+Counts = Dict[Tuple[str, datetime.date], List[int]]
 
-url_re = re.compile(r"\/packages\/([^\/]+)\/([^\/]+)\/releases\/[0-9]+\/download\/[^ ]*")
-dt_re = re.compile(r"\[(\d+\/\w+\/[\d: +-]+)\]")
-ua_re = re.compile(r"\"([^\"]+)\"$")
 
-row_lookup = {}
-package_id_by_key = {}
-for package in Package.query.all():
-	package_id_by_key[f"{package.author.username}/{package.name}".lower()] = package.id
+class LogAggregator:
+	counts: Counts
 
-log_files = [f for f in os.listdir(logs_dir) if os.path.isfile(os.path.join(logs_dir, f))]
+	def __init__(self, before: Optional[datetime.date] = None):
+		self.before = before
+		self.counts = {}
+		self.lines = 0
+		self._date_cache: Dict[bytes, datetime.date] = {}
+		self._bot_cache: Dict[bytes, bool] = {}
 
-ua_is_bot = {}
+	def get_date(self, timestamp: bytes) -> datetime.date:
+		# Only the minute and timezone can change the UTC date, so parse once per minute
+		# rather than once per line
+		key = timestamp[:17] + timestamp[20:]
+		date = self._date_cache.get(key)
+		if date is None:
+			dt = datetime.datetime.strptime(timestamp.decode("ascii"), "%d/%b/%Y:%H:%M:%S %z")
+			date = dt.astimezone(datetime.timezone.utc).date()
+			self._date_cache[key] = date
+		return date
 
+	def is_bot(self, ua: bytes) -> bool:
+		is_bot = self._bot_cache.get(ua)
+		if is_bot is None:
+			is_bot = self._bot_cache[ua] = user_agents.parse(ua.decode("utf-8", "replace")).is_bot
+		return is_bot
 
-def my_open(path):
+	def add_line(self, line: bytes):
+		self.lines += 1
+		if b"/download/" not in line:
+			return
+
+		match = line_re.search(line)
+		if match is None:
+			return
+
+		timestamp, author, name, reason, ua = match.groups()
+		date = self.get_date(timestamp)
+		if self.before and date >= self.before:
+			return
+
+		if self.is_bot(ua):
+			return
+
+		package_key = unquote(f"{author.decode('utf-8', 'replace')}/{name.decode('utf-8', 'replace')}").lower()
+		key = (package_key, date)
+		counts = self.counts.get(key)
+		if counts is None:
+			counts = self.counts[key] = [0] * len(FIELDS)
+
+		if ua.startswith(b"Minetest/") or ua.startswith(b"Luanti/"):
+			counts[PLATFORM_MINETEST] += 1
+		else:
+			counts[PLATFORM_OTHER] += 1
+
+		reason_idx = REASON_INDICES.get(reason)
+		if reason_idx is not None:
+			counts[reason_idx] += 1
+
+	def merge(self, counts: Counts):
+		for key, other in counts.items():
+			mine = self.counts.get(key)
+			if mine is None:
+				self.counts[key] = list(other)
+			else:
+				for i, value in enumerate(other):
+					mine[i] += value
+
+	def take(self) -> Counts:
+		counts = self.counts
+		self.counts = {}
+		return counts
+
+
+def open_log(path: str):
 	if path.endswith(".gz"):
-		return gzip.open(path, "rt")
+		return gzip.open(path, "rb")
 	else:
-		return open(path, "r")
+		return open(path, "rb")
 
 
-for log_file in log_files:
-	print(f"Importing from {log_file}")
-	with my_open(os.path.join(logs_dir, log_file)) as infile:
-		line_no = 1
-		for line in infile:
-			if "/download/" not in line:
-				continue
+def parse_log_file(path: str, before: Optional[datetime.date]) -> Tuple[str, Counts, int]:
+	"""
+	Runs in a worker process, returns (path, counts, number of lines)
+	"""
+	aggregator = LogAggregator(before)
+	with open_log(path) as f:
+		for line in f:
+			aggregator.add_line(line)
 
-			line_no += 1
+	return path, aggregator.counts, aggregator.lines
 
-			url_match = url_re.search(line)
-			if url_match is None:
-				continue
 
-			url = url_match.group(0)
-			author = unquote(url_match.group(1))
-			name = url_match.group(2)
+class Checkpoint:
+	"""
+	Records which files have been imported, and how far through the tailed log the import is
+	"""
 
-			parsed_url = urlparse(url)
-			reason = parse_qs(parsed_url.query).get("reason")
-			if reason:
-				reason = reason[0]
+	def __init__(self, path: Optional[str]):
+		self.path = path
+		self.data = {"files": {}, "tail": None}
+		if path and os.path.isfile(path):
+			with open(path, "r") as f:
+				self.data.update(json.load(f))
 
-			dt_match = dt_re.search(line)
-			assert dt_match
-			dt = datetime.datetime.strptime(dt_match.group(1), "%d/%b/%Y:%H:%M:%S %z")
-			dt = datetime.datetime.utcfromtimestamp(dt.timestamp())
-			date = dt.date()
+	@staticmethod
+	def get_file_key(path: str) -> dict:
+		stat = os.stat(path)
+		return {"size": stat.st_size, "mtime": int(stat.st_mtime)}
 
-			if date >= datetime.date(2022, 11, 6):
-				continue
+	def is_file_done(self, path: str) -> bool:
+		return self.data["files"].get(os.path.abspath(path)) == self.get_file_key(path)
 
-			# print(line)
+	def set_files_done(self, paths: List[str]):
+		for path in paths:
+			self.data["files"][os.path.abspath(path)] = self.get_file_key(path)
+		self.save()
 
-			ua_match = ua_re.search(line)
-			if ua_match is None:
-				print("No UA: " + line)
-				continue
+	def get_tail(self, path: str) -> Optional[dict]:
+		tail = self.data.get("tail")
+		if tail and tail["path"] == os.path.abspath(path):
+			return tail
+		return None
+
+	def set_tail(self, path: str, inode: int, offset: int):
+		self.data["tail"] = {"path": os.path.abspath(path), "inode": inode, "offset": offset}
+		self.save()
+
+	def save(self):
+		if not self.path:
+			return
+
+		# Write then rename, so that the checkpoint is never left half written
+		tmp_path = self.path + ".tmp"
+		with open(tmp_path, "w") as f:
+			json.dump(self.data, f, indent=1)
+		os.replace(tmp_path, self.path)
 
-			ua = ua_match.group(1)
-			is_bot = ua_is_bot.get(ua)
-			if is_bot:
-				continue
-			if is_bot is None:
-				user_agent = user_agents.parse(ua)
-				ua_is_bot[ua] = user_agent.is_bot
-				if user_agent.is_bot:
-					continue
 
-			package_key = f"{author}/{name}".lower()
-			package_id = package_id_by_key.get(package_key)
+class StatsWriter:
+	def __init__(self, batch_size: int):
+		self.batch_size = batch_size
+		self.unknown_packages: Dict[str, int] = {}
+
+		rows = db.session.query(Package.id, User.username, Package.name).join(Package.author).all()
+		self.package_id_by_key = {f"{username}/{name}".lower(): package_id for package_id, username, name in rows}
+
+	def write(self, counts: Counts) -> int:
+		"""
+		Adds the counts to the stats in a single transaction, returns the number of downloads
+		"""
+		rows = []
+		total = 0
+		for (package_key, date), values in counts.items():
+			downloads = values[PLATFORM_MINETEST] + values[PLATFORM_OTHER]
+			package_id = self.package_id_by_key.get(package_key)
 			if package_id is None:
-				print(f"Package not found: {package_key}")
+				self.unknown_packages[package_key] = self.unknown_packages.get(package_key, 0) + downloads
 				continue
 
-			key = f"{date.isoformat()}/{package_id}"
-			# print(author, name, reason, ua, date, key)
+			row = dict(zip(FIELDS, values))
+			row["package_id"] = package_id
+			row["date"] = date
+			rows.append(row)
+			total += downloads
+
+		conn = db.session.connection()
+		for i in range(0, len(rows), self.batch_size):
+			PackageDailyStats.add_counts(conn, rows[i:i + self.batch_size])
+
+		db.session.commit()
+		return total
+
+	def print_unknown_packages(self):
+		for package_key, downloads in sorted(self.unknown_packages.items(), key=lambda x: -x[1]):
+			print(f"Package not found: {package_key} ({downloads} downloads)")
+
+
+def import_files(paths: List[str], checkpoint: Checkpoint, writer: StatsWriter, workers: int,
+		before: Optional[datetime.date], flush_rows: int):
+	todo = [path for path in paths if not checkpoint.is_file_done(path)]
+	print(f"Importing {len(todo)} files, skipping {len(paths) - len(todo)} already imported")
+	if len(todo) == 0:
+		return
+
+	# Counts from several files are merged and written together. Files are only marked as done
+	# once the transaction containing their counts is committed, so a rerun after a crash
+	# imports any files whose counts weren't written
+	pending = LogAggregator()
+	pending_files = []
+
+	def flush():
+		downloads = writer.write(pending.take())
+		checkpoint.set_files_done(pending_files)
+		print(f"Wrote {downloads} downloads from {len(pending_files)} files")
+		pending_files.clear()
+
+	with multiprocessing.Pool(workers) as pool:
+		for path, counts, lines in pool.imap_unordered(partial(parse_log_file, before=before), todo):
+			print(f"Parsed {path}: {lines} lines")
+			pending.merge(counts)
+			pending_files.append(path)
+			if len(pending.counts) >= flush_rows:
+				flush()
+
+	if len(pending_files) > 0:
+		flush()
+
 
-			row = row_lookup.get(key)
-			if not row:
-				row = PackageDailyStats()
-				row.date = date
-				row.package_id = package_id
+def tail_file(path: str, checkpoint: Checkpoint, writer: StatsWriter, before: Optional[datetime.date],
+		interval: float):
+	aggregator = LogAggregator(before)
 
-				row.platform_minetest = 0
-				row.platform_other = 0
-				row.reason_new = 0
-				row.reason_dependency = 0
-				row.reason_update = 0
+	f = open(path, "rb")
+	inode = os.fstat(f.fileno()).st_ino
+	tail = checkpoint.get_tail(path)
+	if tail and tail["inode"] == inode and tail["offset"] <= os.fstat(f.fileno()).st_size:
+		f.seek(tail["offset"])
+	else:
+		f.seek(0, os.SEEK_END)
+
+	print(f"Tailing {path} from offset {f.tell()}")
 
-				db.session.add(row)
-				row_lookup[key] = row
+	def flush():
+		downloads = writer.write(aggregator.take())
+		checkpoint.set_tail(path, inode, f.tell())
+		if downloads > 0:
+			print(f"Wrote {downloads} downloads")
 
-			if ua.startswith("Minetest/") or ua.startswith("Luanti/"):
-				row.platform_minetest += 1
+	last_flush = time.monotonic()
+	try:
+		while True:
+			line = f.readline()
+			if line.endswith(b"\n"):
+				aggregator.add_line(line)
 			else:
-				row.platform_other += 1
+				# Don't consume partially written lines
+				f.seek(-len(line), os.SEEK_CUR)
+
+				try:
+					stat = os.stat(path)
+				except FileNotFoundError:
+					stat = None
+
+				# The log was rotated, the old file has been read to the end so switch to the new one
+				if stat is not None and stat.st_ino != inode:
+					flush()
+					f.close()
+					f = open(path, "rb")
+					inode = os.fstat(f.fileno()).st_ino
+					print(f"{path} was rotated, reopening")
+					continue
+
+				time.sleep(0.5)
+
+			if time.monotonic() - last_flush >= interval:
+				flush()
+				last_flush = time.monotonic()
+	except KeyboardInterrupt:
+		pass
+	finally:
+		flush()
+		f.close()
+
+
+def main():
+	parser = argparse.ArgumentParser(description="Import download stats from nginx access logs")
+	parser.add_argument("logs_dir", nargs="?", help="Directory of log files to import, may be gzipped")
+	parser.add_argument("--tail", metavar="LOG_FILE", help="Continuously import new downloads from a live log")
+	parser.add_argument("--checkpoint", default="import_nginx_logs.checkpoint.json",
+			help="File used to record progress, so that reruns resume")
+	parser.add_argument("--workers", type=int, default=os.cpu_count(), help="Number of processes parsing files")
+	parser.add_argument("--before",
+			help=f"Only import downloads before this date, or 'none'. Defaults to {STATS_START_DATE.isoformat()} "
+				f"when importing a directory, as ContentDB counts downloads itself from then. Required with --tail")
+	parser.add_argument("--batch-size", type=int, default=5000, help="Number of rows per insert")
+	parser.add_argument("--flush-rows", type=int, default=100000,
+			help="Number of merged rows to collect before writing them")
+	parser.add_argument("--interval", type=float, default=10, help="Seconds between writes when tailing")
+	args = parser.parse_args()
+
+	if (args.logs_dir is None) == (args.tail is None):
+		parser.error("Expected exactly one of logs_dir or --tail")
+
+	# New downloads in ContentDB's own logs are already counted by ContentDB
+	if args.tail and args.before is None:
+		parser.error("--tail requires --before. Only tail logs of downloads that ContentDB doesn't count, "
+				"then use --before none")
+
+	checkpoint = Checkpoint(args.checkpoint)
+
+	before = args.before or STATS_START_DATE.isoformat()
+	before = None if before.lower() == "none" else datetime.date.fromisoformat(before)
+
+	with app.app_context():
+		writer = StatsWriter(args.batch_size)
+
+		if args.tail:
+			tail_file(args.tail, checkpoint, writer, before, args.interval)
+		else:
+			if not os.path.isdir(args.logs_dir):
+				parser.error(f"{args.logs_dir} is not a directory")
+
+			paths = sorted(os.path.join(args.logs_dir, f) for f in os.listdir(args.logs_dir)
+					if os.path.isfile(os.path.join(args.logs_dir, f)))
+			import_files(paths, checkpoint, writer, args.workers, before, args.flush_rows)
 
-			if reason == "new":
-				row.reason_new += 1
-			elif reason == "dependency":
-				row.reason_dependency += 1
-			elif reason == "update":
-				row.reason_update += 1
+		writer.print_unknown_packages()
 
-			# if line_no > 1000:
-			# 	break
 
-db.session.commit()
+if __name__ == "__main__":
+	main()